@@ -32,10 +32,34 @@ def create_app(config_class=DevelopmentConfig):
     from .routes.stream import stream_bp
     app.register_blueprint(stream_bp)
 
+    # --- Background services ---
+    from .services.checkpoint_store import local_store
+    local_store.init_app(app)
+    from .services.pdf_cache import pdf_cache
+    pdf_cache.init_app(app)
+    from .services.tts_cache import tts_cache
+    tts_cache.init_app(app)
+    from .services.llm_cache import llm_cache
+    llm_cache.init_app(app)
+
+    from .services.story_index import story_index
+    story_index.start()
+    from .services.gradio_pool import gradio_pool
+    gradio_pool.start()
+
     # --- Main Route ---
     @app.route('/')
     def index():
         from flask import render_template
         return render_template('index.html', show_browse_button=True)
 
+    from .core.decorators import metrics_token_required
+
+    @app.route('/metrics')
+    @metrics_token_required
+    def metrics_snapshot():
+        from flask import jsonify
+        from .core import metrics
+        return jsonify(metrics.snapshot())
+
     return app
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """Thread-safe LRU mapping that remembers how long ago each entry was stored."""
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (value, age_in_seconds) for `key`, or None if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            value, stored_at = entry
+        return value, time.monotonic() - stored_at
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        """Drop every entry whose key satisfies `predicate(key)`."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+class DiskCache:
+    """Thread-safe persistent key -> JSON value store in SQLite, trimmed to `max_entries` by last use.
+
+    Call `open(path)` once the location is known (usually under the app's instance folder);
+    until then every lookup misses and writes are dropped.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.path = None
+        self._conn = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        with self._lock:
+            self.path = path
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, used_at REAL NOT NULL)')
+
+    def get(self, key):
+        """The stored value for `key`, or None."""
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            with self._conn:
+                self._conn.execute('UPDATE entries SET used_at = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self._lock:
+            if self._conn is None:
+                return
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO entries (key, value, used_at) VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
+                self._writes += 1
+                # Trimming scans the table, so only do it every so often
+                if self._writes % 100 == 0:
+                    self._conn.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def discard(self, key):
+        with self._lock:
+            if self._conn is None:
+                return
+            with self._conn:
+                self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def __len__(self):
+        with self._lock:
+            if self._conn is None:
+                return 0
+            return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one call (on one event loop)."""
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def run(self, key, make_coro):
+        """Await `make_coro()`, or the call already running for `key` if there is one."""
+        while key in self._calls:
+            call = self._calls[key]
+            self.shared += 1
+            try:
+                return await asyncio.shield(call)
+            except asyncio.CancelledError:
+                if not call.cancelled():
+                    raise
+                # The caller we were sharing with was cancelled, not us: make our own call
+
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await make_coro()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # Mark it retrieved, in case nobody was sharing it
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            self._calls.pop(key, None)
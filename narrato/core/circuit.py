@@ -0,0 +1,116 @@
+"""Circuit breakers that stop sending traffic to a dependency while it is failing."""
+import threading
+import time
+from collections import deque
+
+from .metrics import LatencyHistogram
+
+class CircuitBreaker:
+    """Rolling-window circuit breaker with closed, open and half-open states.
+
+    While closed, every call is allowed. Outcomes are remembered for `window_seconds` (at most
+    `window` of them), so an old failure stops counting against a dependency that has not been
+    called since. Once at least `min_calls` outcomes are known and the failure rate reaches
+    `failure_threshold`, the breaker opens and refuses calls for `open_seconds`. After that it
+    goes half-open and lets one probe call through. A successful probe closes it again. A
+    failed probe reopens it for twice as long, up to `max_open_seconds`. Callers that acquired
+    a call but never produced an outcome (e.g. they were cancelled) must `release()` it.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=0.5, min_calls=4, window=20, window_seconds=300, open_seconds=30, max_open_seconds=600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = self.CLOSED
+        self.latency = LatencyHistogram(window=window)
+        self._outcomes = deque(maxlen=window)
+        self._open_for = open_seconds
+        self._opened_until = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _recent_outcomes(self):
+        cutoff = time.monotonic() - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+        return [ok for _, ok in self._outcomes]
+
+    @property
+    def success_rate(self):
+        with self._lock:
+            outcomes = self._recent_outcomes()
+        return outcomes.count(True) / len(outcomes) if outcomes else 1.0
+
+    @property
+    def reopens_in(self):
+        """Seconds until an open breaker lets a probe through (0 if calls are allowed now)."""
+        with self._lock:
+            return max(0.0, self._opened_until - time.monotonic()) if self.state == self.OPEN else 0.0
+
+    def available(self):
+        """Whether `try_acquire` would currently succeed, without claiming anything."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.monotonic() >= self._opened_until
+            return not self._probe_in_flight
+
+    def try_acquire(self):
+        """Claim permission for one call. In the half-open state only one probe is allowed at a time."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() >= self._opened_until:
+                self.state = self.HALF_OPEN
+                print(f"--- Circuit {self.name} --- INFO: Half-open, sending a probe")
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """Give back a claimed call that produced no outcome."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self, seconds=None):
+        if seconds is not None:
+            self.latency.observe(seconds)
+        with self._lock:
+            self._outcomes.append((time.monotonic(), True))
+            if self.state == self.HALF_OPEN:
+                print(f"--- Circuit {self.name} --- INFO: Probe succeeded, closing")
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                self._open_for = self.open_seconds
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append((time.monotonic(), False))
+            outcomes = self._recent_outcomes()
+            if self.state == self.HALF_OPEN:
+                self._open_for = min(self._open_for * 2, self.max_open_seconds)
+                self._open()
+            elif self.state == self.CLOSED and len(outcomes) >= self.min_calls \
+                    and outcomes.count(False) / len(outcomes) >= self.failure_threshold:
+                self._open()
+            self._probe_in_flight = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_until = time.monotonic() + self._open_for
+        print(f"--- Circuit {self.name} --- WARN: Open for {self._open_for:.0f}s")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "success_rate": round(self.success_rate, 2),
+            "reopens_in": round(self.reopens_in),
+            "latency": self.latency.snapshot(),
+        }
@@ -1,5 +1,7 @@
+import hmac
+import os
 from functools import wraps
-from flask import session, redirect, url_for, request
+from flask import session, redirect, url_for, request, abort
 
 def login_required(f):
     @wraps(f)
@@ -8,3 +10,18 @@ def login_required(f):
             return redirect(url_for('routes.auth.login', next=request.url))
         return f(*args, **kwargs)
     return decorated_function
+
+def metrics_token_required(f):
+    """Only serve the request if it carries METRICS_TOKEN, as a Bearer token or a `token` query
+    parameter. Without METRICS_TOKEN set, the endpoint does not exist."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        expected = os.getenv('METRICS_TOKEN')
+        if not expected:
+            abort(404)
+        auth = request.headers.get('Authorization', '')
+        token = auth[len('Bearer '):] if auth.startswith('Bearer ') else request.args.get('token', '')
+        if not hmac.compare_digest(token.encode(), expected.encode()):
+            abort(401)
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,78 @@
+"""Incremental reading of a JSON document that arrives in pieces, e.g. from a streamed LLM response."""
+import json
+
+_OBJECT, _ARRAY = '{', '['
+
+class JSONStreamParser:
+    """Reports each scalar value of a JSON document as soon as it has been read in full.
+
+    `feed(text)` returns a list of (path, value) pairs, where `path` is a tuple of object
+    keys and array indices, e.g. (('paragraphs', 2), "Third paragraph"). Anything before the
+    first `{` or `[` (such as a Markdown code fence) is skipped, parsing stops at the end of
+    the top-level value, and a trailing comma before `]` or `}` is tolerated. This does not
+    validate the document; parse the complete text with `json.loads` for that.
+    """
+    def __init__(self):
+        self._stack = []  # [kind, key or index] per open container
+        self._started = False
+        self.done = False
+        self._string = None
+        self._escaped = False
+        self._literal = None
+
+    def _path(self):
+        return tuple(position for _, position in self._stack)
+
+    def _emit(self, raw, events):
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return
+        top = self._stack[-1]
+        if top[0] == _OBJECT and top[1] is None:
+            top[1] = value  # an object key; its value comes next
+        else:
+            events.append((self._path(), value))
+
+    def feed(self, text):
+        events = []
+        for ch in text:
+            if self.done:
+                break
+            if self._string is not None:
+                self._string.append(ch)
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    raw, self._string = ''.join(self._string), None
+                    self._emit(raw, events)
+                continue
+            if self._literal is not None:
+                if not (ch in ',]}' or ch.isspace()):
+                    self._literal.append(ch)
+                    continue
+                raw, self._literal = ''.join(self._literal), None
+                self._emit(raw, events)
+            if not self._started:
+                if ch in '{[':
+                    self._started = True
+                    self._stack.append([ch, None if ch == _OBJECT else 0])
+                continue
+            if ch == '"':
+                self._string = [ch]
+            elif ch in '{[':
+                self._stack.append([ch, None if ch == _OBJECT else 0])
+            elif ch in '}]':
+                self._stack.pop()
+                self.done = not self._stack
+            elif ch == ',':
+                top = self._stack[-1]
+                if top[0] == _ARRAY:
+                    top[1] += 1
+                else:
+                    top[1] = None
+            elif not (ch == ':' or ch.isspace()):
+                self._literal = [ch]
+        return events
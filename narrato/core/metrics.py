@@ -0,0 +1,63 @@
+"""Registry of named metric sources, served together as JSON from /metrics."""
+import bisect
+import threading
+from collections import deque
+
+_sources = {}
+
+def register(name, snapshot):
+    """Register a zero-argument callable returning a JSON-serializable snapshot."""
+    _sources[name] = snapshot
+
+def snapshot():
+    """Collect the current snapshot from every registered source."""
+    return {name: source() for name, source in _sources.items()}
+
+class LatencyHistogram:
+    """Thread-safe fixed-bucket latency histogram (bucket bounds in milliseconds).
+
+    Quantiles are computed from a window of the most recent samples, so they track current
+    conditions rather than the whole lifetime of the process.
+    """
+    BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, window=500):
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self._recent = deque(maxlen=window)
+        self._total = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        index = bisect.bisect_left(self.BUCKETS_MS, ms)
+        with self._lock:
+            self._counts[index] += 1
+            self._recent.append(ms)
+            self._total += ms
+            self._count += 1
+
+    def __len__(self):
+        """Number of recent samples that quantiles are computed from."""
+        with self._lock:
+            return len(self._recent)
+
+    def quantile(self, q):
+        """The q-th quantile (ms) of the recent samples, or None if there are none."""
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return None
+        return round(recent[min(len(recent) - 1, int(q * len(recent)))], 1)
+
+    def snapshot(self):
+        with self._lock:
+            counts, count, total = list(self._counts), self._count, self._total
+        labels = [f"<={bound}ms" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        return {
+            "count": count,
+            "avg_ms": round(total / count, 1) if count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "buckets": dict(zip(labels, counts)),
+        }
@@ -0,0 +1,90 @@
+"""Just enough MPEG audio parsing to cut an MP3 into clips on frame boundaries, without re-encoding."""
+
+# Bitrates in kbps by bitrate index, for Layer III
+_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),  # MPEG-1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),      # MPEG-2 and 2.5
+}
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),   # MPEG-2.5
+}
+
+def _id3v2_size(data):
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def _frame_header(data, offset):
+    """(frame length in bytes, duration in seconds) of the Layer III frame at `offset`, or None."""
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 0x3
+    layer = (data[offset + 1] >> 1) & 0x3
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = (data[offset + 2] >> 2) & 0x3
+    padding = (data[offset + 2] >> 1) & 0x1
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    bitrate = _BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    samples = 1152 if version == 3 else 576
+    return samples * bitrate // 8 // sample_rate + padding, samples / sample_rate
+
+def _is_info_frame(frame):
+    """Whether a frame is a Xing/Info/VBRI header, which describes the whole file rather than holding audio."""
+    return b'Xing' in frame[:64] or b'Info' in frame[:64] or frame[36:40] == b'VBRI'
+
+def mp3_frames(data):
+    """List of (offset, length, start_seconds) for the audio frames in an MP3.
+
+    Raises ValueError if the data is not a Layer III stream.
+    """
+    frames = []
+    offset = first = _id3v2_size(data)
+    elapsed = 0.0
+    while offset < len(data):
+        header = _frame_header(data, offset)
+        if header is None:
+            if data[offset:offset + 3] == b'TAG':
+                break  # ID3v1 tag at the end
+            raise ValueError(f"No MP3 frame at byte {offset}")
+        length, seconds = header
+        if offset == first and _is_info_frame(data[offset:offset + length]):
+            offset += length  # skip it; the clips' timeline starts at the first audio frame
+            continue
+        frames.append((offset, length, elapsed))
+        elapsed += seconds
+        offset += length
+    if not frames:
+        raise ValueError("No MP3 frames found")
+    return frames
+
+def mp3_duration(data):
+    frames = mp3_frames(data)
+    offset, length, start = frames[-1]
+    return start + _frame_header(data, offset)[1]
+
+def split_mp3(data, cut_seconds):
+    """Split an MP3 at the frames nearest to each time in `cut_seconds` (ascending).
+
+    Returns len(cut_seconds) + 1 clips. Each clip is a run of whole frames, so players read
+    it as a valid MP3. Cuts should fall in silence: a frame may borrow bits from the frame
+    before it, so the first few milliseconds after a cut can decode as noise otherwise.
+    """
+    frames = mp3_frames(data)
+    bounds = [0]
+    for cut in cut_seconds:
+        index = min(range(len(frames)), key=lambda i: abs(frames[i][2] - cut))
+        if index <= bounds[-1]:
+            raise ValueError(f"Cut at {cut:.2f}s would leave an empty clip")
+        bounds.append(index)
+    bounds.append(len(frames))
+    clips = []
+    for start, end in zip(bounds, bounds[1:]):
+        first, last = frames[start], frames[end - 1]
+        clips.append(data[first[0]:last[0] + last[1]])
+    return clips
@@ -0,0 +1,95 @@
+import asyncio
+from collections import deque
+
+class Stage:
+    """A named unit of work that may start once every stage it depends on has completed."""
+    def __init__(self, name, run, depends_on=(), weight=1):
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+        self.weight = weight
+
+class StagePipeline:
+    """Runs a dependency graph of stages, starting each one as soon as its dependencies are done.
+
+    Each stage is awaited as `stage.run(report)`, where `report(message, fraction, data=None)`
+    publishes that stage's progress. Reports from all running stages are merged into a single
+    overall percentage weighted by each stage's `weight`.
+    """
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            unknown = [dep for dep in stage.depends_on if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stage(s): {', '.join(unknown)}")
+        self.total_weight = sum(stage.weight for stage in stages) or 1
+        self._fractions = {}
+
+    def progress(self, fractions=None):
+        """Overall progress (0-100) for a mapping of stage name -> completed fraction."""
+        fractions = self._fractions if fractions is None else fractions
+        done = sum(self.stages[name].weight * fraction for name, fraction in fractions.items() if name in self.stages)
+        return int(100 * done / self.total_weight)
+
+    async def run(self, completed=(), on_stage_done=None, ping_interval=15):
+        """Run every stage not in `completed`.
+
+        Yields (message, progress, data) tuples as stages report, or None whenever no stage
+        reported for `ping_interval` seconds. `await on_stage_done(name)` runs as each stage
+        finishes, before any stage depending on it is started. A failing stage cancels the rest.
+        """
+        done = set(completed) & set(self.stages)
+        self._fractions = {name: 1.0 for name in done}
+        pending_events = deque()
+        wake = asyncio.Event()
+        running = {}
+
+        def reporter(name):
+            def report(message, fraction, data=None):
+                self._fractions[name] = max(0.0, min(1.0, fraction))
+                pending_events.append((message, self.progress(), data))
+                wake.set()
+            return report
+
+        def launch_ready():
+            for stage in self.stages.values():
+                if stage.name in done or stage.name in running:
+                    continue
+                if all(dep in done for dep in stage.depends_on):
+                    running[stage.name] = asyncio.create_task(stage.run(reporter(stage.name)))
+
+        launch_ready()
+        try:
+            while running:
+                while pending_events:
+                    yield pending_events.popleft()
+
+                finished = [name for name, task in running.items() if task.done()]
+                for name in finished:
+                    running.pop(name).result()
+                    done.add(name)
+                    self._fractions[name] = 1.0
+                    if on_stage_done:
+                        await on_stage_done(name)
+                if finished:
+                    launch_ready()
+                    continue
+
+                wake.clear()
+                waiter = asyncio.create_task(wake.wait())
+                try:
+                    ready, _ = await asyncio.wait({waiter, *running.values()}, timeout=ping_interval, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+                if not ready:
+                    yield None
+
+            while pending_events:
+                yield pending_events.popleft()
+
+            blocked = [name for name in self.stages if name not in done]
+            if blocked:
+                raise RuntimeError(f"Pipeline stages could not be scheduled: {', '.join(blocked)}")
+        finally:
+            for task in running.values():
+                task.cancel()
@@ -1,13 +1,16 @@
-from flask import Blueprint, render_template, request, jsonify, send_file, Response
+from flask import Blueprint, render_template, request, jsonify, send_file
 from urllib.parse import unquote
 import os
-from weasyprint import HTML
 from io import BytesIO
 import requests
 import base64
 from pathlib import Path
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 from ..services.shov_api import shov_where, shov_remove, shov_contents
+from ..services.story_index import story_index, summarize_story, paginate, SUMMARY_COLLECTION
+from ..services.pdf_cache import pdf_cache
 from ..core.decorators import login_required
 
 story_bp = Blueprint('story', __name__)
@@ -27,51 +30,69 @@ def list_stories():
 
 @story_bp.route('/browse')
 def browse_stories():
-    """Browse all public stories"""
-    stories_response = shov_where('stories', {'public': True})
-    public_stories = stories_response.get('items', [])
-    return render_template('browse.html', stories=public_stories, show_browse_button=False)
+    """Browse all public stories, one page at a time"""
+    page = request.args.get('page', 1, type=int)
+    fields = ('story_uuid', 'title', 'cover_url')
+    if story_index.ready:
+        listing = story_index.public_stories(page, fields=fields)
+    else:
+        stories_response = shov_where('stories', {'public': True})
+        listing = paginate([summarize_story(item['id'], item['value']) for item in stories_response.get('items', [])], page, fields=fields)
+    return render_template('browse.html', stories=listing['items'], listing=listing, show_browse_button=False)
+
+
+def _find_story(indexed_story, filter_dict):
+    """Return (story or None, whether Shov was reachable).
 
+    Uses the story index's copy when it has one, and otherwise the first story matching
+    `filter_dict` in Shov, which the index then keeps for next time.
+    """
+    if indexed_story is not None:
+        return indexed_story, True
+    story_response = shov_where('stories', filter_dict)
+    if not story_response.get('success', True):
+        return None, False
+    stories = story_response.get('items', [])
+    if not stories:
+        return None, True
+    story_index.remember_story(stories[0]['id'], stories[0]['value'])
+    return stories[0]['value'], True
 
 @story_bp.route('/stories/<title>')
 def get_story(title):
     """Get a story from the database"""
     decoded_title = unquote(title)
-    story_response = shov_where('stories', {'title': decoded_title})
-    if not story_response.get('success', True):
-        return render_template('story_view.html', story=None, error="database_down"), 503
-
-    stories = story_response.get('items', [])
-    if stories:
-        story = stories[0]['value']
+    story, reachable = _find_story(story_index.story_for_title(decoded_title), {'title': decoded_title})
+    if story:
         return render_template('story_view.html', story=story)
-    
+    if not reachable:
+        return render_template('story_view.html', story=None, error="database_down"), 503
     return render_template('story_view.html', story=None, error="not_found"), 404
 
 
 @story_bp.route('/view_story/<story_uuid>')
 def view_story(story_uuid):
     """Get a story from the database by ID"""
-    story_response = shov_where('stories', {'story_uuid': story_uuid})
-    
-    if not story_response.get('success', True):
-        return render_template('story_view.html', story=None, error="database_down"), 503
-
-    stories = story_response.get('items', [])
-    if stories:
-        story = stories[0]['value']
+    story, reachable = _find_story(story_index.story_for_uuid(story_uuid), {'story_uuid': story_uuid})
+    if story:
         return render_template('story_view.html', story=story)
-    
+    if not reachable:
+        return render_template('story_view.html', story=None, error="database_down"), 503
     return render_template('story_view.html', story=None, error="not_found"), 404
 
 @story_bp.route('/history')
 @login_required
 def story_history():
-    """Display user's story history"""
+    """Display user's story history, one page at a time"""
     from flask import session
-    stories_response = shov_where('stories', {'email': session['email']})
-    user_stories = stories_response.get('items', [])
-    return render_template('history.html', stories=user_stories)
+    page = request.args.get('page', 1, type=int)
+    fields = ('id', 'title', 'excerpt')
+    if story_index.ready:
+        listing = story_index.stories_for_email(session['email'], page, fields=fields)
+    else:
+        stories_response = shov_where('stories', {'email': session['email']})
+        listing = paginate([summarize_story(item['id'], item['value']) for item in stories_response.get('items', [])], page, fields=fields)
+    return render_template('history.html', stories=listing['items'], listing=listing)
 
 @story_bp.route('/delete_story', methods=['POST'])
 @login_required
@@ -84,13 +105,21 @@ def delete_story():
     if not story_id:
         return jsonify({"success": False, "error": "Invalid request: No story ID provided."} ), 400
 
-    stories_response = shov_where('stories', {'email': session['email']})
-    user_stories = stories_response.get('items', [])
-    owned_story_ids = [story['id'] for story in user_stories]
+    owned_story_ids = story_index.ids_for_email(session['email'])
+    if story_id not in owned_story_ids:
+        # The index may not have caught up with a story written by another worker yet
+        stories_response = shov_where('stories', {'email': session['email']})
+        owned_story_ids = {story['id'] for story in stories_response.get('items', [])}
 
     if story_id in owned_story_ids:
+        summary_ids = {story_index.summary_id_for(story_id)}
         delete_response = shov_remove('stories', story_id)
         if delete_response.get('success'):
+            # Remove every summary of the story, so a duplicate cannot bring it back to /browse
+            summary_response = shov_where(SUMMARY_COLLECTION, {'story_id': story_id})
+            summary_ids.update(item['id'] for item in summary_response.get('items', []))
+            for summary_id in summary_ids - {None}:
+                shov_remove(SUMMARY_COLLECTION, summary_id)
             return jsonify({"success": True})
         else:
             error_msg = delete_response.get('error', 'Unknown error during deletion.')
@@ -101,17 +130,18 @@ def delete_story():
 @story_bp.route('/export_pdf/<story_uuid>')
 def export_pdf(story_uuid):
     """Export a story as a PDF"""
-    story_response = shov_where('stories', {'story_uuid': story_uuid})
-    stories = story_response.get('items', [])
-    if stories:
-        story = stories[0]['value']
-
-        html = render_template('pdf_template.html', story=story)
-        
-        pdf_file = HTML(string=html).write_pdf()
-
-        response = Response(pdf_file, mimetype='application/pdf')
-        response.headers['Content-Disposition'] = f'attachment; filename="{story["title"]}.pdf"'
-        return response
+    story, _ = _find_story(story_index.story_for_uuid(story_uuid), {'story_uuid': story_uuid})
+    if story:
+        try:
+            pdf_path, etag = pdf_cache.get_or_render(story)
+        except FuturesTimeoutError:
+            print(f"--- PDF Export --- WARN: Rendering story {story_uuid} timed out")
+            return "The PDF took too long to render. Please try again in a moment.", 503
+        except BrokenProcessPool:
+            print(f"--- PDF Export --- ERROR: A PDF render process died while rendering story {story_uuid}")
+            return "The PDF could not be rendered. Please try again.", 503
+        # conditional=True answers If-None-Match with 304 and serves Range requests
+        return send_file(pdf_path, mimetype='application/pdf', as_attachment=True,
+                         download_name=f"{story['title']}.pdf", conditional=True, etag=etag)
 
     return "Story not found", 404
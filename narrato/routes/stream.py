@@ -1,188 +1,256 @@
-from flask import Blueprint, request, Response, session
+from flask import Blueprint, request, Response, session, jsonify
 import asyncio
 import json
+import os
 import traceback
-from ..services.shov_api import shov_where, shov_update, shov_add, shov_remove
-from ..services.generation import generate_story_content, generate_style_guide, analyze_story_characters, generate_all_image_prompts, generate_image, generate_voice
+import uuid
+from datetime import datetime, timezone
+from ..services.shov_async import shov_add, shov_update
+from ..services.checkpoint import StoryCheckpoint
+from ..services.pdf_cache import pdf_cache, PDF_CACHE_WARM
+from ..services.generation import generate_story_content, generate_visual_plan, generate_style_guide, analyze_story_characters, generate_all_image_prompts, generate_image, generate_voice
+from ..services.engine import engine, JobAccessDenied
+from ..services.scheduler import current_owner
+from ..services.story_index import SUMMARY_COLLECTION, summary_record
+from ..core.pipeline import Stage, StagePipeline
 
 stream_bp = Blueprint('stream', __name__)
 
-# Define a semaphore to limit concurrent thread-based tasks
+# How many images/clips a single story queues at once. Process-wide provider limits,
+# shared fairly between stories, are enforced by services.scheduler.provider_scheduler.
 CONCURRENCY_LIMIT = 4 # A safe number for a small Heroku dyno
-semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
+IMAGE_CONCURRENCY = int(os.getenv('IMAGE_CONCURRENCY', CONCURRENCY_LIMIT))
+# Clips queued together are narrated in a few batched Speechify requests (see services.tts_batch)
+AUDIO_CONCURRENCY = int(os.getenv('AUDIO_CONCURRENCY', 24))
+PING_INTERVAL = 15
+
+async def _fan_out(indices, make_coro, limit):
+    """Run make_coro(i) for every index with at most `limit` calls in flight.
+
+    Yields (index, result) pairs in completion order.
+    """
+    slots = asyncio.Semaphore(limit)
+
+    async def run(i):
+        async with slots:
+            return i, await make_coro(i)
+
+    tasks = [asyncio.create_task(run(i)) for i in indices]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def _pad_slots(items, size):
+    """Return a list of exactly `size` slots, keeping filled entries by index and None for missing ones."""
+    slots = list(items[:size])
+    return slots + [None] * (size - len(slots))
+
+def _stages_from_step(step):
+    """Translate a checkpoint from the old sequential `step` counter into completed stage names."""
+    completed = []
+    if step >= 1: completed.append('content')
+    # Step 2 (style guide and characters) left both in story_data, where the visual plan stage reuses them
+    if step >= 3: completed.append('visual_plan')
+    if step >= 4: completed.append('images')
+    if step >= 5: completed.append('audio')
+    return completed
 
 async def generate_story_for_stream(prompt, image_mode, min_paragraphs, max_paragraphs, email, public, story_uuid=None):
-    """Generate story and stream progress, with state saving."""
+    """Generate story and stream progress, with state saving.
+
+    The work is split into stages with declared dependencies, so narration runs
+    alongside the visual plan (style guide, characters and image prompts) and images. The story
+    text is streamed: each paragraph is sent to the client, and its narration started,
+    as soon as Gemini has written it.
+    """
     
     def progress_update(task, step, total, data=None):
         return {"task": task, "progress": step, "total": total, "data": data}
 
+    current_owner.set(story_uuid)
+    prefetch_tasks = set()
     try:
-        step = 0
-        state_data = {}
-        shov_id = None
-
-        if story_uuid:
-            response = None
-            for _ in range(3):
-                response = shov_where('stream_progress', {'story_uuid': story_uuid})
-                if response and response.get('items'):
-                    break
-                await asyncio.sleep(0.5)
-
-            if response and response.get('items'):
-                item = response['items'][0]
-                shov_id = item['id']
-                state_data = item['value']
-                step = state_data.get('step', 0)
-                print(f"Resuming story {story_uuid} (shov_id: {shov_id}) from step {step}")
+        checkpoint = StoryCheckpoint(story_uuid)
+        state_data = await checkpoint.load() if story_uuid else {}
 
         story_data = state_data.get('story_data', {})
         image_prompts = state_data.get('image_prompts', [])
+        completed_stages = set(state_data.get('completed_stages') or _stages_from_step(state_data.get('step', 0)))
+        if 'image_prompts' in completed_stages:
+            # Checkpoints from before the style guide, characters and image prompts became one stage
+            completed_stages.add('visual_plan')
+        if checkpoint.source:
+            print(f"Resuming story {story_uuid} from its {checkpoint.source} checkpoint with completed stages: {sorted(completed_stages)}")
 
-        def save_progress(current_step, data_to_save):
-            nonlocal shov_id
-            state = {'step': current_step, 'story_uuid': story_uuid, **data_to_save}
-
-            if shov_id:
-                result = shov_update('stream_progress', shov_id, state)
-            else:
-                result = shov_add('stream_progress', state)
-                if result.get('success') and result.get('id'):
-                    shov_id = result['id']
-
-            if not result.get('success'):
-                print(f"CRITICAL: Failed to save progress for story {story_uuid}. Error: {result.get('details')}")
-                raise IOError(f"Failed to save progress: {result.get('details')}")
-            print(f"Saved progress for story {story_uuid} at step {current_step}")
-
-        if step > 0:
-            initial_progress = 10
-            if step == 2: initial_progress = 25
-            elif step == 3: initial_progress = 35
-            elif step == 4: initial_progress = 70
-            elif step == 5: initial_progress = 95
-            yield progress_update(f"Resuming generation...", initial_progress, 100, story_data)
-
-        while step < 6:
-            if step == 0:
-                yield progress_update('Creating story content...', 0, 100)
-                ping_task = asyncio.create_task(generate_story_content(prompt, min_paragraphs, max_paragraphs))
-                while not ping_task.done():
-                    try:
-                        await asyncio.wait_for(asyncio.shield(ping_task), timeout=15)
-                    except asyncio.TimeoutError:
-                        yield progress_update('Creating story content... (ping)', 0, 100)
-                story_data = await ping_task
-                save_progress(1, {'story_data': story_data})
-                yield progress_update('Story content generated', 10, 100, story_data)
-                step = 1
-            elif step == 1:
-                yield progress_update('Analyzing story elements...', 15, 100)
-                style_task = generate_style_guide(story_data)
-                chars_task = analyze_story_characters(story_data)
-                
-                async def gather_elements():
-                    return await asyncio.gather(style_task, chars_task)
-
-                gather_task = asyncio.create_task(gather_elements())
-                while not gather_task.done():
-                    try:
-                        await asyncio.wait_for(asyncio.shield(gather_task), timeout=15)
-                    except asyncio.TimeoutError:
-                        yield progress_update('Analyzing story elements... (ping)', 15, 100)
-                style_data, char_data = await gather_task
-                story_data['style_guide'] = style_data
+        def prefetch_voice(text):
+            """Start narrating text early; the audio stage picks the clip up from the TTS cache."""
+            task = asyncio.create_task(generate_voice(text))
+            prefetch_tasks.add(task)
+            task.add_done_callback(prefetch_tasks.discard)
+
+        async def content_stage(report):
+            nonlocal story_data
+            report('Creating story content...', 0)
+
+            def on_title(title):
+                report('Writing the story...', 0.05, {'title': title})
+                prefetch_voice(title)
+
+            def on_paragraph(i, paragraph):
+                report(f'Wrote paragraph {i + 1}', min(0.95, (i + 1) / max_paragraphs), {'paragraph': paragraph, 'index': i})
+                prefetch_voice(paragraph)
+
+            story_data = await generate_story_content(prompt, min_paragraphs, max_paragraphs, on_title=on_title, on_paragraph=on_paragraph)
+            checkpoint.set(['story_data'], story_data)
+            report('Story content generated', 1, story_data)
+
+        async def visual_plan_stage(report):
+            """Art style, characters and image prompts, in one structured Gemini call when possible."""
+            nonlocal image_prompts
+            if 'style_guide' not in story_data or 'character_database' not in story_data:
+                report('Planning art style, characters and image prompts...', 0)
+                plan = await generate_visual_plan(story_data)
+                if plan:
+                    story_data['style_guide'], story_data['character_database'], image_prompts = plan
+                    checkpoint.set(['story_data', 'style_guide'], story_data['style_guide'])
+                    checkpoint.set(['story_data', 'character_database'], story_data['character_database'])
+                    checkpoint.set(['image_prompts'], image_prompts)
+                    report(f'Planned art style, characters and {len(image_prompts)} image prompts', 1)
+                    return
+
+                report('Analyzing art style and characters...', 0.1)
+                style_guide, char_data = await asyncio.gather(generate_style_guide(story_data), analyze_story_characters(story_data))
+                story_data['style_guide'] = style_guide
                 story_data['character_database'] = char_data if char_data else {"main_characters": [], "supporting_characters": [], "groups": []}
-                save_progress(2, {'story_data': story_data})
-                yield progress_update('Story elements analyzed', 25, 100, story_data)
-                step = 2
-            elif step == 2:
-                yield progress_update('Generating image prompts...', 30, 100)
-                prompts_task = asyncio.create_task(generate_all_image_prompts(story_data))
-                while not prompts_task.done():
-                    try:
-                        await asyncio.wait_for(asyncio.shield(prompts_task), timeout=15)
-                    except asyncio.TimeoutError:
-                        yield progress_update('Generating image prompts... (ping)', 30, 100)
-                image_prompts = await prompts_task
-                save_progress(3, {'story_data': story_data, 'image_prompts': image_prompts})
-                yield progress_update(f'Generated {len(image_prompts)} prompts', 35, 100)
-                step = 3
-            elif step == 3:
-                if image_mode == 'generate':
-                    yield progress_update('Generating images...', 40, 100)
-                    image_data = story_data.get('images', [])
-                    num_prompts = len(image_prompts)
-                    start_index = len(image_data)
-                    for i, p in enumerate(image_prompts[start_index:], start=start_index):
-                        progress = 40 + int(30 * (i + 1) / num_prompts)
-                        yield progress_update(f'Waiting for image slot {i + 1} of {num_prompts}...', progress, 100)
-                        async with semaphore:
-                            yield progress_update(f'Generating image {i + 1} of {num_prompts}...', progress, 100)
-                            image_task = asyncio.create_task(generate_image(p))
-                            while not image_task.done():
-                                try:
-                                    await asyncio.wait_for(asyncio.shield(image_task), timeout=15)
-                                except asyncio.TimeoutError:
-                                    yield progress_update(f'Generating image {i + 1} of {num_prompts}... (ping)', progress, 100)
-                            image_url = await image_task
-                        
-                        image_data.append({'url': image_url, 'prompt': p})
-                        story_data['images'] = image_data
-                        save_progress(3, {'story_data': story_data, 'image_prompts': image_prompts})
-                        yield progress_update(f'Generated image {i + 1} of {num_prompts}', progress, 100, story_data)
+                checkpoint.set(['story_data', 'style_guide'], story_data['style_guide'])
+                checkpoint.set(['story_data', 'character_database'], story_data['character_database'])
+
+            report('Generating image prompts...', 0.5)
+            image_prompts = await generate_all_image_prompts(story_data)
+            checkpoint.set(['image_prompts'], image_prompts)
+            report(f'Generated {len(image_prompts)} prompts', 1)
+
+        saved_ids = {}
+        # Late images that arrive while save_stage is writing the story; it saves them once it has the ids
+        late_while_saving = set()
+
+        async def update_saved_story(indices):
+            await shov_update('stories', saved_ids['story'], story_data)
+            if 0 in indices and saved_ids.get('summary'):
+                await shov_update(SUMMARY_COLLECTION, saved_ids['summary'], summary_record(saved_ids['story'], story_data))
+
+        def store_late_image(i):
+            """Callback for an image that missed its deadline but was generated in the background."""
+            async def store(image_url):
+                story_data['images'][i] = {'url': image_url, 'prompt': image_prompts[i]}
+                print(f"Late image {i + 1} arrived for story {story_uuid}")
+                if 'story' in saved_ids:
+                    await update_saved_story({i})
+                elif 'saving' in saved_ids:
+                    late_while_saving.add(i)
                 else:
-                    story_data['images'] = [{'prompt': p, 'url': None} for p in image_prompts]
-                    yield progress_update('Skipping image generation', 70, 100)
-                
-                save_progress(4, {'story_data': story_data, 'image_prompts': image_prompts})
-                step = 4
-            elif step == 4:
-                yield progress_update('Generating audio files...', 75, 100)
-                audio_files = story_data.get('audio_files', [])
-                texts_to_voice = [story_data['title']] + story_data['paragraphs']
-                num_texts = len(texts_to_voice)
-                start_index = len(audio_files)
-                for i, text in enumerate(texts_to_voice[start_index:], start=start_index):
-                    progress = 75 + int(20 * (i + 1) / num_texts)
-                    yield progress_update(f'Waiting for audio slot {i + 1} of {num_texts}...', progress, 100)
-                    async with semaphore:
-                        yield progress_update(f'Generating audio {i + 1} of {num_texts}...', progress, 100)
-                        audio_task = asyncio.create_task(generate_voice(text))
-                        while not audio_task.done():
-                            try:
-                                await asyncio.wait_for(asyncio.shield(audio_task), timeout=15)
-                            except asyncio.TimeoutError:
-                                yield progress_update(f'Generated audio {i + 1} of {num_texts}... (ping)', progress, 100)
-                        audio_url = await audio_task
-
-                    audio_files.append(audio_url)
-                    story_data['audio_files'] = audio_files
-                    await asyncio.sleep(1)
-                    save_progress(4, {'story_data': story_data, 'image_prompts': image_prompts})
-                    yield progress_update(f'Generated audio {i + 1} of {num_texts}', progress, 100, {'audio_file': audio_url, 'index': i})
-
-                save_progress(5, {'story_data': story_data, 'image_prompts': image_prompts})
-                step = 5
-            elif step == 5:
-                story_data['email'] = email
-                story_data['story_uuid'] = story_uuid
-                story_data['public'] = public
-                add_response = shov_add('stories', story_data)
-                if not add_response.get('success'):
-                    error_details = add_response.get('details', 'No details provided.')
-                    print(f"CRITICAL: Failed to save story to history. Error: {add_response.get('error')}. Details: {error_details}")
-                
-                if shov_id:
-                    shov_remove('stream_progress', shov_id)
-                yield progress_update('Finished!', 100, 100, story_data)
-                step = 6
+                    checkpoint.set(['story_data', 'images', i], story_data['images'][i])
+            return store
+
+        async def images_stage(report):
+            if image_mode != 'generate':
+                story_data['images'] = [{'prompt': p, 'url': None} for p in image_prompts]
+                checkpoint.set(['story_data', 'images'], story_data['images'])
+                report('Skipping image generation', 1)
+                return
+
+            num_prompts = len(image_prompts)
+            image_data = _pad_slots(story_data.get('images', []), num_prompts)
+            story_data['images'] = image_data
+            pending = [i for i, slot in enumerate(image_data) if slot is None]
+            completed = num_prompts - len(pending)
+            report('Generating images...', completed / max(num_prompts, 1))
+            async for i, image_url in _fan_out(pending, lambda i: generate_image(image_prompts[i], on_late_result=store_late_image(i)), IMAGE_CONCURRENCY):
+                image_data[i] = {'url': image_url, 'prompt': image_prompts[i]}
+                checkpoint.set(['story_data', 'images', i], image_data[i])
+                completed += 1
+                report(f'Generated image {i + 1} ({completed} of {num_prompts})', completed / num_prompts, story_data)
+
+        async def audio_stage(report):
+            texts_to_voice = [story_data['title']] + story_data['paragraphs']
+            num_texts = len(texts_to_voice)
+            audio_files = _pad_slots(story_data.get('audio_files', []), num_texts)
+            story_data['audio_files'] = audio_files
+            pending = [i for i, url in enumerate(audio_files) if url is None]
+            completed = num_texts - len(pending)
+            report('Generating audio files...', completed / num_texts)
+            async for i, audio_url in _fan_out(pending, lambda i: generate_voice(texts_to_voice[i]), AUDIO_CONCURRENCY):
+                audio_files[i] = audio_url
+                checkpoint.set(['story_data', 'audio_files', i], audio_url)
+                completed += 1
+                report(f'Generated audio {i + 1} ({completed} of {num_texts})', completed / num_texts, {'audio_file': audio_url, 'index': i})
+
+        async def save_stage(report):
+            story_data['email'] = email
+            story_data['story_uuid'] = story_uuid
+            story_data['public'] = public
+            story_data['created_at'] = datetime.now(timezone.utc).isoformat()
+            saved_ids['saving'] = True
+            add_response = await shov_add('stories', story_data)
+            if not add_response.get('success'):
+                error_details = add_response.get('details', 'No details provided.')
+                print(f"CRITICAL: Failed to save story to history. Error: {add_response.get('error')}. Details: {error_details}")
+            elif add_response.get('id'):
+                summary_response = await shov_add(SUMMARY_COLLECTION, summary_record(add_response['id'], story_data))
+                saved_ids['summary'] = summary_response.get('id')
+                saved_ids['story'] = add_response['id']
+                if late_while_saving:
+                    await update_saved_story(late_while_saving)
+                if PDF_CACHE_WARM:
+                    asyncio.get_running_loop().run_in_executor(None, pdf_cache.warm, dict(story_data))
+
+            await checkpoint.discard()
+            report('Finished!', 1, story_data)
+
+        async def on_stage_done(name):
+            completed_stages.add(name)
+            if name != 'save':
+                checkpoint.set(['completed_stages'], sorted(completed_stages))
+                checkpoint.flush_soon()
+
+        pipeline = StagePipeline([
+            Stage('content', content_stage, weight=10),
+            Stage('visual_plan', visual_plan_stage, ['content'], weight=25),
+            Stage('images', images_stage, ['visual_plan'], weight=30),
+            Stage('audio', audio_stage, ['content'], weight=30),
+            Stage('save', save_stage, ['images', 'audio'], weight=5),
+        ])
+
+        if completed_stages:
+            resumed_progress = pipeline.progress({name: 1.0 for name in completed_stages})
+            yield progress_update("Resuming generation...", resumed_progress, 100, story_data)
+
+        last_task, last_progress = 'Creating story content...', 0
+        async for event in pipeline.run(completed_stages, on_stage_done, ping_interval=PING_INTERVAL):
+            if event is None:
+                yield progress_update(f'{last_task} (ping)', last_progress, 100)
+                continue
+            last_task, last_progress, data = event
+            yield progress_update(last_task, last_progress, 100, data)
         
+    except asyncio.CancelledError:
+        # Cancelled by its owner: nothing is saved and there is nothing to resume
+        await checkpoint.discard()
+        raise
     except Exception as e:
         print(f"Error in generate_story_for_stream: {str(e)}")
         print(f"Stack trace: {traceback.format_exc()}")
         yield progress_update('Error', 100, 100, {"error": str(e)})
+    finally:
+        for task in prefetch_tasks:
+            task.cancel()
+
+def _stream_owner():
+    """Who a story's stream belongs to. Only the session that started a story may attach to it or cancel it."""
+    return session.get('email') or session.setdefault('stream_owner', str(uuid.uuid4()))
 
 @stream_bp.route('/generate_story_stream', methods=['GET'])
 def generate_story_stream():
@@ -202,19 +270,18 @@ def generate_story_stream():
         email = session.get('email')
         story_uuid = request.args.get('story_uuid')
 
+        owner = _stream_owner()
+
+        job_key = story_uuid or str(uuid.uuid4())
+        job = engine.submit(job_key, lambda: generate_story_for_stream(prompt, image_mode, min_paragraphs, max_paragraphs, email, public, story_uuid), owner=owner)
+
         def generate():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                gen = generate_story_for_stream(prompt, image_mode, min_paragraphs, max_paragraphs, email, public, story_uuid)
-                while True:
-                    try:
-                        progress = loop.run_until_complete(gen.__anext__())
-                        yield f"data: {json.dumps(progress)}\n\n"
-                    except StopAsyncIteration:
-                        break
-            finally:
-                loop.close()
+            for payload in job.subscribe(owner=owner, keepalive=PING_INTERVAL):
+                if payload is None:
+                    # SSE comment line: ignored by the browser, but fails fast if the client has gone away
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {payload}\n\n"
 
         return Response(generate(), mimetype='text/event-stream')
 
@@ -232,3 +299,15 @@ def generate_story_stream():
             yield f"data: {json.dumps(error_payload)}\n\n"
 
         return Response(error_generate(e), mimetype='text/event-stream')
+
+@stream_bp.route('/cancel_story_stream', methods=['POST'])
+def cancel_story_stream():
+    """Stop generating a story and discard its checkpoint, so it is neither finished nor saved."""
+    story_uuid = (request.get_json(silent=True) or {}).get('story_uuid')
+    if not story_uuid:
+        return jsonify({"success": False, "error": "A story_uuid is required."}), 400
+    try:
+        cancelled = engine.cancel(story_uuid, owner=_stream_owner())
+    except JobAccessDenied as e:
+        return jsonify({"success": False, "error": str(e)}), 403
+    return jsonify({"success": True, "cancelled": cancelled})
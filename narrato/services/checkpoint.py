@@ -0,0 +1,177 @@
+import asyncio
+import os
+import weakref
+
+from .shov_async import shov_where, shov_add, shov_remove
+from .checkpoint_store import local_store
+from .engine import engine
+
+CHECKPOINT_COLLECTION = 'stream_progress'
+# Changes made within this many seconds of each other are sent to Shov as one record
+CHECKPOINT_FLUSH_SECONDS = float(os.getenv('CHECKPOINT_FLUSH_SECONDS', 2))
+# Longest wait between attempts to copy local checkpoints to Shov while it is failing
+CHECKPOINT_MAX_RETRY_SECONDS = 60
+
+def apply_ops(state, ops):
+    """Apply [path, value] set-operations to a nested dict/list state, growing lists with None."""
+    for path, value in ops:
+        target = state
+        for key, next_key in zip(path, path[1:]):
+            empty = [] if isinstance(next_key, int) else {}
+            if isinstance(target, list):
+                target.extend([None] * (key + 1 - len(target)))
+                if target[key] is None:
+                    target[key] = empty
+            elif target.get(key) is None:
+                target[key] = empty
+            target = target[key]
+        last = path[-1]
+        if isinstance(target, list):
+            target.extend([None] * (last + 1 - len(target)))
+        target[last] = value
+    return state
+
+def coalesce_ops(ops):
+    """Drop every operation that a later one on the same path overwrites."""
+    latest = {}
+    for path, value in ops:
+        key = tuple(path)
+        # Re-insert so the dict keeps the order of each path's latest write
+        latest.pop(key, None)
+        latest[key] = value
+    return [[list(path), value] for path, value in latest.items()]
+
+class StoryCheckpoint:
+    """Delta checkpoints of one story's generation state.
+
+    Instead of re-uploading the whole state, callers record individual changes with
+    `set(path, value)`, e.g. `set(['story_data', 'images', 7], {...})`. Each change is
+    committed straight away to the local store (services.checkpoint_store). Changes are
+    copied to Shov in the background, coalesced over CHECKPOINT_FLUSH_SECONDS into one small
+    record `{'story_uuid', 'seq', 'ops'}`, and retried with backoff while Shov fails.
+
+    `load()` rebuilds the state from the local store. It falls back to replaying the Shov
+    records in `seq` order. A Shov record without `ops` is a full state document written by
+    older versions and is used as the starting point.
+    """
+    def __init__(self, story_uuid, flush_window=CHECKPOINT_FLUSH_SECONDS):
+        self.story_uuid = story_uuid
+        self.flush_window = flush_window
+        self.source = None
+        self._seq = 0
+        self._failures = 0
+        self._flush_handle = None
+        self._flush_lock = asyncio.Lock()
+        self._discarded = False
+        _open_checkpoints.add(self)
+
+    async def load(self, attempts=3):
+        """Rebuild the saved state for this story, or return {} if nothing was saved."""
+        rows = local_store.load(self.story_uuid)
+        if rows:
+            state = {}
+            for seq, ops in rows:
+                apply_ops(state, ops)
+            self._seq = rows[-1][0]
+            self.source = 'local'
+            if local_store.unreplicated(self.story_uuid):
+                self._schedule_flush(0)
+            return state
+
+        state = await self._load_remote(attempts)
+        if state:
+            # Seed the local store so later changes and resumes work from it
+            self._seq += 1
+            local_store.append(self.story_uuid, self._seq, [[[key], value] for key, value in state.items()], replicated=True)
+            self.source = 'shov'
+        return state
+
+    async def _load_remote(self, attempts):
+        response = None
+        for _ in range(attempts):
+            response = await shov_where(CHECKPOINT_COLLECTION, {'story_uuid': self.story_uuid})
+            if response and response.get('items'):
+                break
+            await asyncio.sleep(0.5)
+        items = (response or {}).get('items') or []
+
+        state = {}
+        for item in sorted(items, key=lambda item: (item['value'].get('seq') is not None, item['value'].get('seq') or 0)):
+            value = item['value']
+            if 'ops' in value:
+                apply_ops(state, value['ops'])
+            else:
+                state = {key: val for key, val in value.items() if key != 'story_uuid'}
+            self._seq = max(self._seq, value.get('seq') or 0)
+        local_store.add_remote_records(self.story_uuid, [item['id'] for item in items])
+        return state
+
+    def set(self, path, value):
+        """Record that `path` now holds `value`."""
+        if not self.story_uuid or self._discarded:
+            return
+        self._seq += 1
+        local_store.append(self.story_uuid, self._seq, [[list(path), value]])
+        self._schedule_flush(self.flush_window)
+
+    def _schedule_flush(self, delay):
+        if self._flush_handle is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    def flush_soon(self):
+        """Copy pending changes to Shov now, without waiting for the write."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._schedule_flush(0)
+
+    async def flush(self):
+        """Copy every change not yet in Shov as a single record."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            if self._discarded or not self.story_uuid:
+                return
+            rows = local_store.unreplicated(self.story_uuid)
+            if not rows:
+                return
+            up_to_seq = rows[-1][0]
+            ops = coalesce_ops([op for _, row_ops in rows for op in row_ops])
+            record = {'story_uuid': self.story_uuid, 'seq': up_to_seq, 'ops': ops}
+            result = await shov_add(CHECKPOINT_COLLECTION, record)
+            if result.get('success') and result.get('id'):
+                local_store.mark_replicated(self.story_uuid, up_to_seq, result['id'])
+                self._failures = 0
+                print(f"Saved checkpoint #{up_to_seq} for story {self.story_uuid} ({len(ops)} changes)")
+                return
+            self._failures += 1
+            retry_in = min(self.flush_window * 2 ** self._failures, CHECKPOINT_MAX_RETRY_SECONDS)
+            print(f"WARN: Failed to copy checkpoint for story {self.story_uuid} to Shov, kept locally and retrying in {retry_in:.0f}s. Error: {result.get('details')}")
+        self._schedule_flush(retry_in)
+
+    async def discard(self):
+        """Remove every checkpoint for this story once it has been saved for good."""
+        self._discarded = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        _open_checkpoints.discard(self)
+        # Wait for a flush that is already writing, so its record is removed too
+        async with self._flush_lock:
+            pass
+        if not self.story_uuid:
+            return
+        record_ids = local_store.remote_records(self.story_uuid)
+        local_store.delete(self.story_uuid)
+        await asyncio.gather(*(shov_remove(CHECKPOINT_COLLECTION, record_id) for record_id in record_ids))
+
+_open_checkpoints = weakref.WeakSet()
+
+async def flush_all():
+    """Copy the pending changes of every open checkpoint to Shov (engine shutdown hook)."""
+    await asyncio.gather(*(checkpoint.flush() for checkpoint in list(_open_checkpoints)), return_exceptions=True)
+
+engine.add_shutdown_hook(flush_all)
@@ -0,0 +1,103 @@
+import json
+import os
+import sqlite3
+import threading
+
+from ..core import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoint_ops (
+    story_uuid TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ops TEXT NOT NULL,
+    replicated INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (story_uuid, seq)
+);
+CREATE TABLE IF NOT EXISTS checkpoint_remote_records (
+    story_uuid TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    PRIMARY KEY (story_uuid, record_id)
+);
+"""
+
+class LocalCheckpointStore:
+    """Local write-ahead log of checkpoint changes, kept in SQLite in WAL mode.
+
+    Every change is committed here first, at local-disk latency. The rows are then copied to
+    the Shov `stream_progress` collection in the background, and each row's `replicated`
+    flag records whether that has happened yet. Resuming reads this store first, so it only
+    needs Shov when the story was started on another machine.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Keep the database in the app's instance folder unless CHECKPOINT_DB_PATH is set."""
+        self.path = os.getenv('CHECKPOINT_DB_PATH') or os.path.join(app.instance_path, 'checkpoints.sqlite3')
+
+    def _connection(self):
+        if self._conn is None:
+            # Without init_app (e.g. in scripts), checkpoints only live as long as the process
+            self._conn = sqlite3.connect(self.path or ':memory:', check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode this survives process crashes; only an OS crash can lose the last commits
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def append(self, story_uuid, seq, ops, replicated=False):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO checkpoint_ops (story_uuid, seq, ops, replicated) VALUES (?, ?, ?, ?)',
+                             (story_uuid, seq, json.dumps(ops), int(replicated)))
+
+    def load(self, story_uuid):
+        """Every row for a story as (seq, ops) pairs, in seq order."""
+        with self._lock:
+            rows = self._connection().execute('SELECT seq, ops FROM checkpoint_ops WHERE story_uuid = ? ORDER BY seq', (story_uuid,)).fetchall()
+        return [(seq, json.loads(ops)) for seq, ops in rows]
+
+    def unreplicated(self, story_uuid):
+        """Rows not yet copied to Shov as (seq, ops) pairs, in seq order."""
+        with self._lock:
+            rows = self._connection().execute('SELECT seq, ops FROM checkpoint_ops WHERE story_uuid = ? AND replicated = 0 ORDER BY seq', (story_uuid,)).fetchall()
+        return [(seq, json.loads(ops)) for seq, ops in rows]
+
+    def mark_replicated(self, story_uuid, up_to_seq, record_id):
+        """Record that every row up to `up_to_seq` is now in the Shov record `record_id`."""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('UPDATE checkpoint_ops SET replicated = 1 WHERE story_uuid = ? AND seq <= ?', (story_uuid, up_to_seq))
+                conn.execute('INSERT OR IGNORE INTO checkpoint_remote_records (story_uuid, record_id) VALUES (?, ?)', (story_uuid, record_id))
+
+    def add_remote_records(self, story_uuid, record_ids):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO checkpoint_remote_records (story_uuid, record_id) VALUES (?, ?)',
+                                 [(story_uuid, record_id) for record_id in record_ids])
+
+    def remote_records(self, story_uuid):
+        with self._lock:
+            rows = self._connection().execute('SELECT record_id FROM checkpoint_remote_records WHERE story_uuid = ?', (story_uuid,)).fetchall()
+        return [record_id for (record_id,) in rows]
+
+    def delete(self, story_uuid):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM checkpoint_ops WHERE story_uuid = ?', (story_uuid,))
+                conn.execute('DELETE FROM checkpoint_remote_records WHERE story_uuid = ?', (story_uuid,))
+
+    def stats(self):
+        with self._lock:
+            stories, unreplicated = self._connection().execute(
+                'SELECT COUNT(DISTINCT story_uuid), COALESCE(SUM(1 - replicated), 0) FROM checkpoint_ops').fetchone()
+        return {"path": self.path, "stories": stories, "unreplicated_changes": unreplicated}
+
+local_store = LocalCheckpointStore()
+metrics.register('checkpoints', local_store.stats)
@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import json
+import os
+import queue
+import threading
+import traceback
+from collections import deque
+
+from ..core import metrics
+
+# How long a finished job stays subscribable, so a reconnecting client still receives its final event
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 600))
+# Events kept per job and replayed to each new subscriber
+JOB_EVENT_BUFFER = 1000
+
+class JobAccessDenied(Exception):
+    """Raised when a client tries to attach to a job started by someone else."""
+
+class StoryJob:
+    """A running generation job whose progress events can be watched by any number of subscribers.
+
+    Every event is kept (up to JOB_EVENT_BUFFER of them), so a subscriber that attaches
+    late, or reconnects, still receives everything the job published before it arrived.
+    Events are serialized to JSON when they are published, so each one shows the state at
+    that moment even though the job goes on changing the objects it refers to.
+    """
+    def __init__(self, key, owner=None):
+        self.key = key
+        self.owner = owner
+        self.finished = False
+        self.last_task = None
+        self.future = None
+        self._events = deque(maxlen=JOB_EVENT_BUFFER)
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def check_owner(self, owner):
+        if owner != self.owner:
+            raise JobAccessDenied("This story is being generated for someone else.")
+
+    def publish(self, event):
+        """Serialize an event, record it and hand it to every current subscriber."""
+        payload = json.dumps(event)
+        with self._lock:
+            self.last_task = event.get('task')
+            self._events.append(payload)
+            for subscriber in self._subscribers:
+                subscriber.put(payload)
+
+    def finish(self):
+        """Mark the job as done and release every subscriber."""
+        with self._lock:
+            self.finished = True
+            for subscriber in self._subscribers:
+                subscriber.put(None)
+
+    def subscribe(self, owner=None, keepalive=15):
+        """Yield the job's events (as JSON strings) from a plain thread, starting with every event published so far.
+
+        Yields None whenever nothing happened for `keepalive` seconds so the caller can
+        probe the connection. Ends once the job has finished. Raises JobAccessDenied unless
+        `owner` started the job.
+        """
+        self.check_owner(owner)
+        subscriber = queue.Queue()
+        with self._lock:
+            for event in self._events:
+                subscriber.put(event)
+            if self.finished:
+                subscriber.put(None)
+            self._subscribers.append(subscriber)
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield None
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            with self._lock:
+                self._subscribers.remove(subscriber)
+
+class GenerationEngine:
+    """Process-wide asyncio event loop, on a background thread, that owns story generation jobs.
+
+    Jobs are keyed (by story_uuid) so a client that reconnects attaches to the job that is
+    already running instead of starting a second one, and a client that goes away does not
+    stop the work. Only `cancel` does.
+    """
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._jobs = {}
+        self._shutdown_hooks = []
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """The engine's event loop, started on first use."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='generation-engine', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, key, make_events, owner=None):
+        """Return the live job for `key`, starting `make_events()` (an async generator) if there is none.
+
+        Raises JobAccessDenied if the live job was started by a different `owner`.
+        """
+        loop = self.loop
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                job.check_owner(owner)
+                return job
+            job = StoryJob(key, owner)
+            self._jobs[key] = job
+        job.future = asyncio.run_coroutine_threadsafe(self._drive(job, make_events), loop)
+        return job
+
+    def cancel(self, key, owner=None):
+        """Stop the live job for `key`. Returns False if there is none.
+
+        Raises JobAccessDenied if the job was started by a different `owner`.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is None or job.finished or job.future is None:
+            return False
+        job.check_owner(owner)
+        return job.future.cancel()
+
+    def run(self, coro):
+        """Schedule a coroutine on the engine loop from any thread and return its concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            "jobs_running": sum(1 for job in jobs if not job.finished),
+            "jobs_retained": sum(1 for job in jobs if job.finished),
+        }
+
+    async def _drive(self, job, make_events):
+        try:
+            async for event in make_events():
+                job.publish(event)
+        except asyncio.CancelledError:
+            print(f"Generation job {job.key} was cancelled")
+            job.publish({"task": "Cancelled", "progress": 100, "total": 100, "data": None})
+            raise
+        except Exception as e:
+            print(f"Error in generation job {job.key}: {e}")
+            print(f"Stack trace: {traceback.format_exc()}")
+            job.publish({"task": "Error", "progress": 100, "total": 100, "data": {"error": str(e)}})
+        finally:
+            job.finish()
+            if job.last_task in ('Error', 'Cancelled'):
+                # Let the client retry (or start over) straight away; a retry resumes from the last checkpoint
+                self._forget(job)
+            else:
+                asyncio.get_running_loop().call_later(JOB_RETENTION_SECONDS, self._forget, job)
+
+    def _forget(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def add_shutdown_hook(self, hook):
+        """Register a coroutine function to be awaited on the engine loop when the process exits.
+
+        Hooks run in reverse order of registration (like atexit), so a hook registered by a
+        module still runs before the hooks of the modules it imports.
+        """
+        self._shutdown_hooks.append(hook)
+
+    def shutdown(self, timeout=5):
+        """Run the shutdown hooks and stop the engine loop.
+
+        In-flight jobs resume from their checkpoints on the next request.
+        """
+        with self._lock:
+            loop = self._loop
+        if loop is None or not loop.is_running():
+            return
+        for hook in reversed(self._shutdown_hooks):
+            try:
+                asyncio.run_coroutine_threadsafe(hook(), loop).result(timeout)
+            except Exception as e:
+                print(f"Error in engine shutdown hook {getattr(hook, '__qualname__', hook)}: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+
+engine = GenerationEngine()
+metrics.register('engine', engine.stats)
+atexit.register(engine.shutdown)
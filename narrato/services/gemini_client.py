@@ -0,0 +1,104 @@
+import asyncio
+import weakref
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+
+from .engine import engine
+from ..core import metrics
+from ..core.circuit import CircuitBreaker
+
+# In order of preference when every model is equally healthy
+GEMINI_MODELS = ['gemini-2.5-flash-lite', 'gemini-2.0-flash-lite', 'gemini-2.5-flash', 'gemini-2.0-flash']
+# How long a call may wait for a model to recover when every model's circuit is open
+MODEL_MAX_WAIT_SECONDS = 60
+# How often to look again when no model is open but each is busy with a half-open probe
+MODEL_PROBE_POLL_SECONDS = 1.0
+
+class GeminiClients:
+    """Per-key Gemini models whose async calls never block the event loop.
+
+    `genai.configure()` sets one process-wide key, so concurrent stories rotating keys would
+    overwrite each other's key. Here every key gets its own `GenerativeServiceAsyncClient`,
+    and a `GenerativeModel` is cached for each (key, model) pair. gRPC async channels are
+    bound to the loop that created them, so the cache is kept per event loop.
+    """
+    def __init__(self):
+        self._clients = weakref.WeakKeyDictionary()
+        self._models = weakref.WeakKeyDictionary()
+
+    def _client(self, loop, api_key):
+        clients = self._clients.setdefault(loop, {})
+        client = clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceAsyncClient(client_options={'api_key': api_key})
+            clients[api_key] = client
+        return client
+
+    def model(self, api_key, model_name):
+        """The cached model for `api_key` and `model_name` on the running loop."""
+        loop = asyncio.get_running_loop()
+        models = self._models.setdefault(loop, {})
+        model = models.get((api_key, model_name))
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            # generate_content_async uses this client instead of the process-wide default one
+            model._async_client = self._client(loop, api_key)
+            models[(api_key, model_name)] = model
+        return model
+
+    async def generate(self, api_key, model_name, prompt, **kwargs):
+        return await self.model(api_key, model_name).generate_content_async(prompt, **kwargs)
+
+    async def stream(self, api_key, model_name, prompt, **kwargs):
+        """Yield the response text piece by piece as the model writes it."""
+        response = await self.model(api_key, model_name).generate_content_async(prompt, stream=True, **kwargs)
+        async for chunk in response:
+            if chunk.parts:
+                yield chunk.text
+
+    async def close(self):
+        """Close the channels opened on the running loop."""
+        loop = asyncio.get_running_loop()
+        self._models.pop(loop, None)
+        clients = self._clients.pop(loop, {})
+        await asyncio.gather(*(client.transport.close() for client in clients.values()), return_exceptions=True)
+
+class ModelRouter:
+    """Orders models by current health, with a circuit breaker per model.
+
+    Models whose breaker is open are skipped until it goes half-open. The rest are tried in
+    order of recent success rate, then median latency (in half-second steps, so jitter does
+    not reshuffle them), then the preference order they were given in.
+    """
+    def __init__(self, models):
+        self.models = list(models)
+        self.breakers = {model: CircuitBreaker(model) for model in self.models}
+
+    def ordered(self):
+        """The models that currently accept calls, healthiest first."""
+        available = [model for model in self.models if self.breakers[model].available()]
+
+        def health(model):
+            breaker = self.breakers[model]
+            p50 = breaker.latency.quantile(0.5) or 0
+            return (-round(breaker.success_rate, 1), round(p50 / 500), self.models.index(model))
+        return sorted(available, key=health)
+
+    def reopens_in(self):
+        """Seconds until it is worth looking for an available model again.
+
+        That is when the first open breaker lets a probe through, or MODEL_PROBE_POLL_SECONDS
+        if no breaker is open (every unavailable model is waiting on its half-open probe).
+        """
+        waits = [breaker.reopens_in for breaker in self.breakers.values() if breaker.state == CircuitBreaker.OPEN]
+        return min(waits) if waits else MODEL_PROBE_POLL_SECONDS
+
+    def stats(self):
+        return {model: breaker.stats() for model, breaker in self.breakers.items()}
+
+gemini_clients = GeminiClients()
+engine.add_shutdown_hook(gemini_clients.close)
+
+gemini_models = ModelRouter(GEMINI_MODELS)
+metrics.register('gemini_models', gemini_models.stats)
@@ -1,125 +1,368 @@
 import asyncio
 import google.generativeai as genai
 from google.api_core import exceptions
-from .key_manager import api_key_manager, speechify_api_key_manager, huggingface_api_key_manager
-import cloudinary
-import cloudinary.uploader
+from .key_manager import api_key_manager, speechify_api_key_manager, huggingface_api_key_manager, NoKeyAvailable, KEY_MAX_WAIT_SECONDS
+from .scheduler import provider_scheduler
+from .gemini_client import gemini_clients, gemini_models, MODEL_MAX_WAIT_SECONDS
+from .gradio_pool import gradio_pool
+from .media_upload import media_uploader
+from .llm_cache import llm_cache, TextResponse
+from .tts_cache import tts_cache
+from .tts_batch import SpeechBatcher, batch_ssml, segment_cut_times, TTS_BATCH_MAX_CHARS
+from ..core import metrics
+from ..core.mp3 import split_mp3
+from ..core.jsonstream import JSONStreamParser
 from speechify import AsyncSpeechify
-import tempfile
-from asgiref.sync import sync_to_async
 import re
 import traceback
 import uuid
 import base64
 import json
 import os
-from gradio_client import Client
-
-async def generate_with_fallback(prompt, safety_settings=None):
-    """Generates content using Gemini with model fallback and key rotation."""
-    models = ['gemini-2.5-flash-lite', 'gemini-2.0-flash-lite', 'gemini-2.5-flash', 'gemini-2.0-flash']
+import random
+import time
+
+# Stream the story from Gemini so paragraphs reach the reader (and narration) as they are written
+STORY_STREAMING = os.getenv('STORY_STREAMING', 'true').lower() == 'true'
+
+async def generate_with_fallback(prompt, safety_settings=None, generation_config=None):
+    """Generates content using Gemini, reusing the response to an identical earlier prompt."""
+    return await llm_cache.get_or_create(prompt, safety_settings, lambda: _generate_uncached(prompt, safety_settings, generation_config), generation_config)
+
+async def _generate_uncached(prompt, safety_settings=None, generation_config=None):
+    """Generates content using Gemini, trying the healthiest model first and rotating keys."""
+    options = {}
+    if safety_settings:
+        options['safety_settings'] = safety_settings
+    if generation_config:
+        options['generation_config'] = generation_config
     last_exception = None
     num_keys = len(api_key_manager.keys)
 
-    for model_name in models:
-        for i in range(num_keys):
-            api_key = ""
+    deadline = time.monotonic() + MODEL_MAX_WAIT_SECONDS
+    while True:
+        attempted = False
+        for model_name in gemini_models.ordered():
+            breaker = gemini_models.breakers[model_name]
+            if not breaker.try_acquire():
+                continue
+            attempted = True
+            succeeded = model_failed = False
             try:
-                api_key = await api_key_manager.get_next_key()
-                genai.configure(api_key=api_key)
-                print(f"Attempting generation with model: {model_name} using key ...{api_key[-4:]}")
-                
-                model = genai.GenerativeModel(model_name)
-                
-                if safety_settings:
-                    response = model.generate_content(prompt, safety_settings=safety_settings)
+                for i in range(num_keys):
+                    api_key = ""
+                    try:
+                        api_key = await api_key_manager.get_next_key(model_name)
+                        print(f"Attempting generation with model: {model_name} using key ...{api_key[-4:]}")
+                    
+                        async with provider_scheduler.slot('gemini'):
+                            started = time.monotonic()
+                            response = await gemini_clients.generate(api_key, model_name, prompt, **options)
+                    
+                        api_key_manager.report_success(api_key, model_name)
+                        breaker.record_success(time.monotonic() - started)
+                        succeeded = True
+                        print(f"Successfully generated content with model: {model_name}")
+                        return response
+                    except asyncio.CancelledError:
+                        # No outcome to report, but the key must not stay counted as in flight
+                        if api_key:
+                            api_key_manager.release(api_key)
+                        raise
+                    except NoKeyAvailable as e:
+                        last_exception = e
+                        model_failed = True
+                        print(f"{e}. Switching to next model.")
+                        break
+                    except exceptions.ResourceExhausted as e:
+                        api_key_manager.report_failure(api_key, model_name, e)
+                        last_exception = e
+                        key_identifier = f"...{api_key[-4:]}" if api_key else "N/A"
+                        print(f"Key {key_identifier} exhausted for model {model_name}. Switching to next key.")
+                        continue
+                    except Exception as e:
+                        if api_key:
+                            api_key_manager.report_failure(api_key, model_name, e)
+                        key_identifier = f"...{api_key[-4:]}" if api_key else "N/A"
+                        print(f"An unexpected error occurred with model {model_name} and key {key_identifier}: {e}")
+                        last_exception = e
+                        model_failed = True
+                        break
                 else:
-                    response = model.generate_content(prompt)
-                
-                print(f"Successfully generated content with model: {model_name}")
-                return response
-            except exceptions.ResourceExhausted as e:
-                last_exception = e
-                key_identifier = f"...{api_key[-4:]}" if api_key else "N/A"
-                print(f"Key {key_identifier} exhausted for model {model_name}. Switching to next key.")
-                continue
-            except Exception as e:
-                key_identifier = f"...{api_key[-4:]}" if api_key else "N/A"
-                print(f"An unexpected error occurred with model {model_name} and key {key_identifier}: {e}")
-                last_exception = e
-                break
+                    # Every key was exhausted for this model
+                    model_failed = True
+            finally:
+                if not succeeded:
+                    if model_failed:
+                        breaker.record_failure()
+                    else:
+                        # A cancelled call says nothing about the model's health
+                        breaker.release()
         
-        print(f"All keys failed for model {model_name}.")
+            print(f"All keys failed for model {model_name}.")
+
+        if attempted:
+            break
+        # Every model is open, or other calls took the half-open probes first: wait for the next one
+        wait = gemini_models.reopens_in()
+        if time.monotonic() + wait > deadline:
+            raise Exception(f"All Gemini models are failing; the next probe is in {wait:.0f}s.")
+        print(f"All Gemini models are failing. Waiting {wait:.0f}s for one to accept a probe.")
+        await asyncio.sleep(wait)
 
     if last_exception:
         raise last_exception
     raise Exception("Failed to generate content with all available models and keys.")
 
-async def generate_image(prompt):
-    """Generate image from prompt using Gradio Client with key rotation and retry."""
-    if not prompt:
-        print("--- Image Generation: Skipped due to empty prompt. ---")
-        return None
-
-    max_cycles = 3  # Try the full list of keys 3 times
+async def generate_streaming_with_fallback(prompt, on_text):
+    """Like generate_with_fallback, but passes each piece of text to on_text(piece) as Gemini writes it.
 
-    for cycle in range(max_cycles):
-        num_keys = len(huggingface_api_key_manager.keys)
-        if num_keys == 0:
-            print("--- FATAL: No Hugging Face API keys found. Cannot generate image. ---")
-            return None
+    If the stream fails, the prompt is retried without streaming on any model and key, so the
+    text already passed to on_text may not match the response that is returned.
+    """
+    async def create():
+        try:
+            return await _stream_uncached(prompt, on_text)
+        except Exception as e:
+            print(f"--- Gemini Stream --- WARN: Streaming failed ({e}). Retrying without streaming.")
+            return await _generate_uncached(prompt)
+    return await llm_cache.get_or_create(prompt, None, create)
+
+async def _stream_uncached(prompt, on_text):
+    """Streams one Gemini call on the healthiest model that accepts it."""
+    for model_name in gemini_models.ordered():
+        breaker = gemini_models.breakers[model_name]
+        if breaker.try_acquire():
+            break
+    else:
+        raise Exception("No Gemini model is accepting calls right now.")
 
-        for i in range(num_keys):
-            current_key = ""
+    api_key = ""
+    succeeded = model_failed = False
+    try:
+        api_key = await api_key_manager.get_next_key(model_name)
+        print(f"Streaming generation with model: {model_name} using key ...{api_key[-4:]}")
+        parts = []
+        async with provider_scheduler.slot('gemini'):
+            started = time.monotonic()
+            async for text in gemini_clients.stream(api_key, model_name, prompt):
+                parts.append(text)
+                on_text(text)
+        api_key_manager.report_success(api_key, model_name)
+        breaker.record_success(time.monotonic() - started)
+        succeeded = True
+        return TextResponse(''.join(parts))
+    except NoKeyAvailable:
+        raise
+    except Exception as e:
+        if api_key:
+            api_key_manager.report_failure(api_key, model_name, e)
+        model_failed = True
+        raise
+    finally:
+        if not succeeded:
+            if model_failed:
+                breaker.record_failure()
+            else:
+                # Cancelled, or no key: says nothing about the model's health
+                breaker.release()
+                if api_key:
+                    api_key_manager.release(api_key)
+
+# How long a story waits for one image before moving on without it
+IMAGE_DEADLINE_SECONDS = float(os.getenv('IMAGE_DEADLINE_SECONDS', 150))
+# How long a late image keeps being retried in the background after that
+IMAGE_BACKGROUND_DEADLINE_SECONDS = float(os.getenv('IMAGE_BACKGROUND_DEADLINE_SECONDS', 900))
+IMAGE_BACKOFF_SECONDS = 2
+IMAGE_MAX_BACKOFF_SECONDS = 30
+# Hedging needs enough observed predictions for the p90 latency to mean something
+IMAGE_HEDGE_MIN_SAMPLES = 10
+
+# Keeps background image retries alive until they finish
+_late_image_tasks = set()
+
+class _ImageAttempt:
+    """One image request on one key: predict on Gradio, then upload to Cloudinary."""
+    def __init__(self, prompt, key):
+        self.key = key
+        self.started_at = None
+        self.predicted = False
+        self.key_settled = False
+        self.task = asyncio.create_task(self._run(prompt))
+        self.task.add_done_callback(self._release_if_cancelled)
+
+    def _release_if_cancelled(self, task):
+        # A hedge loser may be cancelled while still queued for a slot, or before it even started
+        if task.cancelled() and not self.key_settled:
+            huggingface_api_key_manager.release(self.key)
+
+    async def _run(self, prompt):
+        async with provider_scheduler.slot('hf_gradio'):
+            self.started_at = asyncio.get_running_loop().time()
             try:
-                current_key = await huggingface_api_key_manager.get_next_key()
-                print(
-                    f"=== Attempting image generation with key ending in ...{current_key[-4:]} "
-                    f"(Attempt {i+1}/{num_keys}, Cycle {cycle+1}/{max_cycles}) ==="
+                result = await gradio_pool.predict(
+                    self.key,
+                    prompt=prompt,
+                    negative_prompt="",
+                    seed=0,
+                    randomize_seed=True,
+                    width=1024,
+                    height=1024,
+                    guidance_scale=0,
+                    num_inference_steps=4,
+                    api_name="/infer"
                 )
-                print(f"Input prompt: {prompt}")
-
-                def predict_sync():
-                    client = Client("stabilityai/stable-diffusion-3.5-large-turbo", hf_token=current_key)
-                    result = client.predict(
-                        prompt=prompt,
-                        negative_prompt="",
-                        seed=0,
-                        randomize_seed=True,
-                        width=1024,
-                        height=1024,
-                        guidance_scale=0,
-                        num_inference_steps=4,
-                        api_name="/infer"
-                    )
-                    if result and isinstance(result, (list, tuple)) and isinstance(result[0], str):
-                        return result[0]
-                    print(f"--- UNEXPECTED GRADIO CLIENT RAW RESULT ---: {result}")
-                    raise Exception("Invalid or unexpected response format from Gradio client")
-
-                local_image_path = await sync_to_async(predict_sync)()
-
-                if local_image_path:
-                    upload_result = await sync_to_async(cloudinary.uploader.upload)(local_image_path)
-                    cloudinary_url = upload_result.get("secure_url")
-                    print(f"Image uploaded to Cloudinary: {cloudinary_url}")
-                    try:
-                        os.remove(local_image_path)
-                    except OSError as e:
-                        print(f"Error removing temporary file {local_image_path}: {e}")
-                    return cloudinary_url
             except Exception as e:
-                key_identifier = f"...{current_key[-4:]}" if current_key else "N/A"
-                print(f"--- Key {key_identifier} failed. Error: {e} ---")
-                if i == num_keys - 1:
-                    print(f"--- All {num_keys} keys failed in cycle {cycle+1}. ---")
+                self.key_settled = True
+                huggingface_api_key_manager.report_failure(self.key, exc=e)
+                raise
+        self.key_settled = True
+        huggingface_api_key_manager.report_success(self.key)
+        self.predicted = True
+
+        if not (result and isinstance(result, (list, tuple)) and isinstance(result[0], str)):
+            print(f"--- UNEXPECTED GRADIO CLIENT RAW RESULT ---: {result}")
+            raise Exception("Invalid or unexpected response format from Gradio client")
+        local_image_path = result[0]
+
+        # Gradio always downloads the result to disk; read it once and upload from memory
+        with open(local_image_path, 'rb') as f:
+            image_bytes = f.read()
+        try:
+            os.remove(local_image_path)
+        except OSError as e:
+            print(f"Error removing temporary file {local_image_path}: {e}")
+        upload_result = await media_uploader.upload_image(image_bytes)
+        cloudinary_url = upload_result.get("secure_url")
+        print(f"Image uploaded to Cloudinary: {cloudinary_url}")
+        return cloudinary_url
+
+def _hedge_after():
+    """Seconds after which a running prediction is slower than 90% of recent ones, if known."""
+    if len(gradio_pool.latency) < IMAGE_HEDGE_MIN_SAMPLES:
+        return None
+    return gradio_pool.latency.quantile(0.9) / 1000
+
+async def _race_for_image(prompt, deadline, running=()):
+    """Keep requesting an image until one succeeds or the loop clock passes `deadline`.
+
+    Failed rounds back off exponentially with jitter. Keys that are cooling down are skipped
+    by the key manager. A prediction that runs past the observed p90 latency is hedged
+    with a second request on another key, and the first result wins. Returns (url, attempts
+    still running). On a missed deadline the url is None, and the running attempts are left
+    for the caller to adopt or cancel.
+    """
+    loop = asyncio.get_running_loop()
+    running = list(running)
+    hedged = bool(running)
+    failures = 0
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None, running
+
+            if not running:
+                if failures:
+                    backoff = min(IMAGE_MAX_BACKOFF_SECONDS, IMAGE_BACKOFF_SECONDS * 2 ** (failures - 1)) * random.uniform(0.5, 1.5)
+                    print(f"--- Image Generation: All attempts failed, retrying in {backoff:.1f}s ---")
+                    await asyncio.sleep(min(backoff, remaining))
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        return None, running
+                try:
+                    key = await huggingface_api_key_manager.get_next_key(max_wait=min(remaining, KEY_MAX_WAIT_SECONDS))
+                except NoKeyAvailable as e:
+                    print(f"--- Image Generation: {e} ---")
+                    await asyncio.sleep(min(e.retry_after, remaining))
+                    continue
+                print(f"=== Attempting image generation with key ending in ...{key[-4:]} ({remaining:.0f}s left) ===")
+                print(f"Input prompt: {prompt}")
+                running = [_ImageAttempt(prompt, key)]
+                hedged = False
+
+            timeout = remaining
+            hedge_after = None if hedged else _hedge_after()
+            primary = running[0]
+            if hedge_after is not None and not primary.predicted:
+                # Until the prediction has a provider slot, check back every second
+                hedge_at = primary.started_at + hedge_after if primary.started_at is not None else loop.time() + 1
+                timeout = max(0, min(timeout, hedge_at - loop.time()))
+
+            done, _ = await asyncio.wait([attempt.task for attempt in running], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in [attempt for attempt in running if attempt.task in done]:
+                running.remove(attempt)
+                try:
+                    url = attempt.task.result()
+                except Exception as e:
+                    print(f"--- Key ...{attempt.key[-4:]} failed. Error: {e} ---")
+                    continue
+                if url:
+                    return url, running
+            if done:
+                if not running:
+                    failures += 1
                 continue
 
-        if cycle < max_cycles - 1:
-            print("--- Waiting for 60 seconds before retrying all keys... ---")
-            await asyncio.sleep(60)
+            slow = (hedge_after is not None and not primary.predicted and primary.started_at is not None
+                    and loop.time() - primary.started_at >= hedge_after)
+            if slow:
+                hedged = True
+                try:
+                    hedge_key = await huggingface_api_key_manager.get_next_key(max_wait=0)
+                except NoKeyAvailable:
+                    continue
+                if hedge_key == primary.key:
+                    huggingface_api_key_manager.release(hedge_key)
+                    continue
+                print(f"--- Image Generation: Key ...{primary.key[-4:]} is slower than p90 ({hedge_after:.1f}s), hedging on ...{hedge_key[-4:]} ---")
+                running.append(_ImageAttempt(prompt, hedge_key))
+    except asyncio.CancelledError:
+        # The story was cancelled: stop our requests too
+        _cancel_attempts(running)
+        raise
+
+def _cancel_attempts(attempts):
+    for attempt in attempts:
+        attempt.task.cancel()
+
+async def _finish_late_image(prompt, running, on_late_result):
+    loop = asyncio.get_running_loop()
+    url, leftover = await _race_for_image(prompt, loop.time() + IMAGE_BACKGROUND_DEADLINE_SECONDS, running)
+    _cancel_attempts(leftover)
+    if not url:
+        print("--- Background image retry failed. Giving up on this image. ---")
+        return
+    try:
+        await on_late_result(url)
+    except Exception as e:
+        print(f"--- Could not store late image {url}: {e} ---")
+
+async def generate_image(prompt, on_late_result=None, deadline_seconds=IMAGE_DEADLINE_SECONDS):
+    """Generate image from prompt using Gradio Client, giving up after `deadline_seconds`.
+
+    If the deadline passes and `on_late_result` is given, the image keeps being retried in the
+    background (reusing any request still in flight) and `await on_late_result(url)` is called
+    if it eventually succeeds.
+    """
+    if not prompt:
+        print("--- Image Generation: Skipped due to empty prompt. ---")
+        return None
+
+    loop = asyncio.get_running_loop()
+    url, running = await _race_for_image(prompt, loop.time() + deadline_seconds)
+    if url:
+        _cancel_attempts(running)
+        return url
 
-    print("--- All retry cycles failed. Could not generate image. ---")
+    if on_late_result is None:
+        _cancel_attempts(running)
+        print("--- Image deadline missed. Could not generate image. ---")
+        return None
+    print(f"--- Image deadline of {deadline_seconds:.0f}s missed. Continuing in the background. ---")
+    task = asyncio.create_task(_finish_late_image(prompt, running, on_late_result))
+    _late_image_tasks.add(task)
+    task.add_done_callback(_late_image_tasks.discard)
     return None
 
 def find_character(name, char_db):
@@ -135,35 +378,87 @@ def find_character(name, char_db):
             return group, 'group'
     return None, None
 
+TTS_VOICE_ID = "oliver"
+TTS_EMOTION = "assertive"
+TTS_FORMAT = "mp3"
+
 async def generate_voice(text):
+    """Generate voice from text, reusing the clip of any identical text narrated before"""
+    if TTS_BATCH_MAX_CHARS:
+        create = lambda: voice_batcher.request(text)
+    else:
+        create = lambda: _synthesize_voice(text)
+    return await tts_cache.get_or_create(text, TTS_VOICE_ID, TTS_EMOTION, TTS_FORMAT, create)
+
+async def _speechify_tts(ssml_input):
+    """Run one Speechify request on the healthiest key and return its response"""
+    speechify_key = await speechify_api_key_manager.get_next_key()
+    speechify_client = AsyncSpeechify(token=speechify_key)
+    try:
+        async with provider_scheduler.slot('speechify'):
+            response = await speechify_client.tts.audio.speech(
+                input=ssml_input,
+                voice_id=TTS_VOICE_ID,
+                audio_format=TTS_FORMAT
+            )
+    except asyncio.CancelledError:
+        # Cancelled while queued for a slot or mid-request: no outcome, but give the key back
+        speechify_api_key_manager.release(speechify_key)
+        raise
+    except Exception as e:
+        speechify_api_key_manager.report_failure(speechify_key, exc=e)
+        raise
+    speechify_api_key_manager.report_success(speechify_key)
+    return response
+
+async def _upload_voice(audio_bytes):
+    upload_result = await media_uploader.upload_audio(
+        audio_bytes,
+        folder="storybook_audio",
+        public_id=f"{uuid.uuid4()}"
+    )
+    cloudinary_url = upload_result.get('secure_url')
+    print(f"Audio uploaded to Cloudinary: {cloudinary_url}")
+    return cloudinary_url
+
+async def _synthesize_voice(text):
     """Generate voice from text using Speechify and upload to Cloudinary"""
     try:
-        speechify_key = await speechify_api_key_manager.get_next_key()
-        speechify_client = AsyncSpeechify(token=speechify_key)
-        ssml_input = f'<speak><speechify:style emotion="assertive">{text}</speechify:style></speak>'
-        response = await speechify_client.tts.audio.speech(
-            input=ssml_input,
-            voice_id="oliver",
-            audio_format="mp3"
-        )
-        audio_bytes = base64.b64decode(response.audio_data)
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio_file:
-            temp_audio_file.write(audio_bytes)
-            temp_audio_path = temp_audio_file.name
-        upload_result = await sync_to_async(cloudinary.uploader.upload)(
-            temp_audio_path,
-            resource_type="video",
-            folder="storybook_audio",
-            public_id=f"{uuid.uuid4()}"
-        )
-        os.remove(temp_audio_path)
-        cloudinary_url = upload_result.get('secure_url')
-        print(f"Audio uploaded to Cloudinary: {cloudinary_url}")
-        return cloudinary_url
+        # The same escaped SSML as a batch of one, so text with & or < is narrated rather than rejected
+        response = await _speechify_tts(batch_ssml([text], TTS_EMOTION))
+        return await _upload_voice(base64.b64decode(response.audio_data))
     except Exception as e:
         print(f"Error creating voice: {str(e)}")
         return None
 
+async def _synthesize_voice_batch(texts):
+    """Narrate several texts in one Speechify request and upload one clip per text.
+
+    The audio is cut where the speech marks say one text ends and the next begins. If that
+    fails, every text is narrated on its own instead.
+    """
+    if len(texts) == 1:
+        return [await _synthesize_voice(texts[0])]
+    try:
+        response = await _speechify_tts(batch_ssml(texts, TTS_EMOTION))
+        audio_bytes = base64.b64decode(response.audio_data)
+        clips = split_mp3(audio_bytes, segment_cut_times(response.speech_marks, texts))
+    except Exception as e:
+        print(f"--- Voice Batch --- WARN: Could not narrate {len(texts)} texts together ({e}). Narrating them one by one.")
+        return await asyncio.gather(*(_synthesize_voice(text) for text in texts))
+
+    async def upload(clip):
+        try:
+            return await _upload_voice(clip)
+        except Exception as e:
+            print(f"Error uploading voice: {str(e)}")
+            return None
+    print(f"Narrated {len(texts)} texts in one Speechify request")
+    return await asyncio.gather(*(upload(clip) for clip in clips))
+
+voice_batcher = SpeechBatcher(_synthesize_voice_batch)
+metrics.register('tts_batch', voice_batcher.stats)
+
 def check_paragraph_length(paragraph):
     """Check and adjust paragraph length to not exceed 30 words"""
     words = paragraph.split()
@@ -184,8 +479,53 @@ def check_paragraph_length(paragraph):
         return new_paragraphs
     return [paragraph]
 
-async def generate_story_content(prompt, min_paragraphs, max_paragraphs):
-    """Generate story content using Gemini"""
+class _StoryStreamReader:
+    """Reports the title and paragraphs of a story while its JSON is still streaming in.
+
+    Paragraphs are split and capped the way generate_story_content does it, so the indices
+    passed to on_paragraph match the final story.
+    """
+    def __init__(self, max_paragraphs, on_title, on_paragraph):
+        self.max_paragraphs = max_paragraphs
+        self.on_title = on_title
+        self.on_paragraph = on_paragraph
+        self.title = None
+        self.paragraphs = []
+        self._parser = JSONStreamParser()
+
+    def _add_title(self, title):
+        self.title = title
+        if self.on_title:
+            self.on_title(title)
+
+    def _add_paragraph(self, paragraph):
+        self.paragraphs.append(paragraph)
+        self.on_paragraph(len(self.paragraphs) - 1, paragraph)
+
+    def feed(self, text):
+        for path, value in self._parser.feed(text):
+            if not isinstance(value, str):
+                continue
+            if path == ('title',) and self.title is None:
+                self._add_title(value)
+            elif len(path) == 2 and path[0] == 'paragraphs':
+                for paragraph in check_paragraph_length(value):
+                    if len(self.paragraphs) < self.max_paragraphs:
+                        self._add_paragraph(paragraph)
+
+    def finish(self, story_data):
+        """Report what the stream did not, e.g. padding paragraphs or a response served from the cache."""
+        if self.title is None:
+            self._add_title(story_data['title'])
+        for paragraph in story_data['paragraphs'][len(self.paragraphs):]:
+            self._add_paragraph(paragraph)
+
+async def generate_story_content(prompt, min_paragraphs, max_paragraphs, on_title=None, on_paragraph=None):
+    """Generate story content using Gemini.
+
+    With `on_paragraph(index, text)` (and optionally `on_title(title)`), the response is
+    streamed and each paragraph is reported as soon as Gemini has written it.
+    """
     if min_paragraphs == max_paragraphs:
         paragraph_instruction = f"The story MUST have EXACTLY {max_paragraphs} paragraphs."
         paragraph_range_doc = f"exactly {max_paragraphs}"
@@ -241,7 +581,12 @@ async def generate_story_content(prompt, min_paragraphs, max_paragraphs):
     try:
         print(f"=== Starting generate_story_content ===")
         print(f"Input prompt: {prompt}")
-        english_story_response = await generate_with_fallback(prompt_content)
+        reader = None
+        if on_paragraph and STORY_STREAMING:
+            reader = _StoryStreamReader(max_paragraphs, on_title, on_paragraph)
+            english_story_response = await generate_streaming_with_fallback(prompt_content, reader.feed)
+        else:
+            english_story_response = await generate_with_fallback(prompt_content)
         response_text = english_story_response.text.strip()
         response_text = re.sub(r'```(?:json)?\s*|\s*```', '', response_text)
         response_text = re.sub(r',(\s*\])', r'\1', response_text)
@@ -259,9 +604,12 @@ async def generate_story_content(prompt, min_paragraphs, max_paragraphs):
         elif num_paragraphs < min_paragraphs:
             while len(story_data['paragraphs']) < min_paragraphs:
                 story_data['paragraphs'].append("And the story continues...")
+        if reader:
+            reader.finish(story_data)
         return story_data
     except (json.JSONDecodeError, ValueError) as e:
         print(f"Error processing story: {str(e)}")
+        llm_cache.forget(prompt_content)
         return {"title": "Error Creating Story", "paragraphs": ["We encountered an error while creating your story."] * min_paragraphs, "moral": "Sometimes we need to be patient and try again."}
     except Exception as e:
         print(f"Generate story error: {str(e)}")
@@ -286,6 +634,7 @@ async def generate_style_guide(story_data):
             }}
         }}
     '''
+    style_guide_response = None
     try:
         story_start = ' '.join(story_data['paragraphs'][:5])
         prompt_content = prompt_template.format(title=story_data['title'], story_start=story_start)
@@ -300,6 +649,8 @@ async def generate_style_guide(story_data):
         return style_data
     except Exception as e:
         print(f"Error generating style guide: {e}")
+        if style_guide_response:
+            llm_cache.forget(prompt_content)
         return {"art_style": {"overall_style": "Digital art style with realistic details", "color_palette": "Rich, vibrant colors with deep contrasts", "lighting": "Dramatic lighting with strong highlights and shadows", "composition": "Dynamic, cinematic compositions", "texture": "Detailed textures with fine grain", "perspective": "Varied angles to enhance dramatic effect"}}
 
 async def analyze_story_characters(story_data):
@@ -354,6 +705,7 @@ async def analyze_story_characters(story_data):
             ]
         }}    
     '''
+    character_analysis = None
     try:
         story_text = ' '.join(story_data['paragraphs'])
         prompt_content = prompt_template.format(title=story_data['title'], story=story_text)
@@ -369,8 +721,18 @@ async def analyze_story_characters(story_data):
         return char_data
     except Exception as e:
         print(f"Could not parse character analysis: {str(e)}")
+        if character_analysis:
+            llm_cache.forget(prompt_content)
         return None
 
+# Image prompts describe scenes of the story, which may include conflict or peril
+IMAGE_PROMPT_SAFETY_SETTINGS = {
+    genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+    genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
+    genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+    genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+}
+
 async def generate_all_image_prompts(story_data):
     """Create all image prompts for the story using Gemini, with retry and fallback."""
     num_paragraphs = len(story_data['paragraphs'])
@@ -436,13 +798,7 @@ async def generate_all_image_prompts(story_data):
                 num_paragraphs=num_paragraphs
             )
             
-            safety_settings = {
-                genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-            }
-
+            safety_settings = IMAGE_PROMPT_SAFETY_SETTINGS
             image_prompts_response = await generate_with_fallback(prompt_for_gemini, safety_settings=safety_settings)
             if not image_prompts_response:
                 continue
@@ -466,8 +822,131 @@ async def generate_all_image_prompts(story_data):
             return cleaned_prompts
         except (json.JSONDecodeError, ValueError) as e:
             print(f"--- Image Prompt Generation: Attempt {attempt + 1} failed: {e} ---")
+            # Otherwise the retry would be served the same rejected response
+            llm_cache.forget(prompt_for_gemini, safety_settings)
             if attempt < 2:
                 print("--- Retrying... ---")
             continue
 
     return [None] * len(story_data['paragraphs'])
+
+def _string_list():
+    return {"type": "array", "items": {"type": "string"}}
+
+def _variations_schema():
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"trigger_keywords": _string_list(), "expression_override": {"type": "string"}},
+            "required": ["trigger_keywords", "expression_override"],
+        },
+    }
+
+def _character_schema():
+    return {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "role": {"type": "string"},
+            "base_description": {"type": "string"},
+            "variations": _variations_schema(),
+            "relationships": _string_list(),
+            "development_points": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"story_point": {"type": "string"}, "appearance_change": {"type": "string"}},
+                    "required": ["story_point", "appearance_change"],
+                },
+            },
+        },
+        "required": ["name", "role", "base_description"],
+    }
+
+def visual_plan_schema(num_paragraphs):
+    """Response schema for generate_visual_plan: the shapes the three separate prompts ask for, with one image prompt per paragraph."""
+    art_style_fields = ["overall_style", "color_palette", "lighting", "composition", "texture", "perspective"]
+    return {
+        "type": "object",
+        "properties": {
+            "art_style": {
+                "type": "object",
+                "properties": {field: {"type": "string"} for field in art_style_fields},
+                "required": art_style_fields,
+            },
+            "main_characters": {"type": "array", "items": _character_schema()},
+            "supporting_characters": {"type": "array", "items": _character_schema()},
+            "groups": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"name": {"type": "string"}, "members_description": {"type": "string"}, "variations": _variations_schema()},
+                    "required": ["name", "members_description"],
+                },
+            },
+            "image_prompts": {**_string_list(), "min_items": num_paragraphs, "max_items": num_paragraphs},
+        },
+        "required": ["art_style", "main_characters", "supporting_characters", "groups", "image_prompts"],
+    }
+
+VISUAL_PLAN_ATTEMPTS = 2
+
+async def generate_visual_plan(story_data):
+    """Create the art style guide, character database and image prompts in one Gemini call.
+
+    The response is constrained to `visual_plan_schema`, so it needs no JSON repair. Returns
+    (style_guide, character_database, image_prompts), or None if no valid plan came back,
+    in which case callers fall back to generate_style_guide, analyze_story_characters and
+    generate_all_image_prompts.
+    """
+    prompt_template = '''
+    You are the art director for an illustrated story. Read the whole story, then plan its illustrations.
+
+    Title: {title}
+
+    **Story Paragraphs (one image per paragraph):**
+    {paragraphs_json}
+
+    **1. Art style (`art_style`):** One consistent art style guide for every image: overall style,
+    color palette, lighting, composition, texture and perspective.
+
+    **2. Characters (`main_characters`, `supporting_characters`, `groups`):**
+    - Identify ALL named and unnamed but important characters
+    - Give each a VERY detailed `base_description` (appearance, clothing, expressions) to use in EVERY image,
+      with exact measurements and specific colors where possible
+    - Add `variations` (trigger keywords with an expression override) and `development_points`
+      for how their appearance changes through the story
+
+    **3. Image prompts (`image_prompts`):** Exactly {num_paragraphs} prompts, one per paragraph, in order. Each prompt must:
+    - Start with the EXACT, combined character descriptions for that scene, applying any variation or development point that fits
+    - Describe the scene/action from the paragraph
+    - Adhere to the art style
+    - Be between 75-100 words
+    - Follow the format: [character descriptions], [scene/action description], [art style], [mood], [lighting]
+    '''
+    num_paragraphs = len(story_data['paragraphs'])
+    prompt_content = prompt_template.format(
+        title=story_data['title'],
+        paragraphs_json=json.dumps(story_data['paragraphs'], indent=2),
+        num_paragraphs=num_paragraphs
+    )
+    generation_config = {"response_mime_type": "application/json", "response_schema": visual_plan_schema(num_paragraphs)}
+
+    for attempt in range(VISUAL_PLAN_ATTEMPTS):
+        try:
+            response = await generate_with_fallback(prompt_content, safety_settings=IMAGE_PROMPT_SAFETY_SETTINGS, generation_config=generation_config)
+            plan = json.loads(response.text)
+            prompts = [re.sub(r'["\'\n]', '', p) for p in plan['image_prompts']]
+            if len(prompts) != num_paragraphs:
+                raise ValueError(f"Mismatch in number of prompts ({len(prompts)}) and paragraphs ({num_paragraphs}).")
+            style_guide = {"art_style": plan['art_style']}
+            character_database = {key: plan.get(key, []) for key in ('main_characters', 'supporting_characters', 'groups')}
+            return style_guide, character_database, prompts
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            print(f"--- Visual Plan: Attempt {attempt + 1} failed: {e} ---")
+            llm_cache.forget(prompt_content, IMAGE_PROMPT_SAFETY_SETTINGS, generation_config)
+        except Exception as e:
+            print(f"--- Visual Plan: Generation failed: {e} ---")
+            break
+    return None
@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gradio_client import Client
+
+from .key_manager import huggingface_api_key_manager, is_rate_limited
+from ..core import metrics
+from ..core.metrics import LatencyHistogram
+
+HF_IMAGE_SPACE = "stabilityai/stable-diffusion-3.5-large-turbo"
+# Each Gradio client can run several predictions at once; more clients per key only help with many threads
+GRADIO_CLIENTS_PER_KEY = int(os.getenv('GRADIO_CLIENTS_PER_KEY', 1))
+GRADIO_THREADS = int(os.getenv('GRADIO_THREADS', os.getenv('HF_GRADIO_CONCURRENCY', 4)))
+# Clients are rebuilt in the background after this long, before the Space's session can go stale
+GRADIO_CLIENT_MAX_AGE_SECONDS = float(os.getenv('GRADIO_CLIENT_MAX_AGE_SECONDS', 3600))
+GRADIO_HEALTH_CHECK_SECONDS = 60
+
+class _PooledClient:
+    def __init__(self, client):
+        self.client = client
+        self.built_at = time.monotonic()
+
+class GradioClientPool:
+    """Reusable Gradio clients for one Space, per Hugging Face key.
+
+    Building a `gradio_client.Client` does a handshake and downloads the Space config, so
+    clients are built once, warmed at startup and then shared by every image and story.
+    Predictions run on the pool's own thread pool. A client that fails with anything other
+    than a quota error is dropped and rebuilt. A background health check also rebuilds
+    clients that are missing or older than GRADIO_CLIENT_MAX_AGE_SECONDS, so requests rarely
+    pay for a handshake.
+    """
+    def __init__(self, space, keys, clients_per_key=GRADIO_CLIENTS_PER_KEY, threads=GRADIO_THREADS):
+        self.space = space
+        self.keys = list(keys)
+        self.clients_per_key = max(1, clients_per_key)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='gradio')
+        self._slots = {key: [None] * self.clients_per_key for key in self.keys}
+        self._next_slot = {key: 0 for key in self.keys}
+        self._slot_locks = {(key, i): threading.Lock() for key in self.keys for i in range(self.clients_per_key)}
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.build_failures = 0
+        self.rebuilds_after_error = 0
+        # Duration of successful predictions, used to decide when a slow one is worth hedging
+        self.latency = LatencyHistogram()
+
+    def _build(self, key, index):
+        """Build the client in slot `index` for `key` unless another thread already has."""
+        with self._slot_locks[(key, index)]:
+            pooled = self._slots[key][index]
+            if pooled is not None:
+                return pooled
+            try:
+                pooled = _PooledClient(Client(self.space, hf_token=key, verbose=False))
+            except Exception:
+                with self._lock:
+                    self.build_failures += 1
+                raise
+            with self._lock:
+                self._slots[key][index] = pooled
+                self.builds += 1
+            return pooled
+
+    def _checkout(self, key):
+        with self._lock:
+            index = self._next_slot[key]
+            self._next_slot[key] = (index + 1) % self.clients_per_key
+            pooled = self._slots[key][index]
+        return index, pooled or self._build(key, index)
+
+    def _discard(self, key, index, pooled):
+        with self._lock:
+            if self._slots[key][index] is pooled:
+                self._slots[key][index] = None
+
+    def _predict_sync(self, key, kwargs):
+        index, pooled = self._checkout(key)
+        started = time.monotonic()
+        try:
+            result = pooled.client.predict(**kwargs)
+            self.latency.observe(time.monotonic() - started)
+            return result
+        except Exception as e:
+            if not is_rate_limited(e):
+                print(f"--- Gradio Pool --- WARN: Dropping client for key ...{key[-4:]} after error: {e}")
+                with self._lock:
+                    self.rebuilds_after_error += 1
+                self._discard(key, index, pooled)
+                self._executor.submit(self._build_quietly, key, index)
+            raise
+
+    async def predict(self, key, **kwargs):
+        """Run `client.predict(**kwargs)` with a pooled client for `key`, on the pool's threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._predict_sync, key, kwargs))
+
+    def _build_quietly(self, key, index):
+        try:
+            self._build(key, index)
+        except Exception as e:
+            print(f"--- Gradio Pool --- WARN: Could not build client for key ...{key[-4:]}: {e}")
+
+    def _check_health(self):
+        now = time.monotonic()
+        for key in self.keys:
+            for index in range(self.clients_per_key):
+                with self._lock:
+                    pooled = self._slots[key][index]
+                if pooled is not None and now - pooled.built_at > GRADIO_CLIENT_MAX_AGE_SECONDS:
+                    self._discard(key, index, pooled)
+                    pooled = None
+                if pooled is None:
+                    self._executor.submit(self._build_quietly, key, index)
+
+    def start(self, interval=GRADIO_HEALTH_CHECK_SECONDS):
+        """Warm every client now and keep them healthy in the background."""
+        def check_forever():
+            while True:
+                try:
+                    self._check_health()
+                except Exception as e:
+                    print(f"--- Gradio Pool --- ERROR: Health check crashed: {e}")
+                time.sleep(interval)
+        threading.Thread(target=check_forever, name='gradio-pool', daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            ready = sum(pooled is not None for slots in self._slots.values() for pooled in slots)
+            return {
+                "ready_clients": ready,
+                "total_slots": len(self.keys) * self.clients_per_key,
+                "builds": self.builds,
+                "build_failures": self.build_failures,
+                "rebuilds_after_error": self.rebuilds_after_error,
+                "latency": self.latency.snapshot(),
+            }
+
+gradio_pool = GradioClientPool(HF_IMAGE_SPACE, huggingface_api_key_manager.keys)
+metrics.register('gradio_pool', gradio_pool.stats)
@@ -1,43 +1,208 @@
 import os
 import asyncio
 import re
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions
+
+from ..core import metrics
+
+# How long a caller may wait for a key to come off cooldown or refill before giving up on it
+KEY_MAX_WAIT_SECONDS = float(os.getenv('KEY_MAX_WAIT_SECONDS', 20))
+# Cooldown for a rate-limited key when the provider gives no retry-after hint; doubles on repeats
+KEY_DEFAULT_COOLDOWN_SECONDS = 30
+KEY_MAX_COOLDOWN_SECONDS = 600
+KEY_ERROR_WINDOW = 20
+
+class NoKeyAvailable(Exception):
+    """Raised when every key is cooling down or out of tokens for longer than the caller may wait."""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_rate_limited(exc):
+    """Whether a provider error means "this key is over its quota", as opposed to a bad request."""
+    if isinstance(exc, exceptions.ResourceExhausted) or getattr(exc, 'status_code', None) == 429:
+        return True
+    message = str(exc).lower()
+    return '429' in message or 'quota' in message or 'rate limit' in message
+
+_RETRY_PATTERNS = (
+    (re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)'), lambda m: int(m.group(1))),
+    (re.compile(r'retry in (\d+):(\d+):(\d+)', re.I), lambda m: int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3))),
+    (re.compile(r'retry (?:in|after) ([\d.]+)\s*s', re.I), lambda m: float(m.group(1))),
+)
+
+def retry_after_from(exc):
+    """Seconds the provider asked us to wait, if the error says so."""
+    headers = getattr(exc, 'headers', None) or getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    message = str(exc)
+    for pattern, seconds in _RETRY_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return seconds(match)
+    return None
+
+class TokenBucket:
+    """Allows `rate_per_minute` takes per minute on average, with bursts of up to `capacity`."""
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, rate_per_minute)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class _KeyHealth:
+    def __init__(self):
+        self.in_flight = 0
+        self.outcomes = deque(maxlen=KEY_ERROR_WINDOW)
+        self.cooldown_until = {}
+        self.cooldown_streak = {}
+        self.buckets = {}
+
+    @property
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
 
 class APIKeyManager:
-    """Manages and rotates API keys"""
-    def __init__(self, keys):
+    """Hands out API keys based on what we know about each one.
+
+    Every key has a token bucket per scope (e.g. per Gemini model) when `rate_per_minute` is
+    set. After a 429/quota error it gets a cooldown for that scope, honouring the provider's
+    retry-after hint. Among the keys that are usable right now, the one with the fewest calls
+    in flight and the lowest recent error rate wins, with ties broken round-robin. Callers
+    should tell the manager how each call went with `report_success` / `report_failure`.
+    """
+    def __init__(self, keys, name='keys', rate_per_minute=0):
         self.keys = [key for key in keys if key] # Filter out empty keys
         if not self.keys:
             raise ValueError("APIKeyManager initialized with no keys.")
+        self.name = name
+        self.rate_per_minute = rate_per_minute
         self.current_key_index = 0
         self.key_usage = {key: 0 for key in self.keys}
-        self._lock = asyncio.Lock()
-    
-    async def get_next_key(self):
-        """Gets the next API key in a round-robin fashion"""
-        async with self._lock:
-            self.current_key_index = (self.current_key_index + 1) % len(self.keys)
-            key = self.keys[self.current_key_index]
+        self._health = {key: _KeyHealth() for key in self.keys}
+        self._lock = threading.Lock()
+
+    def _bucket(self, health, scope):
+        bucket = health.buckets.get(scope)
+        if bucket is None:
+            bucket = health.buckets[scope] = TokenBucket(self.rate_per_minute)
+        return bucket
+
+    def _wait_time(self, key, scope, now):
+        health = self._health[key]
+        wait = max(0.0, health.cooldown_until.get(scope, 0) - now)
+        if self.rate_per_minute:
+            wait = max(wait, self._bucket(health, scope).wait_time(now))
+        return wait
+
+    def _try_acquire(self, scope):
+        """Take the best usable key, or return (None, seconds until one frees up)."""
+        with self._lock:
+            now = time.monotonic()
+            count = len(self.keys)
+            rotation = [(self.current_key_index + offset) % count for offset in range(1, count + 1)]
+            waits = {index: self._wait_time(self.keys[index], scope, now) for index in rotation}
+            usable = [index for index in rotation if waits[index] == 0]
+            if not usable:
+                return None, min(waits.values())
+            index = min(usable, key=lambda i: (self._health[self.keys[i]].in_flight, round(self._health[self.keys[i]].error_rate, 1)))
+            key = self.keys[index]
+            health = self._health[key]
+            if self.rate_per_minute:
+                self._bucket(health, scope).take(now)
+            health.in_flight += 1
             self.key_usage[key] += 1
-            return key
-    
+            self.current_key_index = index
+            return key, 0.0
+
+    async def get_next_key(self, scope=None, max_wait=KEY_MAX_WAIT_SECONDS):
+        """Gets the healthiest API key for `scope`, waiting up to `max_wait` seconds for one to free up."""
+        deadline = time.monotonic() + max_wait
+        while True:
+            key, wait = self._try_acquire(scope)
+            if key:
+                return key
+            if time.monotonic() + wait > deadline:
+                raise NoKeyAvailable(f"All {self.name} keys are rate limited for {scope or 'this provider'}; next one frees up in {wait:.0f}s", wait)
+            await asyncio.sleep(wait)
+
+    def report_success(self, key, scope=None):
+        with self._lock:
+            health = self._health.get(key)
+            if health is None:
+                return
+            health.in_flight = max(0, health.in_flight - 1)
+            health.outcomes.append(True)
+            health.cooldown_streak.pop(scope, None)
+
+    def report_failure(self, key, scope=None, exc=None):
+        """Record a failed call; a rate-limit error puts the key on cooldown for `scope`."""
+        with self._lock:
+            health = self._health.get(key)
+            if health is None:
+                return
+            health.in_flight = max(0, health.in_flight - 1)
+            health.outcomes.append(False)
+            if exc is not None and is_rate_limited(exc):
+                streak = health.cooldown_streak.get(scope, 0) + 1
+                health.cooldown_streak[scope] = streak
+                cooldown = retry_after_from(exc) or min(KEY_DEFAULT_COOLDOWN_SECONDS * 2 ** (streak - 1), KEY_MAX_COOLDOWN_SECONDS)
+                health.cooldown_until[scope] = time.monotonic() + cooldown
+                print(f"--- Key Manager --- INFO: {self.name} key ...{key[-4:]} cooling down for {cooldown:.0f}s ({scope or 'all scopes'})")
+
+    def release(self, key):
+        """Give back a key whose call was abandoned without an outcome."""
+        with self._lock:
+            health = self._health.get(key)
+            if health is not None:
+                health.in_flight = max(0, health.in_flight - 1)
+
     def get_current_key(self):
         """Gets the current API key"""
         return self.keys[self.current_key_index]
-    
-    async def get_least_used_key(self):
-        """Gets the least-used API key"""
-        async with self._lock:
-            key = min(self.key_usage.items(), key=lambda x: x[1])[0]
-            self.key_usage[key] += 1
-            return key
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                f"...{key[-4:]}": {
+                    "usage": self.key_usage[key],
+                    "in_flight": health.in_flight,
+                    "error_rate": round(health.error_rate, 2),
+                    "cooling_down": {str(scope): round(until - now) for scope, until in health.cooldown_until.items() if until > now},
+                }
+                for key, health in self._health.items()
+            }
 
 # Initialize Google API key manager
 google_keys = sorted([v for k, v in os.environ.items() if k.startswith('GOOGLE_API_KEY')])
-api_key_manager = APIKeyManager(google_keys)
+api_key_manager = APIKeyManager(google_keys, 'google', rate_per_minute=int(os.getenv('GOOGLE_KEY_RPM', 15)))
 
 # Initialize Speechify API key manager
 speechify_keys = sorted([v for k, v in os.environ.items() if k.startswith('SPEECHIFY_KEY')])
-speechify_api_key_manager = APIKeyManager(speechify_keys)
+speechify_api_key_manager = APIKeyManager(speechify_keys, 'speechify', rate_per_minute=int(os.getenv('SPEECHIFY_KEY_RPM', 0)))
 
 # Initialize Hugging Face API key manager
 keys_with_indices = []
@@ -51,4 +216,6 @@ for k, v in os.environ.items():
                 keys_with_indices.append((int(match.group(1)), v))
 keys_with_indices.sort(key=lambda x: x[0])
 huggingface_keys = [v for i, v in keys_with_indices]
-huggingface_api_key_manager = APIKeyManager(huggingface_keys)
+huggingface_api_key_manager = APIKeyManager(huggingface_keys, 'huggingface', rate_per_minute=int(os.getenv('HF_KEY_RPM', 0)))
+
+metrics.register('keys', lambda: {manager.name: manager.stats() for manager in (api_key_manager, speechify_api_key_manager, huggingface_api_key_manager)})
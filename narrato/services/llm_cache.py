@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import time
+
+from .gemini_client import GEMINI_MODELS
+from ..core import metrics
+from ..core.cache import LRUCache, DiskCache, SingleFlight
+
+# Gemini responses are reused for this long; 0 turns the cache off
+LLM_CACHE_TTL_SECONDS = float(os.getenv('LLM_CACHE_TTL_SECONDS', 86400))
+LLM_CACHE_MEMORY_ENTRIES = 512
+# Responses kept on disk across restarts; 0 keeps them in memory only
+LLM_CACHE_DISK_ENTRIES = int(os.getenv('LLM_CACHE_DISK_ENTRIES', 5000))
+# Part of every key, so changing the models we call starts a fresh cache
+LLM_MODEL_POLICY = ','.join(GEMINI_MODELS)
+
+class TextResponse:
+    """The part of a Gemini response callers use: its text."""
+    def __init__(self, text):
+        self.text = text
+
+def llm_cache_key(prompt, safety_settings=None, generation_config=None, policy=LLM_MODEL_POLICY):
+    settings = sorted((str(category), str(threshold)) for category, threshold in (safety_settings or {}).items())
+    payload = json.dumps([prompt, settings, generation_config, policy], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class LLMCache:
+    """Reuses Gemini responses for prompts that were sent before.
+
+    Responses are keyed on the prompt, the safety settings, the generation config (e.g. a
+    response schema) and the models we route between,
+    and kept in memory and (optionally) in a local SQLite file for LLM_CACHE_TTL_SECONDS.
+    Identical requests made while one is in flight share its response. Callers that reject
+    a response should `forget` it, so that retrying makes a new call.
+    """
+    def __init__(self, ttl=LLM_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._memory = LRUCache(LLM_CACHE_MEMORY_ENTRIES)
+        self._disk = DiskCache(LLM_CACHE_DISK_ENTRIES)
+        self._calls = SingleFlight()
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+
+    def init_app(self, app):
+        if LLM_CACHE_DISK_ENTRIES:
+            self._disk.open(os.getenv('LLM_CACHE_DB_PATH') or os.path.join(app.instance_path, 'llm_cache.sqlite3'))
+
+    def _lookup(self, key):
+        entry = self._memory.get(key)
+        if entry is not None and entry[1] < self.ttl:
+            self.hits['memory'] += 1
+            return entry[0]
+        stored = self._disk.get(key)
+        if stored and time.time() - stored['stored_at'] < self.ttl:
+            self.hits['disk'] += 1
+            self._memory.set(key, stored['text'])
+            return stored['text']
+        return None
+
+    async def get_or_create(self, prompt, safety_settings, create, generation_config=None):
+        """A response with `.text` for this prompt: cached, shared with an identical call in flight, or from `await create()`."""
+        if not self.ttl:
+            return await create()
+        key = llm_cache_key(prompt, safety_settings, generation_config)
+        return await self._calls.run(key, lambda: self._lookup_or_create(key, create))
+
+    async def _lookup_or_create(self, key, create):
+        text = self._lookup(key)
+        if text is not None:
+            return TextResponse(text)
+        self.misses += 1
+        response = await create()
+        text = response.text
+        self._memory.set(key, text)
+        self._disk.set(key, {'text': text, 'stored_at': time.time()})
+        return TextResponse(text)
+
+    def forget(self, prompt, safety_settings=None, generation_config=None):
+        """Drop the cached response for a prompt, e.g. because it could not be parsed."""
+        key = llm_cache_key(prompt, safety_settings, generation_config)
+        self._memory.discard(key)
+        self._disk.discard(key)
+
+    def stats(self):
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "shared_in_flight": self._calls.shared,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk),
+        }
+
+llm_cache = LLMCache()
+metrics.register('llm_cache', llm_cache.stats)
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import os
+import random
+import time
+from io import BytesIO
+
+import aiohttp
+import cloudinary
+import cloudinary.utils
+from PIL import Image
+
+from .engine import engine
+from .scheduler import provider_scheduler
+
+# Images are re-encoded before upload; webp or jpeg (progressive)
+MEDIA_IMAGE_FORMAT = os.getenv('MEDIA_IMAGE_FORMAT', 'webp').lower()
+MEDIA_IMAGE_QUALITY = int(os.getenv('MEDIA_IMAGE_QUALITY', 82))
+MEDIA_UPLOAD_TIMEOUT = float(os.getenv('MEDIA_UPLOAD_TIMEOUT', 60))
+MEDIA_UPLOAD_POOL_SIZE = int(os.getenv('CLOUDINARY_CONCURRENCY', 8))
+
+class CloudinaryUploadError(Exception):
+    """Raised when Cloudinary rejects an upload."""
+
+def encode_image(image_bytes, image_format=MEDIA_IMAGE_FORMAT, quality=MEDIA_IMAGE_QUALITY):
+    """Re-encode an image for the web. Returns (bytes, file extension)."""
+    image = Image.open(BytesIO(image_bytes))
+    out = BytesIO()
+    if image_format == 'webp':
+        image.save(out, 'WEBP', quality=quality, method=4)
+        return out.getvalue(), 'webp'
+    image.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return out.getvalue(), 'jpg'
+
+class MediaUploader:
+    """Signed Cloudinary uploads straight from memory.
+
+    Files are posted as multipart form data over one keep-alive connection pool per event
+    loop, so there is no temp-file round trip and no worker thread per upload.
+    """
+    def __init__(self, pool_size=MEDIA_UPLOAD_POOL_SIZE, timeout=MEDIA_UPLOAD_TIMEOUT, max_retries=3, backoff=0.5):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._sessions = {}
+
+    def _session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60))
+            self._sessions[loop] = session
+        return session
+
+    async def upload(self, data, filename, resource_type='image', **params):
+        """Upload `data` (bytes) and return Cloudinary's response, e.g. with `secure_url`."""
+        url = cloudinary.utils.cloudinary_api_url('upload', resource_type=resource_type)
+        for attempt in range(self.max_retries):
+            # Sign per attempt: Cloudinary rejects signatures with stale timestamps
+            signed = cloudinary.utils.sign_request({'timestamp': int(time.time()), **params}, {})
+            form = aiohttp.FormData()
+            for key, value in signed.items():
+                form.add_field(key, str(value))
+            form.add_field('file', data, filename=filename)
+            try:
+                async with provider_scheduler.slot('cloudinary'):
+                    async with self._session().post(url, data=form, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                        text = await response.text()
+                if response.status >= 500:
+                    raise CloudinaryUploadError(f"Cloudinary returned HTTP {response.status}: {text[:200]}")
+                result = json.loads(text)
+                if response.status >= 400 or 'error' in result:
+                    # Client errors (bad signature, bad file) will not succeed on retry
+                    raise ValueError(f"Cloudinary rejected the upload: {result.get('error', text[:200])}")
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError, CloudinaryUploadError) as e:
+                print(f"--- Cloudinary Upload --- WARN: Attempt {attempt + 1}/{self.max_retries} failed: {e!r}")
+                if attempt + 1 == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+    async def upload_image(self, image_bytes, **params):
+        """Re-encode an image (MEDIA_IMAGE_FORMAT / MEDIA_IMAGE_QUALITY) and upload it."""
+        encoded, extension = await asyncio.to_thread(encode_image, image_bytes)
+        print(f"Re-encoded image as {extension}: {len(image_bytes) // 1024} KB -> {len(encoded) // 1024} KB")
+        return await self.upload(encoded, f"image.{extension}", 'image', **params)
+
+    async def upload_audio(self, audio_bytes, **params):
+        """Upload an MP3 (Cloudinary files audio under the `video` resource type)."""
+        return await self.upload(audio_bytes, "audio.mp3", 'video', **params)
+
+    async def close(self):
+        """Close the connection pool owned by the running event loop."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+media_uploader = MediaUploader()
+engine.add_shutdown_hook(media_uploader.close)
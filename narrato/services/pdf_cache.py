@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+
+from flask import render_template
+
+from .pdf_render import render_pdf
+from ..core import metrics
+
+# Upper bound on the disk space used by cached PDFs; least recently used files go first
+PDF_CACHE_MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_MB', 512)) * 1024 * 1024
+# Render the PDF of every newly saved story in the background, so the first download is cached too
+PDF_CACHE_WARM = os.getenv('PDF_CACHE_WARM', 'false').lower() == 'true'
+
+class PdfCache:
+    """Content-addressed disk cache of rendered story PDFs.
+
+    A PDF is stored under a hash of the story's uuid, its full content and the PDF template,
+    so editing the story or the template simply produces a new key. Disk usage is kept
+    under PDF_CACHE_MAX_BYTES by deleting the least recently served files. The key doubles
+    as the HTTP ETag.
+    """
+    def __init__(self, max_bytes=PDF_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.app = None
+        self.directory = None
+        self.template_hash = ''
+        self.hits = 0
+        self.misses = 0
+        self._sizes = {}
+        self._key_locks = {}  # key -> [lock, number of requests using it]
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = os.getenv('PDF_CACHE_DIR') or os.path.join(app.instance_path, 'pdf_cache')
+        os.makedirs(self.directory, exist_ok=True)
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, 'pdf_template.html')
+        self.template_hash = hashlib.sha256(source.encode()).hexdigest()
+        with self._lock:
+            self._sizes = {}
+            for name in os.listdir(self.directory):
+                if name.endswith('.pdf'):
+                    self._sizes[name[:-4]] = os.path.getsize(os.path.join(self.directory, name))
+
+    def key_for(self, story):
+        content_hash = hashlib.sha256(json.dumps(story, sort_keys=True).encode()).hexdigest()
+        return hashlib.sha256(f"{story.get('story_uuid')}:{content_hash}:{self.template_hash}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key):
+        """Path of the cached PDF for `key`, or None."""
+        path = self._path(key)
+        with self._lock:
+            if key not in self._sizes:
+                return None
+        try:
+            # The modification time tracks last use, for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._sizes.pop(key, None)
+            return None
+        return path
+
+    def put(self, key, pdf_bytes):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._sizes[key] = len(pdf_bytes)
+        self._evict(keep=key)
+        return path
+
+    def _evict(self, keep=None):
+        with self._lock:
+            total = sum(self._sizes.values())
+            if total <= self.max_bytes:
+                return
+            by_last_use = []
+            for key in self._sizes:
+                try:
+                    by_last_use.append((os.path.getmtime(self._path(key)), key))
+                except FileNotFoundError:
+                    by_last_use.append((0, key))
+            for _, key in sorted(by_last_use):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                total -= self._sizes.pop(key)
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+
+    def get_or_render(self, story):
+        """Return (path, etag) of the story's PDF, rendering it only if it is not cached yet."""
+        key = self.key_for(story)
+        path = self.get(key)
+        if path:
+            with self._lock:
+                self.hits += 1
+            return path, key
+        # Concurrent requests for the same story wait for one render instead of each doing it.
+        # The lock is dropped only when no request uses it, so a late arrival cannot start a second render.
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                path = self.get(key)
+                if path is None:
+                    with self._lock:
+                        self.misses += 1
+                    path = self.put(key, render_story_pdf(story))
+                else:
+                    with self._lock:
+                        self.hits += 1
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+        return path, key
+
+    def warm(self, story):
+        """Render and cache a story's PDF ahead of its first download."""
+        try:
+            self.get_or_render(story)
+            print(f"--- PDF Cache --- INFO: Warmed PDF for story {story.get('story_uuid')}")
+        except Exception as e:
+            print(f"--- PDF Cache --- WARN: Could not warm PDF for story {story.get('story_uuid')}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "files": len(self._sizes), "bytes": sum(self._sizes.values()), "max_bytes": self.max_bytes}
+
+def render_story_pdf(story):
+    """Lay out a story as a PDF in the render pool and return the bytes."""
+    # A request context lets the template use url_for even when warming from the engine thread
+    with pdf_cache.app.test_request_context():
+        html = render_template('pdf_template.html', story=story)
+    image_urls = [image.get('url') for image in story.get('images') or [] if image]
+    return render_pdf(html, image_urls)
+
+pdf_cache = PdfCache()
+metrics.register('pdf_cache', pdf_cache.stats)
@@ -0,0 +1,90 @@
+import atexit
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+# WeasyPrint layouts run in this many worker processes, so exports never stall the web threads
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', 2))
+PDF_RENDER_TIMEOUT = float(os.getenv('PDF_RENDER_TIMEOUT', 180))
+# Longest side of images embedded in PDFs; 1240px covers an A4 page at 150 dpi
+PDF_IMAGE_MAX_PX = int(os.getenv('PDF_IMAGE_MAX_PX', 1240))
+PDF_IMAGE_QUALITY = int(os.getenv('PDF_IMAGE_QUALITY', 82))
+PDF_IMAGE_FETCH_CONCURRENCY = 8
+
+_session = requests.Session()
+_fetch_pool = ThreadPoolExecutor(max_workers=PDF_IMAGE_FETCH_CONCURRENCY, thread_name_prefix='pdf-image-fetch')
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn, not fork: forking a process that runs the engine loop and web threads is unsafe
+            _render_pool = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _render_pool
+
+def _reset_render_pool(broken_pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is broken_pool:
+            _render_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+def _shutdown_render_pool():
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(_shutdown_render_pool)
+
+def _prepare_image(url, directory, index):
+    """Download one image and save it as a print-sized JPEG. Returns the local path, or None on failure."""
+    try:
+        response = _session.get(url, timeout=30)
+        response.raise_for_status()
+        image = Image.open(BytesIO(response.content))
+        image.thumbnail((PDF_IMAGE_MAX_PX, PDF_IMAGE_MAX_PX), Image.LANCZOS)
+        path = os.path.join(directory, f"{index}.jpg")
+        image.convert('RGB').save(path, 'JPEG', quality=PDF_IMAGE_QUALITY, optimize=True)
+        return path
+    except Exception as e:
+        print(f"--- PDF Render --- WARN: Could not prefetch {url}: {e}")
+        return None
+
+def prefetch_images(urls, directory):
+    """Fetch and downscale all images at once. Returns {url: local path} for the ones that worked."""
+    urls = list(dict.fromkeys(url for url in urls if url))
+    paths = _fetch_pool.map(lambda pair: _prepare_image(pair[1], directory, pair[0]), enumerate(urls))
+    return {url: path for url, path in zip(urls, paths) if path}
+
+def _render_in_worker(html, local_files):
+    """Runs in a render process: lay out `html`, reading prefetched images from disk."""
+    # Only the render processes load WeasyPrint
+    from weasyprint import HTML, default_url_fetcher
+
+    def url_fetcher(url, *args, **kwargs):
+        path = local_files.get(url)
+        if path:
+            return {'file_obj': open(path, 'rb'), 'mime_type': 'image/jpeg', 'redirected_url': url}
+        return default_url_fetcher(url, *args, **kwargs)
+
+    return HTML(string=html, url_fetcher=url_fetcher).write_pdf()
+
+def render_pdf(html, image_urls=()):
+    """Render `html` to PDF bytes in the render pool, with `image_urls` prefetched and downscaled first."""
+    with tempfile.TemporaryDirectory(prefix='narrato-pdf-') as directory:
+        local_files = prefetch_images(image_urls, directory)
+        pool = _get_render_pool()
+        try:
+            return pool.submit(_render_in_worker, html, local_files).result(timeout=PDF_RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            # A render process died (e.g. out of memory); start a fresh pool for the next export
+            _reset_render_pool(pool)
+            raise
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from ..core import metrics
+
+# Who the current provider call is made on behalf of (the story_uuid of the running job)
+current_owner = ContextVar('current_owner', default=None)
+
+class ProviderQueue:
+    """Capacity-limited gate for one provider that hands out free slots round-robin across owners.
+
+    Each owner gets its own FIFO queue, so one owner with many queued calls cannot starve another
+    owner that only needs a few.
+    """
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.in_use = 0
+        self._waiters = OrderedDict()
+        self._recent_waits = deque(maxlen=200)
+        self._max_wait = 0.0
+        self._granted = 0
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self._waiters.values())
+
+    async def acquire(self, owner=None):
+        started = time.monotonic()
+        if self.in_use < self.capacity and not self._waiters:
+            self.in_use += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(owner, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was granted just as we were cancelled; hand it on
+                    self.release()
+                else:
+                    self._discard(owner, future)
+                raise
+        self._record_wait(time.monotonic() - started)
+
+    def release(self):
+        self.in_use -= 1
+        self._grant_next()
+
+    def _grant_next(self):
+        while self.in_use < self.capacity and self._waiters:
+            owner, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+            if future.done():
+                continue
+            self.in_use += 1
+            future.set_result(None)
+
+    def _discard(self, owner, future):
+        waiters = self._waiters.get(owner)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[owner]
+
+    def _record_wait(self, waited):
+        self._granted += 1
+        self._recent_waits.append(waited)
+        self._max_wait = max(self._max_wait, waited)
+
+    def stats(self):
+        waits = self._recent_waits
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queued": self.queued,
+            "owners_waiting": len(self._waiters),
+            "granted": self._granted,
+            "avg_wait_ms": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+            "max_wait_ms": round(1000 * self._max_wait, 1),
+        }
+
+class ProviderScheduler:
+    """Process-wide limits on concurrent calls to each external provider, shared by every story."""
+    def __init__(self, capacities):
+        self.queues = {name: ProviderQueue(name, capacity) for name, capacity in capacities.items()}
+
+    @asynccontextmanager
+    async def slot(self, provider, owner=None):
+        """Hold one of `provider`'s slots for the duration of the block."""
+        queue = self.queues[provider]
+        await queue.acquire(owner if owner is not None else current_owner.get())
+        try:
+            yield
+        finally:
+            queue.release()
+
+    def stats(self):
+        return {name: queue.stats() for name, queue in self.queues.items()}
+
+provider_scheduler = ProviderScheduler({
+    'gemini': int(os.getenv('GEMINI_CONCURRENCY', 8)),
+    'hf_gradio': int(os.getenv('HF_GRADIO_CONCURRENCY', 4)),
+    'speechify': int(os.getenv('SPEECHIFY_CONCURRENCY', 8)),
+    'cloudinary': int(os.getenv('CLOUDINARY_CONCURRENCY', 8)),
+})
+metrics.register('providers', provider_scheduler.stats)
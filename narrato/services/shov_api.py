@@ -3,11 +3,16 @@ import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), 'speechify-api-sdk-python', 'src'))
 import requests
+from requests.adapters import HTTPAdapter
 import uuid
 import base64
 import json
+import threading
 import time
 
+from ..core import metrics
+from ..core.cache import LRUCache
+
 load_dotenv()
 
 # Shov.com configuration
@@ -15,11 +20,111 @@ SHOV_API_KEY = os.getenv("SHOV_API_KEY")
 PROJECT_NAME = os.getenv("SHOV_PROJECT", "narrato")
 SHOV_API_URL = f"https://shov.com/api"
 
+# Connection pool and timeouts shared by the sync (requests) and async (aiohttp) clients
+SHOV_POOL_SIZE = int(os.getenv('SHOV_POOL_SIZE', 20))
+SHOV_TIMEOUT = float(os.getenv('SHOV_TIMEOUT', 30))
+SHOV_CONNECT_TIMEOUT = float(os.getenv('SHOV_CONNECT_TIMEOUT', 5))
+
+# One keep-alive session per process, so route handlers reuse TCP+TLS connections to shov.com
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=SHOV_POOL_SIZE))
+
+# Request latency per Shov endpoint ('where', 'add', 'update', 'remove', ...), sync and async alike
+shov_latency = {}
+_shov_latency_lock = threading.Lock()
+
+def record_latency(endpoint, seconds):
+    """Add one request's latency to the histogram for a Shov endpoint."""
+    with _shov_latency_lock:
+        histogram = shov_latency.get(endpoint)
+        if histogram is None:
+            histogram = shov_latency[endpoint] = metrics.LatencyHistogram()
+    histogram.observe(seconds)
+
+metrics.register('shov_latency', lambda: {endpoint: h.snapshot() for endpoint, h in list(shov_latency.items())})
+
+# Read-through cache for shov_where. Only collections listed here are cached; stories never change
+# once written, so the listing/lookups only need to refresh when something is added or removed.
+SHOV_CACHE_TTL = {
+    'stories': float(os.getenv('SHOV_STORIES_CACHE_TTL', 300)),
+}
+# Lookups of a single story by its uuid or id are kept for less time: other workers may delete it
+SHOV_LOOKUP_CACHE_TTL = float(os.getenv('SHOV_LOOKUP_CACHE_TTL', 30))
+_LOOKUP_FIELDS = ('story_uuid', 'story_id', 'id')
+# How long past its TTL an entry may still be served while it is refreshed (or while Shov is down)
+SHOV_CACHE_STALE_SECONDS = float(os.getenv('SHOV_CACHE_STALE_SECONDS', 3600))
+_where_cache = LRUCache(max_entries=int(os.getenv('SHOV_CACHE_SIZE', 512)))
+_where_cache_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "invalidations": 0}
+_collection_generation = {}
+_refreshing = set()
+_cache_lock = threading.Lock()
+
+metrics.register('shov_cache', lambda: {**_where_cache_stats, "entries": len(_where_cache)})
+
+def invalidate_collection(collection_name):
+    """Forget every cached shov_where result for a collection. Called on every write to it."""
+    with _cache_lock:
+        _collection_generation[collection_name] = _collection_generation.get(collection_name, 0) + 1
+        _where_cache_stats["invalidations"] += 1
+    _where_cache.discard_where(lambda key: key[0] == collection_name)
+
+_write_listeners = {}
+
+def add_write_listener(collection_name, listener):
+    """Call `listener(op, item_id, value)` after every successful add/update/remove on a collection."""
+    _write_listeners.setdefault(collection_name, []).append(listener)
+
+def notify_write(collection_name, op, item_id, value, result):
+    """Invalidate cached reads of a collection and tell its listeners about a successful write."""
+    invalidate_collection(collection_name)
+    if not result.get('success'):
+        return
+    for listener in _write_listeners.get(collection_name, []):
+        try:
+            listener(op, item_id, value)
+        except Exception as e:
+            print(f"--- Shov Write Listener --- ERROR: {op} on '{collection_name}' failed: {e}")
+
+def _where_cache_key(collection_name, filter_dict):
+    return (collection_name, json.dumps(filter_dict or {}, sort_keys=True, default=str))
+
+def _is_ok(result):
+    return result.get('success', True) and 'error' not in result
+
+def _is_cacheable(result):
+    # Empty results are never cached: the story may just have been saved by another worker
+    return _is_ok(result) and bool(result.get('items'))
+
+def _cache_ttl(collection_name, filter_dict):
+    ttl = SHOV_CACHE_TTL.get(collection_name)
+    if ttl and filter_dict and any(field in filter_dict for field in _LOOKUP_FIELDS):
+        ttl = min(ttl, SHOV_LOOKUP_CACHE_TTL)
+    return ttl
+
+def _refresh_where(key, collection_name, filter_dict, generation):
+    try:
+        result = _shov_where_uncached(collection_name, filter_dict)
+        with _cache_lock:
+            current = _collection_generation.get(collection_name, 0)
+        # Skip results that raced with a write to the collection
+        if current == generation:
+            if _is_cacheable(result):
+                _where_cache.set(key, result)
+            elif _is_ok(result):
+                # The items are gone (e.g. deleted by another worker): stop serving the stale copy
+                _where_cache.discard(key)
+    finally:
+        with _cache_lock:
+            _refreshing.discard(key)
+
 def _shov_request_with_retry(url, headers, json_data=None, max_retries=3, delay=1):
-    """Wrapper for requests.post with retry logic for connection errors."""
+    """POST through the pooled session, with retry logic for connection errors."""
+    endpoint = url[len(SHOV_API_URL):].strip('/').split('/')[0]
     for attempt in range(max_retries):
+        started = time.monotonic()
         try:
-            response = requests.post(url, headers=headers, json=json_data)
+            response = _session.post(url, headers=headers, json=json_data, timeout=(SHOV_CONNECT_TIMEOUT, SHOV_TIMEOUT))
+            record_latency(endpoint, time.monotonic() - started)
             response.raise_for_status()
             return response
         except (requests.exceptions.RequestException, ConnectionResetError) as e:
@@ -85,6 +190,7 @@ def shov_add(collection_name, value):
         print(f"--- Shov Add --- POST-REQUEST: Status Code: {response.status_code}, Raw Response: {response.text}")
         response_json = response.json()
         print(f"--- Shov Add --- POST-REQUEST: JSON Response: {response_json}")
+        notify_write(collection_name, 'add', response_json.get('id'), value, response_json)
         return response_json
     except (requests.exceptions.RequestException, ConnectionResetError) as e:
         print(f"--- Shov Add --- FATAL: RequestException: {e}")
@@ -93,7 +199,45 @@ def shov_add(collection_name, value):
         return {"success": False, "error": "JSONDecodeError", "details": "API returned success status but response was not valid JSON."}
 
 def shov_where(collection_name, filter_dict=None):
-    """Filter items in a collection based on JSON properties."""
+    """Filter items in a collection based on JSON properties.
+
+    Non-empty results for collections in SHOV_CACHE_TTL are served from a local LRU cache
+    (for SHOV_LOOKUP_CACHE_TTL at most when looking up one story by uuid or id). Once an entry
+    is older than its TTL it is still returned while a background refresh runs, and it keeps
+    being served if Shov is unreachable, until SHOV_CACHE_STALE_SECONDS have passed.
+    """
+    ttl = _cache_ttl(collection_name, filter_dict)
+    if not ttl:
+        return _shov_where_uncached(collection_name, filter_dict)
+
+    key = _where_cache_key(collection_name, filter_dict)
+    with _cache_lock:
+        generation = _collection_generation.get(collection_name, 0)
+    cached = _where_cache.get(key)
+    if cached:
+        value, age = cached
+        if age < ttl:
+            _where_cache_stats["hits"] += 1
+            return value
+        if age < ttl + SHOV_CACHE_STALE_SECONDS:
+            _where_cache_stats["stale_hits"] += 1
+            with _cache_lock:
+                start_refresh = key not in _refreshing
+                _refreshing.add(key)
+            if start_refresh:
+                threading.Thread(target=_refresh_where, args=(key, collection_name, filter_dict, generation), daemon=True).start()
+            return value
+
+    _where_cache_stats["misses"] += 1
+    result = _shov_where_uncached(collection_name, filter_dict)
+    if _is_cacheable(result):
+        with _cache_lock:
+            unchanged = _collection_generation.get(collection_name, 0) == generation
+        if unchanged:
+            _where_cache.set(key, result)
+    return result
+
+def _shov_where_uncached(collection_name, filter_dict=None):
     headers = {
         "Authorization": f"Bearer {SHOV_API_KEY}",
         "Content-Type": "application/json"
@@ -159,8 +303,11 @@ def shov_remove(collection_name, item_id):
 
         if 200 <= response.status_code < 300:
             try:
-                return response.json()
+                response_json = response.json()
+                notify_write(collection_name, 'remove', item_id, None, response_json)
+                return response_json
             except json.JSONDecodeError:
+                invalidate_collection(collection_name)
                 return {"success": False, "error": "JSONDecodeError", "details": "API returned success status but response was not valid JSON."}
         else:
             return {"success": False, "error": f"API returned status {response.status_code}", "details": response.text[:500]}
@@ -194,10 +341,11 @@ def shov_update(collection_name, item_id, value):
     }
     data = {"collection": collection_name, "value": value}
     try:
-        response = requests.post(f"{SHOV_API_URL}/update/{PROJECT_NAME}/{item_id}", headers=headers, json=data)
+        response = _shov_request_with_retry(f"{SHOV_API_URL}/update/{PROJECT_NAME}/{item_id}", headers=headers, json_data=data)
         response_json = response.json()
+        notify_write(collection_name, 'update', item_id, value, response_json)
         return response_json
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ConnectionResetError) as e:
         return {"success": False, "error": "RequestException", "details": str(e)}
     except json.JSONDecodeError:
         return {"success": False, "error": "JSONDecodeError", "details": "API returned success status but response was not valid JSON."}
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+from .shov_api import (SHOV_API_KEY, PROJECT_NAME, SHOV_API_URL, SHOV_POOL_SIZE, SHOV_TIMEOUT,
+                       SHOV_CONNECT_TIMEOUT, record_latency, notify_write)
+from .engine import engine
+
+class ShovHTTPError(Exception):
+    """Raised when Shov answers with a non-2xx status."""
+    def __init__(self, status, text):
+        super().__init__(f"Shov returned HTTP {status}: {text[:200]}")
+        self.status = status
+        self.text = text
+
+class AsyncShovClient:
+    """Non-blocking shov.com client for coroutines.
+
+    Keeps one keep-alive connection pool per event loop and retries failed requests with
+    exponential backoff and jitter instead of sleeping the thread.
+    """
+    def __init__(self, api_url, project, api_key, pool_size=SHOV_POOL_SIZE, timeout=SHOV_TIMEOUT,
+                 connect_timeout=SHOV_CONNECT_TIMEOUT, max_retries=3, backoff=0.5):
+        self.api_url = api_url
+        self.project = project
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._sessions = {}
+
+    def _session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+            self._sessions[loop] = session
+        return session
+
+    async def post(self, endpoint, data=None, item_id=None, timeout=None):
+        """POST to `/{endpoint}/{project}[/{item_id}]` and return (status, text), retrying transient failures."""
+        url = f"{self.api_url}/{endpoint}/{self.project}"
+        if item_id is not None:
+            url = f"{url}/{item_id}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout, connect=self.connect_timeout)
+        for attempt in range(self.max_retries):
+            started = time.monotonic()
+            try:
+                async with self._session().post(url, json=data, timeout=client_timeout) as response:
+                    text = await response.text()
+                    record_latency(endpoint, time.monotonic() - started)
+                    if response.status >= 400:
+                        raise ShovHTTPError(response.status, text)
+                    return response.status, text
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionResetError, ShovHTTPError) as e:
+                print(f"--- Async Shov Request --- WARN: Attempt {attempt + 1}/{self.max_retries} failed: {e!r}")
+                if attempt + 1 == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+    async def close(self):
+        """Close the connection pool owned by the running event loop."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+shov_client = AsyncShovClient(SHOV_API_URL, PROJECT_NAME, SHOV_API_KEY)
+engine.add_shutdown_hook(shov_client.close)
+
+_TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionResetError, ShovHTTPError)
+
+def _request_failed(e, **extra):
+    return {"success": False, "error": "RequestException", "details": str(e), **extra}
+
+def _invalid_json(**extra):
+    return {"success": False, "error": "JSONDecodeError", "details": "API returned success status but response was not valid JSON.", **extra}
+
+async def _call(endpoint, data=None, timeout=None, item_id=None, **error_extra):
+    try:
+        _, text = await shov_client.post(endpoint, data, item_id=item_id, timeout=timeout)
+        return json.loads(text)
+    except _TRANSPORT_ERRORS as e:
+        print(f"--- Async Shov {endpoint} --- FATAL: {e!r}")
+        return _request_failed(e, **error_extra)
+    except json.JSONDecodeError:
+        return _invalid_json(**error_extra)
+
+async def shov_set(key, value, timeout=None):
+    """Store a key-value pair in the shov.com database."""
+    return await _call("set", {"key": key, "value": value}, timeout)
+
+async def shov_get(key, timeout=None):
+    """Retrieve a key-value pair from the shov.com database."""
+    return await _call("get", {"key": key}, timeout)
+
+async def shov_contents(timeout=None):
+    """List all items in the shov.com project."""
+    return await _call("contents", None, timeout)
+
+async def shov_add(collection_name, value, timeout=None):
+    """Add a JSON object to a collection."""
+    result = await _call("add", {"name": collection_name, "value": value}, timeout)
+    notify_write(collection_name, 'add', result.get('id'), value, result)
+    return result
+
+async def shov_where(collection_name, filter_dict=None, timeout=None):
+    """Filter items in a collection based on JSON properties."""
+    data = {"name": collection_name}
+    if filter_dict:
+        data['filter'] = filter_dict
+    return await _call("where", data, timeout, items=[])
+
+async def shov_send_otp(email, timeout=None):
+    """Send OTP to the user's email."""
+    return await _call("send-otp", {"identifier": email}, timeout)
+
+async def shov_verify_otp(email, pin, timeout=None):
+    """Verify the OTP provided by the user."""
+    return await _call("verify-otp", {"identifier": email, "pin": pin}, timeout)
+
+async def shov_remove(collection_name, item_id, timeout=None):
+    """Remove an item from a collection by its ID."""
+    result = await _call("remove", {"collection": collection_name}, timeout, item_id=item_id)
+    notify_write(collection_name, 'remove', item_id, None, result)
+    return result
+
+async def shov_forget(key, timeout=None):
+    """Permanently delete a key-value pair."""
+    return await _call("forget", {"key": key}, timeout)
+
+async def shov_update(collection_name, item_id, value, timeout=None):
+    """Update an item in a collection by its ID."""
+    result = await _call("update", {"collection": collection_name, "value": value}, timeout, item_id=item_id)
+    notify_write(collection_name, 'update', item_id, value, result)
+    return result
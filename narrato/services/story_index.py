@@ -0,0 +1,285 @@
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from .shov_api import add_write_listener, shov_add, shov_get, shov_set, _shov_where_uncached
+from ..core import metrics
+from ..core.cache import LRUCache
+
+# How often each process rebuilds its index, to pick up stories written by other workers
+STORY_INDEX_REFRESH_SECONDS = float(os.getenv('STORY_INDEX_REFRESH_SECONDS', 300))
+STORY_PAGE_SIZE = int(os.getenv('STORY_PAGE_SIZE', 24))
+# Full story records kept by item id. Shov cannot fetch one item by id, so this is what lets an
+# index hit skip the filtered query altogether.
+STORY_RECORD_CACHE_SIZE = int(os.getenv('STORY_RECORD_CACHE_SIZE', 256))
+
+# Compact per-story records written next to each full story, so listings never load full stories
+SUMMARY_COLLECTION = 'story_summaries'
+# Shov key set once every story written before summaries existed has one. Until then, each process
+# scans the full `stories` collection once to backfill them.
+SUMMARY_BACKFILL_MARKER = 'migrations:story_summaries_backfilled'
+
+def summarize_story(item_id, value):
+    """The small subset of a story record that listings and ownership checks need."""
+    images = value.get('images') or []
+    paragraphs = value.get('paragraphs') or []
+    return {
+        'id': item_id,
+        'story_uuid': value.get('story_uuid'),
+        'title': value.get('title'),
+        'email': value.get('email'),
+        'public': bool(value.get('public')),
+        'cover_url': images[0].get('url') if images and images[0] else None,
+        'excerpt': paragraphs[0] if paragraphs else '',
+        'created_at': value.get('created_at'),
+        'paragraph_count': len(paragraphs),
+    }
+
+def summary_record(story_id, value):
+    """The value stored in SUMMARY_COLLECTION for the story with Shov item id `story_id`."""
+    record = summarize_story(story_id, value)
+    record['story_id'] = record.pop('id')
+    return record
+
+def _from_summary_record(summary_id, record):
+    summary = {key: value for key, value in record.items() if key != 'story_id'}
+    summary['id'] = record.get('story_id')
+    summary['summary_id'] = summary_id
+    return summary
+
+def paginate(summaries, page=1, per_page=STORY_PAGE_SIZE, fields=None):
+    """Cut one page out of a list of summaries, keeping only `fields` of each when given."""
+    per_page = max(1, per_page)
+    total = len(summaries)
+    pages = max(1, math.ceil(total / per_page))
+    page = min(max(1, page), pages)
+    items = summaries[(page - 1) * per_page:page * per_page]
+    if fields:
+        items = [{field: summary.get(field) for field in fields} for summary in items]
+    return {
+        'items': items,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': pages,
+        'has_prev': page > 1,
+        'has_next': page < pages,
+    }
+
+class StoryIndex:
+    """In-process secondary index of the `stories` collection.
+
+    Maps story_uuid, email, title and the public flag to Shov item ids, and keeps a summary
+    of each story, so listings and ownership checks are dictionary lookups instead of a
+    filter over the whole collection. Kept current by Shov write listeners and rebuilt
+    periodically from the compact SUMMARY_COLLECTION. The full records of recently written
+    or read stories are kept too, so `story_for_uuid` / `story_for_title` usually answer
+    without a Shov round trip.
+    """
+    def __init__(self):
+        self.ready = False
+        self.built_at = None
+        self.backfilled = False
+        self._summaries = {}
+        self._by_uuid = {}
+        # Id "sets" are dicts so they keep insertion (i.e. creation) order
+        self._by_email = defaultdict(dict)
+        self._by_title = defaultdict(dict)
+        self._public = {}
+        self._records = LRUCache(STORY_RECORD_CACHE_SIZE)
+        self._rebuilding = False
+        self._writes_during_rebuild = []
+        self._lock = threading.Lock()
+
+    def _add(self, summary):
+        item_id = summary['id']
+        previous = self._summaries.get(item_id)
+        if previous and previous.get('summary_id') and not summary.get('summary_id'):
+            summary = {**summary, 'summary_id': previous['summary_id']}
+        self._remove(item_id)
+        self._summaries[item_id] = summary
+        if summary['story_uuid']:
+            self._by_uuid[summary['story_uuid']] = item_id
+        if summary['email']:
+            self._by_email[summary['email']][item_id] = None
+        if summary['title']:
+            self._by_title[summary['title']][item_id] = None
+        if summary['public']:
+            self._public[item_id] = None
+
+    def _remove(self, item_id):
+        summary = self._summaries.pop(item_id, None)
+        if summary is None:
+            return
+        if self._by_uuid.get(summary['story_uuid']) == item_id:
+            del self._by_uuid[summary['story_uuid']]
+        self._by_email.get(summary['email'], {}).pop(item_id, None)
+        self._by_title.get(summary['title'], {}).pop(item_id, None)
+        self._public.pop(item_id, None)
+
+    def story_listener(self, op, item_id, value):
+        """Write listener for the `stories` collection."""
+        self._record_write('story', op, item_id, value)
+
+    def summary_listener(self, op, item_id, value):
+        """Write listener for SUMMARY_COLLECTION."""
+        self._record_write('summary', op, item_id, value)
+
+    def _record_write(self, kind, op, item_id, value):
+        if item_id is None:
+            return
+        with self._lock:
+            if self._rebuilding:
+                self._writes_during_rebuild.append((kind, op, item_id, value))
+            self._apply(kind, op, item_id, value)
+
+    def _apply(self, kind, op, item_id, value):
+        if kind == 'story':
+            if op == 'remove':
+                self._remove(item_id)
+                self._records.discard(item_id)
+            elif value is not None:
+                self._add(summarize_story(item_id, value))
+                self._records.set(item_id, value)
+        elif op != 'remove' and value and value.get('story_id'):
+            self._add(_from_summary_record(item_id, value))
+
+    def rebuild(self, include_stories=False):
+        """Reload the whole index from Shov. Returns False (keeping the old index) if Shov fails.
+
+        Normally only SUMMARY_COLLECTION is read. With `include_stories`, the full `stories`
+        collection is scanned too, and any story written before summaries existed gets its
+        summary record backfilled. Once every backfill has succeeded, SUMMARY_BACKFILL_MARKER
+        is set so that no process scans the full collection again.
+        """
+        with self._lock:
+            self._rebuilding = True
+            self._writes_during_rebuild = []
+        try:
+            response = _shov_where_uncached(SUMMARY_COLLECTION)
+            if not response.get('success', True) or 'error' in response:
+                print(f"--- Story Index --- WARN: Rebuild failed: {response.get('details')}")
+                return False
+            summaries = [_from_summary_record(item['id'], item.get('value') or {}) for item in response.get('items', [])]
+            summaries = [summary for summary in summaries if summary['id']]
+
+            missing = []
+            if include_stories:
+                stories_response = _shov_where_uncached('stories')
+                if not stories_response.get('success', True) or 'error' in stories_response:
+                    print(f"--- Story Index --- WARN: Full scan failed: {stories_response.get('details')}")
+                    return False
+                known = {summary['id'] for summary in summaries}
+                missing = [(item['id'], item.get('value') or {}) for item in stories_response.get('items', []) if item['id'] not in known]
+                summaries += [summarize_story(item_id, value) for item_id, value in missing]
+
+            # Oldest first, as Shov lists them; stories from before created_at existed come first
+            summaries.sort(key=lambda summary: summary.get('created_at') or '')
+            with self._lock:
+                self._summaries, self._by_uuid, self._public = {}, {}, {}
+                self._by_email, self._by_title = defaultdict(dict), defaultdict(dict)
+                for summary in summaries:
+                    self._add(summary)
+                # Writes that landed while the snapshot was being fetched may be missing from it
+                for kind, op, item_id, value in self._writes_during_rebuild:
+                    self._apply(kind, op, item_id, value)
+                self.ready = True
+                self.built_at = time.time()
+            print(f"--- Story Index --- INFO: Indexed {len(self._summaries)} stories")
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._writes_during_rebuild = []
+
+        complete = True
+        for item_id, value in missing:
+            # Another worker's backfill may have beaten us to it since the snapshot was taken
+            existing = _shov_where_uncached(SUMMARY_COLLECTION, {'story_id': item_id})
+            if not existing.get('success', True) or 'error' in existing:
+                complete = False
+            elif not existing.get('items'):
+                complete = bool(shov_add(SUMMARY_COLLECTION, summary_record(item_id, value)).get('success')) and complete
+        if include_stories and complete:
+            self._mark_backfilled(len(missing))
+        return True
+
+    def _mark_backfilled(self, count):
+        result = shov_set(SUMMARY_BACKFILL_MARKER, {'completed_at': datetime.now(timezone.utc).isoformat(), 'backfilled': count})
+        if result.get('success'):
+            self.backfilled = True
+            print(f"--- Story Index --- INFO: Summary backfill complete ({count} stories)")
+
+    def _backfill_marker_set(self):
+        response = shov_get(SUMMARY_BACKFILL_MARKER)
+        return bool(response.get('success') and response.get('value'))
+
+    def start(self, refresh_interval=STORY_INDEX_REFRESH_SECONDS):
+        """Build the index in the background and keep refreshing it."""
+        def refresh_forever():
+            while True:
+                try:
+                    if not self.backfilled:
+                        self.backfilled = self._backfill_marker_set()
+                    self.rebuild(include_stories=not self.backfilled)
+                except Exception as e:
+                    print(f"--- Story Index --- ERROR: Rebuild crashed: {e}")
+                time.sleep(refresh_interval)
+        threading.Thread(target=refresh_forever, name='story-index', daemon=True).start()
+
+    def _summaries_for(self, ids):
+        return [self._summaries[item_id] for item_id in ids]
+
+    def public_stories(self, page=1, per_page=STORY_PAGE_SIZE, fields=None):
+        """One page of public story summaries (see `paginate`)."""
+        with self._lock:
+            summaries = self._summaries_for(self._public)
+        return paginate(summaries, page, per_page, fields)
+
+    def stories_for_email(self, email, page=1, per_page=STORY_PAGE_SIZE, fields=None):
+        """One page of a user's story summaries (see `paginate`)."""
+        with self._lock:
+            summaries = self._summaries_for(self._by_email.get(email, {}))
+        return paginate(summaries, page, per_page, fields)
+
+    def summary_id_for(self, item_id):
+        """The SUMMARY_COLLECTION item id for a story, if known."""
+        with self._lock:
+            summary = self._summaries.get(item_id)
+            return summary.get('summary_id') if summary else None
+
+    def ids_for_email(self, email):
+        with self._lock:
+            return set(self._by_email.get(email, {}))
+
+    def remember_story(self, item_id, value):
+        """Keep a story record fetched from Shov for later lookups."""
+        self._records.set(item_id, value)
+
+    def _record(self, item_id):
+        cached = self._records.get(item_id) if item_id else None
+        return cached[0] if cached else None
+
+    def story_for_uuid(self, story_uuid):
+        """The full record of the story with `story_uuid`, if the index knows it and has it at hand."""
+        with self._lock:
+            item_id = self._by_uuid.get(story_uuid)
+        return self._record(item_id)
+
+    def story_for_title(self, title):
+        """The full record of the first story titled `title`, if the index knows it and has it at hand."""
+        with self._lock:
+            item_id = next(iter(self._by_title.get(title, {})), None)
+        return self._record(item_id)
+
+    def stats(self):
+        with self._lock:
+            return {"ready": self.ready, "stories": len(self._summaries), "public": len(self._public),
+                    "records_cached": len(self._records), "built_at": self.built_at, "backfilled": self.backfilled}
+
+story_index = StoryIndex()
+add_write_listener('stories', story_index.story_listener)
+add_write_listener(SUMMARY_COLLECTION, story_index.summary_listener)
+metrics.register('story_index', story_index.stats)
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import re
+from xml.sax.saxutils import escape
+
+# Clips requested within TTS_BATCH_LINGER_SECONDS of each other are narrated in one Speechify
+# request of up to TTS_BATCH_MAX_CHARS characters; 0 narrates every clip on its own
+TTS_BATCH_MAX_CHARS = int(os.getenv('TTS_BATCH_MAX_CHARS', 3000))
+TTS_BATCH_LINGER_SECONDS = float(os.getenv('TTS_BATCH_LINGER_SECONDS', 0.3))
+# Silence between clips in a batch; the audio is cut in the middle of it
+TTS_BATCH_PAUSE_MS = 1200
+
+_WORD = re.compile(r"\w+")
+
+class SpeechMarksMismatch(ValueError):
+    """Raised when a batch's speech marks cannot be lined up with the texts that were sent."""
+
+def batch_ssml(texts, emotion, pause_ms=TTS_BATCH_PAUSE_MS):
+    """One SSML document narrating every text in turn, with a pause between them."""
+    pause = f'<break time="{pause_ms}ms"/>'
+    body = pause.join(escape(text) for text in texts)
+    return f'<speak><speechify:style emotion="{emotion}">{body}</speechify:style></speak>'
+
+def _field(mark, name):
+    return mark.get(name) if isinstance(mark, dict) else getattr(mark, name, None)
+
+def _words(text):
+    return [word.lower() for word in _WORD.findall(text)]
+
+def segment_cut_times(speech_marks, texts):
+    """Seconds at which to cut a batch's audio so that each text gets its own clip.
+
+    Speechify's word marks are matched against the words of each text in order, and each
+    cut falls halfway between the last word of one text and the first word of the next.
+    Raises SpeechMarksMismatch if the spoken words do not match the texts.
+    """
+    marks = [mark for mark in (_field(speech_marks, 'chunks') or []) if _field(mark, 'type') in (None, 'word')]
+    spoken = []
+    for mark in marks:
+        spoken += [(word, _field(mark, 'start_time'), _field(mark, 'end_time')) for word in _words(_field(mark, 'value') or '')]
+    expected = [_words(text) for text in texts]
+    if [word for word, _, _ in spoken] != [word for words in expected for word in words]:
+        raise SpeechMarksMismatch(f"Speech marks have {len(spoken)} words, texts have {sum(map(len, expected))}")
+    if any(not words for words in expected):
+        raise SpeechMarksMismatch("A text has no words to anchor a cut on")
+    cuts = []
+    position = 0
+    for words in expected[:-1]:
+        position += len(words)
+        last_end, next_start = spoken[position - 1][2], spoken[position][1]
+        cuts.append((last_end + next_start) / 2 / 1000)  # marks are in milliseconds
+    return cuts
+
+class SpeechBatcher:
+    """Groups clips requested close together so they can be narrated in one request.
+
+    `request(text)` waits up to `linger` seconds for more texts (or until `max_chars` are
+    queued), then hands the whole group to `synthesize(texts)`, which returns one URL (or
+    None) per text.
+    """
+    def __init__(self, synthesize, max_chars=TTS_BATCH_MAX_CHARS, linger=TTS_BATCH_LINGER_SECONDS):
+        self._synthesize = synthesize
+        self.max_chars = max_chars
+        self.linger = linger
+        self._pending = []
+        self._pending_chars = 0
+        self._timer = None
+        self._running = set()
+        self.batches = 0
+        self.clips = 0
+
+    async def request(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self._pending and self._pending_chars + len(text) > self.max_chars:
+            self._flush()
+        self._pending.append((text, future))
+        self._pending_chars += len(text)
+        if self._pending_chars >= self.max_chars:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_chars = self._pending, [], 0
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch):
+        # Drop clips whose callers gave up (e.g. a cancelled story) before the batch went out
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        self.batches += 1
+        self.clips += len(batch)
+        try:
+            urls = await self._synthesize([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), url in zip(batch, urls):
+            if not future.done():
+                future.set_result(url)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "clips": self.clips,
+            "clips_per_batch": round(self.clips / self.batches, 1) if self.batches else None,
+        }
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import json
+import os
+import unicodedata
+
+from .shov_async import shov_get, shov_set
+from ..core import metrics
+from ..core.cache import LRUCache, DiskCache, SingleFlight
+
+# Narration URLs are stored in Shov under this key prefix, shared by every process
+TTS_CACHE_KEY_PREFIX = 'tts:'
+TTS_CACHE_MEMORY_ENTRIES = 2048
+TTS_CACHE_DISK_ENTRIES = int(os.getenv('TTS_CACHE_DISK_ENTRIES', 50000))
+
+def normalize_text(text):
+    """Text as it will sound: Unicode-normalized, with whitespace runs collapsed."""
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+def tts_cache_key(text, voice_id, emotion, audio_format):
+    payload = json.dumps([normalize_text(text), voice_id, emotion, audio_format])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class TTSCache:
+    """Content-addressed cache of narration clips: (text, voice, emotion, format) -> Cloudinary URL.
+
+    Lookups go through process memory, then a local SQLite file, then Shov's key-value
+    store, so clips are shared across restarts and between web processes. Concurrent
+    requests for the same clip share a single synthesis.
+    """
+    def __init__(self):
+        self._memory = LRUCache(TTS_CACHE_MEMORY_ENTRIES)
+        self._disk = DiskCache(TTS_CACHE_DISK_ENTRIES)
+        self._calls = SingleFlight()
+        self._background = set()
+        self.hits = {'memory': 0, 'disk': 0, 'shov': 0}
+        self.misses = 0
+
+    def init_app(self, app):
+        self._disk.open(os.getenv('TTS_CACHE_DB_PATH') or os.path.join(app.instance_path, 'tts_cache.sqlite3'))
+
+    async def _lookup(self, key):
+        entry = self._memory.get(key)
+        if entry is not None:
+            self.hits['memory'] += 1
+            return entry[0]
+        url = self._disk.get(key)
+        if url:
+            self.hits['disk'] += 1
+            self._memory.set(key, url)
+            return url
+        response = await shov_get(TTS_CACHE_KEY_PREFIX + key)
+        url = response.get('value') if response.get('success') else None
+        if url:
+            self.hits['shov'] += 1
+            self._memory.set(key, url)
+            self._disk.set(key, url)
+            return url
+        return None
+
+    def _store(self, key, url):
+        self._memory.set(key, url)
+        self._disk.set(key, url)
+        task = asyncio.create_task(shov_set(TTS_CACHE_KEY_PREFIX + key, url))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def get_or_create(self, text, voice_id, emotion, audio_format, create):
+        """The cached URL for this clip, or the result of `await create()` (cached unless it is None)."""
+        key = tts_cache_key(text, voice_id, emotion, audio_format)
+        return await self._calls.run(key, lambda: self._lookup_or_create(key, create))
+
+    async def _lookup_or_create(self, key, create):
+        url = await self._lookup(key)
+        if url is None:
+            self.misses += 1
+            url = await create()
+            if url:
+                self._store(key, url)
+        return url
+
+    def stats(self):
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "shared_in_flight": self._calls.shared,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk),
+        }
+
+tts_cache = TTSCache()
+metrics.register('tts_cache', tts_cache.stats)
@@ -25,12 +25,27 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- Core Functions ---
 
+    function cancelStoryJob() {
+        // The server keeps generating after the stream closes, so stop the job itself
+        const taskJSON = localStorage.getItem(activeStreamTaskKey);
+        const storyUuid = taskJSON ? JSON.parse(taskJSON).story_uuid : null;
+        if (!storyUuid) return;
+        fetch('/cancel_story_stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ story_uuid: storyUuid })
+        }).catch(err => console.error('Could not cancel story generation:', err));
+    }
+
     function resetUI() {
         sessionStorage.removeItem('isSubmitting'); // Reset submission guard
         if (currentEventSource) {
             currentEventSource.close();
             currentEventSource = null;
         }
+        cancelStoryJob();
         // Add logic here for stopping polling if/when implemented
 
         toggleForm(false);
@@ -166,6 +181,18 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
+            if (data.task === 'Cancelled') {
+                // Cancelled from another tab (or this one, before the stream closed)
+                sessionStorage.removeItem('isSubmitting');
+                currentEventSource.close();
+                localStorage.removeItem(activeStreamTaskKey);
+                toggleForm(false);
+                loading.classList.add('hidden');
+                cancelBtn.classList.add('hidden');
+                updateProgress('Cancelled', 0, 100);
+                return;
+            }
+
                             updateProgress(data.task, data.progress, data.total);
                             updateAllTaskStatuses(data.progress);
             
@@ -1,6 +1,9 @@
 from narrato import create_app
 
-app = create_app()
+# PDF render processes are spawned and re-import this module as __mp_main__; only the
+# process serving requests should build the app and start its background services
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080)
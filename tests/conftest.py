@@ -0,0 +1,5 @@
+import os
+
+# Provider key managers refuse to start without keys; the tests never call the providers
+for name in ('GOOGLE_API_KEY', 'HUGGING_FACE_TOKEN', 'SPEECHIFY_KEY'):
+    os.environ.setdefault(name, f'test-{name.lower()}')
@@ -0,0 +1,59 @@
+from narrato.services.checkpoint import apply_ops, coalesce_ops
+
+def test_apply_ops_builds_nested_dicts_and_lists():
+    state = apply_ops({}, [
+        [['story_data', 'title'], 'The Fox'],
+        [['story_data', 'images', 2], {'url': 'c.png'}],
+        [['completed_stages'], ['content']],
+    ])
+
+    assert state == {
+        'story_data': {'title': 'The Fox', 'images': [None, None, {'url': 'c.png'}]},
+        'completed_stages': ['content'],
+    }
+
+def test_apply_ops_fills_gaps_and_keeps_existing_values():
+    state = {'story_data': {'audio_files': ['a.mp3'], 'title': 'The Fox'}}
+
+    apply_ops(state, [
+        [['story_data', 'audio_files', 3], 'd.mp3'],
+        [['story_data', 'audio_files', 1], 'b.mp3'],
+        [['story_data', 'images', 0, 'url'], 'a.png'],
+    ])
+
+    assert state['story_data'] == {
+        'audio_files': ['a.mp3', 'b.mp3', None, 'd.mp3'],
+        'title': 'The Fox',
+        'images': [{'url': 'a.png'}],
+    }
+
+def test_apply_ops_replaces_a_whole_subtree():
+    state = {'story_data': {'images': [{'url': 'a.png'}, {'url': 'b.png'}]}}
+
+    apply_ops(state, [[['story_data', 'images'], []]])
+
+    assert state == {'story_data': {'images': []}}
+
+def test_coalesce_ops_keeps_the_last_write_per_path():
+    ops = [
+        [['story_data', 'images', 0], {'url': 'old.png'}],
+        [['story_data', 'images', 1], {'url': 'b.png'}],
+        [['story_data', 'images', 0], {'url': 'new.png'}],
+    ]
+
+    assert coalesce_ops(ops) == [
+        [['story_data', 'images', 1], {'url': 'b.png'}],
+        [['story_data', 'images', 0], {'url': 'new.png'}],
+    ]
+
+def test_coalesced_ops_rebuild_the_same_state():
+    ops = [
+        [['story_data', 'images'], [None, None]],
+        [['story_data', 'images', 1], {'url': 'b.png'}],
+        [['story_data', 'images'], [None, None, None]],
+        [['story_data', 'images', 2], {'url': 'c.png'}],
+        [['completed_stages'], ['content']],
+        [['completed_stages'], ['content', 'audio']],
+    ]
+
+    assert apply_ops({}, coalesce_ops(ops)) == apply_ops({}, ops)
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+from narrato.core import circuit
+from narrato.core.circuit import CircuitBreaker
+from narrato.services import gemini_client, generation
+from narrato.services.gemini_client import ModelRouter, MODEL_PROBE_POLL_SECONDS
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(circuit.time, 'monotonic', fake)
+    return fake
+
+def tripped(clock, **kwargs):
+    breaker = CircuitBreaker('test', min_calls=4, open_seconds=30, **kwargs)
+    for _ in range(4):
+        breaker.record_failure()
+    return breaker
+
+def test_opens_once_the_failure_rate_is_reached(clock):
+    breaker = CircuitBreaker('test', failure_threshold=0.5, min_calls=4)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED  # only three outcomes so far
+
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available()
+    assert not breaker.try_acquire()
+    assert breaker.reopens_in == 30
+
+def test_old_failures_leave_the_window(clock):
+    breaker = CircuitBreaker('test', min_calls=4, window_seconds=300)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 301
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.success_rate == 0.0
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = tripped(clock)
+    clock.now += 30
+
+    assert breaker.available()
+    assert breaker.try_acquire()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.available()
+    assert not breaker.try_acquire()
+    assert breaker.reopens_in == 0
+
+def test_successful_probe_closes_the_breaker(clock):
+    breaker = tripped(clock)
+    clock.now += 30
+    breaker.try_acquire()
+
+    breaker.record_success(0.2)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.success_rate == 1.0
+    assert breaker.try_acquire()
+
+def test_failed_probe_doubles_the_open_time_up_to_the_maximum(clock):
+    breaker = tripped(clock, max_open_seconds=100)
+    for expected in (60, 100, 100):
+        clock.now += breaker.reopens_in
+        assert breaker.try_acquire()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.reopens_in == expected
+
+def test_released_probe_lets_another_one_through(clock):
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.try_acquire()
+
+    breaker.release()
+
+    assert breaker.try_acquire()
+
+def test_router_waits_for_the_first_open_breaker(clock):
+    router = ModelRouter(['a', 'b'])
+    for name, extra in (('a', 0), ('b', 10)):
+        for _ in range(4):
+            router.breakers[name].record_failure()
+        clock.now += extra
+
+    assert router.ordered() == []
+    assert router.reopens_in() == 20
+
+def test_router_polls_while_every_model_is_probing(clock):
+    router = ModelRouter(['a'])
+    for _ in range(4):
+        router.breakers['a'].record_failure()
+    clock.now += 30
+    router.breakers['a'].try_acquire()
+
+    assert router.ordered() == []
+    assert router.reopens_in() == MODEL_PROBE_POLL_SECONDS
+
+def test_call_waits_when_another_call_holds_the_probe(monkeypatch):
+    router = ModelRouter(['model-a'])
+    breaker = router.breakers['model-a']
+    for _ in range(4):
+        breaker.record_failure()
+    breaker._opened_until = 0
+    assert breaker.try_acquire()  # someone else's probe is in flight
+    monkeypatch.setattr(generation, 'gemini_models', router)
+    monkeypatch.setattr(gemini_client, 'MODEL_PROBE_POLL_SECONDS', 0.01)
+
+    async def generate(api_key, model_name, prompt, **options):
+        return f"{model_name}: {prompt}"
+    monkeypatch.setattr(generation.gemini_clients, 'generate', generate)
+
+    async def run():
+        call = asyncio.create_task(generation._generate_uncached('hello'))
+        await asyncio.sleep(0.03)
+        assert not call.done()
+        breaker.record_success()  # the probe succeeds and closes the breaker
+        return await call
+
+    assert asyncio.run(run()) == 'model-a: hello'
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from narrato.services import engine as engine_module
+from narrato.services.engine import GenerationEngine, JobAccessDenied, StoryJob
+
+@pytest.fixture
+def engine():
+    generation_engine = GenerationEngine()
+    yield generation_engine
+    for job in list(generation_engine._jobs.values()):
+        generation_engine.cancel(job.key, owner=job.owner)
+        wait_until(lambda: job.finished)
+    generation_engine.shutdown()
+
+def events(*tasks, fail=False, hold=None):
+    async def make_events():
+        for task in tasks:
+            yield {'task': task}
+            await asyncio.sleep(0)
+        if hold is not None:
+            await asyncio.sleep(hold)
+        if fail:
+            raise RuntimeError("provider down")
+    return make_events
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def tasks_of(payloads):
+    return [json.loads(payload)['task'] for payload in payloads]
+
+def test_late_subscriber_gets_every_event(engine):
+    job = engine.submit('story', events('a', 'b', 'Finished!'))
+    wait_until(lambda: job.finished)
+
+    assert tasks_of(job.subscribe()) == ['a', 'b', 'Finished!']
+    assert tasks_of(job.subscribe()) == ['a', 'b', 'Finished!']
+
+def test_events_keep_the_state_they_were_published_with():
+    job = StoryJob('story')
+    story = {'paragraphs': ['One']}
+    job.publish({'task': 'a', 'data': story})
+    story['paragraphs'].append('Two')
+    job.finish()
+
+    assert json.loads(next(job.subscribe()))['data'] == {'paragraphs': ['One']}
+
+def test_subscribers_receive_live_events(engine):
+    job = engine.submit('story', events('a', 'b', hold=0.1))
+
+    assert tasks_of(job.subscribe()) == ['a', 'b']
+
+def test_reconnecting_client_attaches_to_the_running_job(engine):
+    first = engine.submit('story', events('a', hold=0.5), owner='ann')
+
+    assert engine.submit('story', events('other'), owner='ann') is first
+
+def test_other_owners_cannot_attach(engine):
+    job = engine.submit('story', events('a', hold=0.5), owner='ann')
+
+    with pytest.raises(JobAccessDenied):
+        engine.submit('story', events('other'), owner='bob')
+    with pytest.raises(JobAccessDenied):
+        next(job.subscribe(owner='bob'))
+
+def test_finished_jobs_are_kept_for_the_retention_period(engine, monkeypatch):
+    monkeypatch.setattr(engine_module, 'JOB_RETENTION_SECONDS', 0.2)
+    job = engine.submit('story', events('Finished!'))
+    wait_until(lambda: job.finished)
+
+    assert engine.submit('story', events('again')) is job
+    wait_until(lambda: engine.stats()['jobs_retained'] == 0)
+    assert engine.submit('story', events('again')) is not job
+
+def test_failed_jobs_are_forgotten_straight_away(engine, monkeypatch):
+    monkeypatch.setattr(engine_module, 'JOB_RETENTION_SECONDS', 60)
+    job = engine.submit('story', events('a', fail=True))
+    wait_until(lambda: job.finished)
+
+    assert tasks_of(job.subscribe()) == ['a', 'Error']
+    wait_until(lambda: engine.stats() == {'jobs_running': 0, 'jobs_retained': 0})
+
+def test_cancel_stops_the_job_for_its_owner_only(engine):
+    job = engine.submit('story', events('a', hold=10), owner='ann')
+    wait_until(lambda: job.last_task == 'a')
+
+    with pytest.raises(JobAccessDenied):
+        engine.cancel('story', owner='bob')
+    assert engine.cancel('story', owner='ann')
+    wait_until(lambda: job.finished)
+
+    assert tasks_of(job.subscribe(owner='ann')) == ['a', 'Cancelled']
+    assert not engine.cancel('story', owner='ann')
+
+def test_event_buffer_keeps_the_most_recent_events(monkeypatch):
+    monkeypatch.setattr(engine_module, 'JOB_EVENT_BUFFER', 3)
+    job = StoryJob('story')
+    for task in 'abcde':
+        job.publish({'task': task})
+    job.finish()
+
+    assert tasks_of(job.subscribe()) == ['c', 'd', 'e']
@@ -0,0 +1,65 @@
+import json
+
+from narrato.core.jsonstream import JSONStreamParser
+
+STORY = '```json\n{"title": "The \\"Brave\\" Fox", "paragraphs": ["First, {it} ran.", "Then: it hid]"], "moral": null, "pages": 2, "tags": [[1, true], {"k": -0.5}]}\n```'
+
+def events_for(chunks):
+    parser = JSONStreamParser()
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    return parser, events
+
+def test_reports_every_value_with_its_path():
+    parser, events = events_for([STORY])
+
+    assert events == [
+        (('title',), 'The "Brave" Fox'),
+        (('paragraphs', 0), 'First, {it} ran.'),
+        (('paragraphs', 1), 'Then: it hid]'),
+        (('moral',), None),
+        (('pages',), 2),
+        (('tags', 0, 0), 1),
+        (('tags', 0, 1), True),
+        (('tags', 1, 'k'), -0.5),
+    ]
+    assert parser.done
+
+def test_chunk_boundaries_do_not_matter():
+    _, whole = events_for([STORY])
+
+    for size in (1, 2, 3, 7):
+        _, chunked = events_for([STORY[i:i + size] for i in range(0, len(STORY), size)])
+        assert chunked == whole
+
+def test_values_are_reported_as_soon_as_they_are_complete():
+    parser = JSONStreamParser()
+
+    assert parser.feed('{"paragraphs": ["One", "Tw') == [(('paragraphs', 0), 'One')]
+    assert parser.feed('o"') == [(('paragraphs', 1), 'Two')]
+    assert parser.feed(', 4') == []
+    assert parser.feed('2]') == [(('paragraphs', 2), 42)]
+    assert not parser.done
+
+def test_escapes_and_unicode_are_decoded():
+    _, events = events_for(['{"t": "a\\\\", "u": "caf\\u00e9 \\u2014 ok", "n": "line\\nbreak"}'])
+
+    assert events == [(('t',), 'a\\'), (('u',), 'café — ok'), (('n',), 'line\nbreak')]
+
+def test_trailing_commas_and_text_after_the_document_are_ignored():
+    parser, events = events_for(['{"a": [1, 2,], "b": "x",}', ' trailing {"c": 3}'])
+
+    assert events == [(('a', 0), 1), (('a', 1), 2), (('b',), 'x')]
+    assert parser.done
+
+def test_top_level_array():
+    _, events = events_for(['[{"p": "a"}, {"p": "b"}]'])
+
+    assert events == [((0, 'p'), 'a'), ((1, 'p'), 'b')]
+
+def test_matches_json_loads_for_the_story_values():
+    _, events = events_for([STORY])
+    document = json.loads(STORY.strip('`').removeprefix('json\n'))
+
+    assert [value for path, value in events if path[0] == 'paragraphs'] == document['paragraphs']
@@ -0,0 +1,132 @@
+import asyncio
+import types
+
+import pytest
+
+from narrato.services import key_manager
+from narrato.services.key_manager import APIKeyManager, NoKeyAvailable, TokenBucket, retry_after_from
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(key_manager, 'time', types.SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(key_manager, 'asyncio', types.SimpleNamespace(sleep=fake.sleep))
+    return fake
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, message='429 Too Many Requests', headers=None):
+        super().__init__(message)
+        self.headers = headers or {}
+
+def acquire(manager, scope=None, max_wait=0):
+    return asyncio.run(manager.get_next_key(scope, max_wait=max_wait))
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate_per_minute=60, capacity=2)
+    bucket.updated = now = 0.0
+    bucket.take(now)
+    bucket.take(now)
+
+    assert bucket.wait_time(now) == pytest.approx(1.0)
+    assert bucket.wait_time(now + 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 10) == 0
+    assert bucket.tokens == 2  # never above capacity
+
+def test_each_scope_has_its_own_bucket(clock):
+    manager = APIKeyManager(['key-a'], rate_per_minute=1)
+
+    assert acquire(manager, 'flash') == 'key-a'
+    assert acquire(manager, 'pro') == 'key-a'
+    with pytest.raises(NoKeyAvailable) as error:
+        acquire(manager, 'flash')
+    assert error.value.retry_after == pytest.approx(60)
+
+def test_waits_for_a_token_within_max_wait(clock):
+    manager = APIKeyManager(['key-a'], rate_per_minute=2)
+    acquire(manager)
+    acquire(manager)
+
+    assert acquire(manager, max_wait=30) == 'key-a'
+    assert clock.now == pytest.approx(1030)
+
+def test_prefers_keys_with_fewer_calls_in_flight(clock):
+    manager = APIKeyManager(['key-a', 'key-b', 'key-c'])
+
+    first, second, third = (acquire(manager) for _ in range(3))
+    assert {first, second, third} == {'key-a', 'key-b', 'key-c'}
+
+    manager.report_success(second)
+    assert acquire(manager) == second
+
+def test_prefers_keys_with_a_lower_error_rate(clock):
+    manager = APIKeyManager(['key-a', 'key-b'])
+    for _ in range(4):
+        key = acquire(manager)
+        if key == 'key-a':
+            manager.report_failure(key)
+        else:
+            manager.report_success(key)
+
+    assert acquire(manager) == 'key-b'
+
+def test_rate_limited_key_cools_down_with_doubling(clock):
+    manager = APIKeyManager(['key-a'])
+
+    for expected in (30, 60, 120):
+        key = acquire(manager, max_wait=1000)
+        manager.report_failure(key, 'flash', RateLimited())
+        assert manager._wait_time(key, 'flash', clock.now) == expected
+        assert manager._wait_time(key, 'pro', clock.now) == 0
+
+    key = acquire(manager, 'flash', max_wait=1000)
+    manager.report_success(key, 'flash')
+    manager.report_failure(acquire(manager, 'flash'), 'flash', RateLimited())
+    assert manager._wait_time(key, 'flash', clock.now) == 30  # streak reset by the success
+
+def test_cooldown_honours_retry_after(clock):
+    manager = APIKeyManager(['key-a', 'key-b'])
+    key = acquire(manager)
+
+    manager.report_failure(key, None, RateLimited(headers={'Retry-After': '7'}))
+
+    assert manager._wait_time(key, None, clock.now) == 7
+    assert acquire(manager) != key
+
+def test_other_failures_do_not_cool_down(clock):
+    manager = APIKeyManager(['key-a'])
+    key = acquire(manager)
+
+    manager.report_failure(key, None, ValueError("bad prompt"))
+
+    assert manager._wait_time(key, None, clock.now) == 0
+
+def test_release_gives_back_an_abandoned_call(clock):
+    manager = APIKeyManager(['key-a'])
+    key = acquire(manager)
+
+    manager.release(key)
+
+    assert manager._health[key].in_flight == 0
+    assert manager._health[key].outcomes.count(False) == 0
+
+@pytest.mark.parametrize('exc, seconds', [
+    (RateLimited(headers={'retry-after': '12'}), 12),
+    (Exception('429 Quota exceeded. retry_delay {\n  seconds: 41\n}'), 41),
+    (Exception('Rate limit reached. Please retry in 0:01:05.'), 65),
+    (Exception('Too many requests, retry after 2.5s'), 2.5),
+    (Exception('429 Too Many Requests'), None),
+])
+def test_retry_after_from(exc, seconds):
+    assert retry_after_from(exc) == seconds
@@ -0,0 +1,176 @@
+import asyncio
+import types
+
+import pytest
+
+from narrato.core import cache as cache_module
+from narrato.core.cache import DiskCache, SingleFlight
+from narrato.services import generation, llm_cache as llm_cache_module
+from narrato.services.llm_cache import LLMCache, TextResponse, llm_cache_key
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    fake_time = types.SimpleNamespace(monotonic=fake, time=fake)
+    monkeypatch.setattr(cache_module, 'time', fake_time)
+    monkeypatch.setattr(llm_cache_module, 'time', fake_time)
+    return fake
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    llm_cache = LLMCache(ttl=60)
+    llm_cache._disk.open(str(tmp_path / 'llm_cache.sqlite3'))
+    return llm_cache
+
+class Gemini:
+    """Counts calls and answers with the queued texts."""
+    def __init__(self, *texts, delay=0):
+        self.texts = list(texts)
+        self.calls = 0
+        self.delay = delay
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return TextResponse(self.texts.pop(0))
+
+def ask(cache, gemini, prompt='Tell a story', **kwargs):
+    return asyncio.run(cache.get_or_create(prompt, None, gemini, **kwargs)).text
+
+def test_repeated_prompts_are_answered_from_cache(cache):
+    gemini = Gemini('once upon a time')
+
+    assert ask(cache, gemini) == 'once upon a time'
+    assert ask(cache, gemini) == 'once upon a time'
+    assert gemini.calls == 1
+    assert cache.stats()['hits'] == {'memory': 1, 'disk': 0}
+
+def test_key_covers_settings_and_config():
+    base = llm_cache_key('p')
+
+    assert llm_cache_key('p', {'harassment': 'block_none'}) != base
+    assert llm_cache_key('p', generation_config={'response_schema': {'type': 'object'}}) != base
+    assert llm_cache_key('p', policy='other-model') != base
+    assert llm_cache_key('p', {'a': 1, 'b': 2}) == llm_cache_key('p', {'b': 2, 'a': 1})
+
+def test_entries_expire_after_the_ttl(cache, clock):
+    gemini = Gemini('first', 'second')
+    ask(cache, gemini)
+
+    clock.now += 59
+    assert ask(cache, gemini) == 'first'
+    clock.now += 2
+    assert ask(cache, gemini) == 'second'
+    assert gemini.calls == 2
+
+def test_disk_entries_survive_a_restart(cache, tmp_path):
+    ask(cache, Gemini('kept'))
+    restarted = LLMCache(ttl=60)
+    restarted._disk.open(str(tmp_path / 'llm_cache.sqlite3'))
+    gemini = Gemini('new')
+
+    assert ask(restarted, gemini) == 'kept'
+    assert gemini.calls == 0
+    assert restarted.stats()['hits'] == {'memory': 0, 'disk': 1}
+
+def test_forget_makes_the_next_call_ask_again(cache):
+    gemini = Gemini('not json', '{"ok": true}')
+    ask(cache, gemini)
+
+    cache.forget('Tell a story')
+
+    assert ask(cache, gemini) == '{"ok": true}'
+    assert gemini.calls == 2
+
+def test_concurrent_identical_prompts_share_one_call(cache):
+    gemini = Gemini('shared', delay=0.01)
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_create('Tell a story', None, gemini) for _ in range(5)))
+
+    responses = asyncio.run(run())
+
+    assert [response.text for response in responses] == ['shared'] * 5
+    assert gemini.calls == 1
+    assert cache.stats()['shared_in_flight'] == 4
+
+def test_zero_ttl_turns_the_cache_off(clock):
+    gemini = Gemini('a', 'b')
+    llm_cache = LLMCache(ttl=0)
+
+    assert [ask(llm_cache, gemini), ask(llm_cache, gemini)] == ['a', 'b']
+
+def test_single_flight_shares_errors_and_then_retries():
+    flight = SingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append('call')
+        await asyncio.sleep(0.01)
+        raise RuntimeError("gemini down")
+
+    async def run():
+        results = await asyncio.gather(*(flight.run('k', failing) for _ in range(3)), return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await flight.run('k', failing)
+        return results
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(calls) == 2
+
+def test_single_flight_survives_the_leader_being_cancelled():
+    flight = SingleFlight()
+    calls = []
+
+    async def slow():
+        calls.append('call')
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    async def run():
+        leader = asyncio.create_task(flight.run('k', slow))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.run('k', slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(run()) == 'done'
+    assert len(calls) == 2
+
+def test_disk_cache_trims_least_recently_used_entries(tmp_path, clock):
+    disk = DiskCache(max_entries=50)
+    disk.open(str(tmp_path / 'cache.sqlite3'))
+    for i in range(100):
+        clock.now += 1
+        disk.set(f'key-{i}', {'n': i})
+        if i == 60:
+            clock.now += 1
+            disk.get('key-0')  # recently used, so it is kept
+
+    assert len(disk) == 50
+    assert disk.get('key-0') == {'n': 0}
+    assert disk.get('key-50') is None
+    assert disk.get('key-51') == {'n': 51}
+
+def test_style_guide_that_does_not_parse_is_not_reused(cache, monkeypatch):
+    answers = Gemini('Sorry, I cannot do that.', '{"art_style": {"overall_style": "Watercolour"}}')
+    monkeypatch.setattr(generation, 'llm_cache', cache)
+    monkeypatch.setattr(generation, '_generate_uncached', lambda prompt, safety_settings=None, generation_config=None: answers())
+    story = {'title': 'Fox', 'paragraphs': ['One', 'Two']}
+
+    fallback = asyncio.run(generation.generate_style_guide(story))
+    retried = asyncio.run(generation.generate_style_guide(story))
+
+    assert fallback['art_style']['overall_style'] != 'Watercolour'
+    assert retried == {'art_style': {'overall_style': 'Watercolour'}}
+    assert answers.calls == 2
@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from flask import Flask
+
+from narrato.routes import story as story_routes
+from narrato.services import pdf_cache as pdf_cache_module
+from narrato.services.pdf_cache import PdfCache
+
+STORY = {'story_uuid': 'story-1', 'title': 'The Lighthouse', 'story': 'Once upon a time.'}
+
+@pytest.fixture
+def cache(tmp_path):
+    pdf_cache = PdfCache(max_bytes=100)
+    pdf_cache.directory = str(tmp_path)
+    pdf_cache.template_hash = 'template-v1'
+    return pdf_cache
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Replaces the render pool with a stub that records each story it renders."""
+    rendered = []
+    def render(story):
+        rendered.append(story['story_uuid'])
+        return f"%PDF {story['story_uuid']}".encode()
+    monkeypatch.setattr(pdf_cache_module, 'render_story_pdf', render)
+    return rendered
+
+def set_last_use(cache, key, timestamp):
+    os.utime(cache._path(key), (timestamp, timestamp))
+
+def test_key_changes_with_story_content_and_template(cache):
+    key = cache.key_for(STORY)
+    assert cache.key_for(dict(STORY)) == key
+    assert cache.key_for({**STORY, 'story': 'A different tale.'}) != key
+    assert cache.key_for({**STORY, 'story_uuid': 'story-2'}) != key
+    cache.template_hash = 'template-v2'
+    assert cache.key_for(STORY) != key
+
+def test_get_or_render_renders_once_and_returns_key_as_etag(cache, renders):
+    path, etag = cache.get_or_render(STORY)
+    assert etag == cache.key_for(STORY)
+    assert cache.get_or_render(STORY) == (path, etag)
+    assert renders == ['story-1']
+    with open(path, 'rb') as f:
+        assert f.read() == b'%PDF story-1'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_edited_story_gets_a_new_etag(cache, renders):
+    _, etag = cache.get_or_render(STORY)
+    _, edited_etag = cache.get_or_render({**STORY, 'story': 'A different tale.'})
+    assert edited_etag != etag
+    assert len(renders) == 2
+
+def test_eviction_removes_least_recently_used_files(cache):
+    for i, key in enumerate(('a', 'b', 'c')):
+        cache.put(key, b'x' * 30)
+        set_last_use(cache, key, 1000 + i)
+    # Serving 'a' makes it the most recently used
+    assert cache.get('a')
+    cache.put('d', b'x' * 30)
+    assert cache.get('b') is None
+    assert not os.path.exists(cache._path('b'))
+    assert all(cache.get(key) for key in ('a', 'c', 'd'))
+    assert cache.stats()['bytes'] == 90
+
+def test_eviction_keeps_the_new_file_even_when_it_is_too_large(cache):
+    cache.put('a', b'x' * 30)
+    cache.put('huge', b'x' * 150)
+    assert cache.get('a') is None
+    assert cache.get('huge')
+
+def test_get_forgets_files_removed_from_disk(cache):
+    cache.put('a', b'x' * 10)
+    os.remove(cache._path('a'))
+    assert cache.get('a') is None
+    assert cache.stats()['files'] == 0
+
+@pytest.fixture
+def client(monkeypatch, cache):
+    monkeypatch.setattr(story_routes, 'pdf_cache', cache)
+    monkeypatch.setattr(story_routes, '_find_story', lambda indexed_story, filter_dict: (STORY, None))
+    app = Flask(__name__)
+    app.register_blueprint(story_routes.story_bp)
+    return app.test_client()
+
+def test_export_pdf_answers_matching_etag_with_not_modified(client, renders):
+    response = client.get('/export_pdf/story-1')
+    assert response.status_code == 200
+    etag = response.headers['ETag'].strip('"')
+    cached = client.get('/export_pdf/story-1', headers={'If-None-Match': f'"{etag}"'})
+    assert cached.status_code == 304
+    assert renders == ['story-1']
+
+@pytest.mark.parametrize('error', [FuturesTimeoutError(), BrokenProcessPool()])
+def test_export_pdf_reports_render_failures(client, monkeypatch, cache, error):
+    def fail(story):
+        raise error
+    monkeypatch.setattr(cache, 'get_or_render', fail)
+    response = client.get('/export_pdf/story-1')
+    assert response.status_code == 503
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from narrato.core.pipeline import Stage, StagePipeline
+
+def collect(pipeline, **kwargs):
+    async def run():
+        return [event async for event in pipeline.run(**kwargs)]
+    return asyncio.run(run())
+
+def test_stages_start_after_their_dependencies():
+    order = []
+
+    def stage(name, delay=0):
+        async def run(report):
+            order.append(f"start {name}")
+            await asyncio.sleep(delay)
+            report(name, 1)
+            order.append(f"end {name}")
+        return run
+
+    pipeline = StagePipeline([
+        Stage('content', stage('content')),
+        Stage('images', stage('images', 0.02), ['content']),
+        Stage('audio', stage('audio'), ['content']),
+        Stage('save', stage('save'), ['images', 'audio']),
+    ])
+    collect(pipeline)
+
+    assert order[:2] == ['start content', 'end content']
+    # Independent stages run side by side
+    assert order.index('start audio') < order.index('end images')
+    assert order[-2:] == ['start save', 'end save']
+
+def test_progress_is_weighted_and_monotonic():
+    async def half_then_done(report):
+        report('half', 0.5)
+        await asyncio.sleep(0)
+        report('done', 1)
+
+    pipeline = StagePipeline([
+        Stage('a', half_then_done, weight=30),
+        Stage('b', half_then_done, ['a'], weight=10),
+    ])
+    progress = [event[1] for event in collect(pipeline)]
+
+    assert progress == [37, 75, 87, 100]
+
+def test_completed_stages_are_skipped_and_counted():
+    ran = []
+
+    async def run(report):
+        ran.append('b')
+        report('b', 1)
+
+    async def must_not_run(report):
+        raise AssertionError("completed stage was run again")
+
+    pipeline = StagePipeline([Stage('a', must_not_run, weight=3), Stage('b', run, ['a'], weight=1)])
+    events = collect(pipeline, completed=['a'])
+
+    assert ran == ['b']
+    assert events == [('b', 100, None)]
+
+def test_on_stage_done_runs_before_dependents_start():
+    log = []
+
+    async def run(report):
+        log.append('b')
+
+    async def on_stage_done(name):
+        log.append(f"done {name}")
+
+    async def first(report):
+        log.append('a')
+
+    collect(StagePipeline([Stage('a', first), Stage('b', run, ['a'])]), on_stage_done=on_stage_done)
+
+    assert log == ['a', 'done a', 'b', 'done b']
+
+def test_failing_stage_cancels_the_others():
+    cancelled = asyncio.Event()
+
+    async def fail(report):
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def slow(report):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def run():
+        pipeline = StagePipeline([Stage('fail', fail), Stage('slow', slow)])
+        with pytest.raises(ValueError):
+            async for _ in pipeline.run():
+                pass
+        await asyncio.sleep(0)
+        return cancelled.is_set()
+
+    assert asyncio.run(run())
+
+def test_unknown_dependency_is_rejected():
+    async def run(report):
+        pass
+
+    with pytest.raises(ValueError, match="unknown stage"):
+        StagePipeline([Stage('a', run, ['missing'])])
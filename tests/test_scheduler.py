@@ -0,0 +1,77 @@
+import asyncio
+
+from narrato.services.scheduler import ProviderQueue, ProviderScheduler
+
+def test_free_slots_are_shared_round_robin_between_owners():
+    async def run():
+        queue = ProviderQueue('test', capacity=1)
+        await queue.acquire('holder')
+        granted = []
+
+        async def call(owner, n):
+            await queue.acquire(owner)
+            granted.append((owner, n))
+            queue.release()
+
+        # 'busy' queues five calls before 'light' queues two
+        tasks = [asyncio.create_task(call('busy', n)) for n in range(5)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(call('light', n)) for n in range(2)]
+        await asyncio.sleep(0)
+        queue.release()
+        await asyncio.gather(*tasks)
+        return granted
+
+    granted = asyncio.run(run())
+
+    assert [owner for owner, _ in granted] == ['busy', 'light', 'busy', 'light', 'busy', 'busy', 'busy']
+    # Each owner's own calls stay in order
+    assert [n for owner, n in granted if owner == 'busy'] == [0, 1, 2, 3, 4]
+
+def test_capacity_is_never_exceeded():
+    async def run():
+        scheduler = ProviderScheduler({'speechify': 3})
+        active = peak = 0
+
+        async def call(owner):
+            nonlocal active, peak
+            async with scheduler.slot('speechify', owner):
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.001)
+                active -= 1
+
+        await asyncio.gather(*(call(i % 4) for i in range(20)))
+        return peak, scheduler.queues['speechify'].in_use
+
+    assert asyncio.run(run()) == (3, 0)
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def run():
+        queue = ProviderQueue('test', capacity=1)
+        await queue.acquire('a')
+        waiter = asyncio.create_task(queue.acquire('b'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        queued_after_cancel = queue.queued
+        queue.release()
+        return queued_after_cancel, queue.in_use
+
+    assert asyncio.run(run()) == (0, 0)
+
+def test_slot_granted_while_cancelling_is_handed_on():
+    async def run():
+        queue = ProviderQueue('test', capacity=1)
+        await queue.acquire('a')
+        first = asyncio.create_task(queue.acquire('b'))
+        second = asyncio.create_task(queue.acquire('c'))
+        await asyncio.sleep(0)
+        # The slot goes to 'b', which is cancelled before it resumes
+        queue.release()
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await second
+        return queue.in_use
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from narrato.core.cache import LRUCache
+from narrato.services import shov_api
+
+class FakeShov:
+    """Stands in for the Shov `where` endpoint, answering from a list of queued results."""
+    def __init__(self):
+        self.results = []
+        self.calls = 0
+        self.refreshed = threading.Event()
+
+    def __call__(self, collection_name, filter_dict=None):
+        self.calls += 1
+        self.refreshed.set()
+        return self.results.pop(0)
+
+def found(*ids):
+    return {'success': True, 'items': [{'id': item_id, 'value': {}} for item_id in ids]}
+
+@pytest.fixture
+def shov(monkeypatch):
+    fake = FakeShov()
+    monkeypatch.setattr(shov_api, '_shov_where_uncached', fake)
+    monkeypatch.setattr(shov_api, '_where_cache', LRUCache(16))
+    monkeypatch.setattr(shov_api, '_collection_generation', {})
+    monkeypatch.setattr(shov_api, '_refreshing', set())
+    return fake
+
+def test_results_are_served_from_cache_until_a_write(shov):
+    shov.results = [found('1'), found('1', '2')]
+
+    assert shov_api.shov_where('stories', {'email': 'a@b.c'}) == found('1')
+    assert shov_api.shov_where('stories', {'email': 'a@b.c'}) == found('1')
+    assert shov.calls == 1
+
+    shov_api.invalidate_collection('stories')
+    assert shov_api.shov_where('stories', {'email': 'a@b.c'}) == found('1', '2')
+    assert shov.calls == 2
+
+def test_other_collections_are_not_cached(shov):
+    shov.results = [found('1'), found('1')]
+
+    shov_api.shov_where('checkpoints', {'story_uuid': 'u'})
+    shov_api.shov_where('checkpoints', {'story_uuid': 'u'})
+
+    assert shov.calls == 2
+
+def test_empty_and_failed_results_are_not_cached(shov):
+    shov.results = [{'success': True, 'items': []}, {'success': False, 'error': 'RequestException', 'items': []}, found('1')]
+
+    for _ in range(3):
+        shov_api.shov_where('stories', {'story_uuid': 'u'})
+
+    assert shov.calls == 3
+
+def test_lookups_by_uuid_use_the_shorter_ttl():
+    assert shov_api._cache_ttl('stories', {'story_uuid': 'u'}) == min(shov_api.SHOV_CACHE_TTL['stories'], shov_api.SHOV_LOOKUP_CACHE_TTL)
+    assert shov_api._cache_ttl('stories', {'email': 'a@b.c'}) == shov_api.SHOV_CACHE_TTL['stories']
+    assert shov_api._cache_ttl('checkpoints', {'story_uuid': 'u'}) is None
+
+def test_stale_entry_is_served_while_refreshing(shov, monkeypatch):
+    monkeypatch.setitem(shov_api.SHOV_CACHE_TTL, 'stories', 0.01)
+    shov.results = [found('1')]
+    shov_api.shov_where('stories', {'public': True})
+    shov.refreshed.clear()
+    time.sleep(0.02)
+
+    shov.results = [found('1', '2')]
+    assert shov_api.shov_where('stories', {'public': True}) == found('1')
+    assert shov.refreshed.wait(1)
+    for _ in range(100):
+        if not shov_api._refreshing:
+            break
+        time.sleep(0.01)
+    assert shov_api._where_cache.get(shov_api._where_cache_key('stories', {'public': True}))[0] == found('1', '2')
+
+def test_refresh_that_finds_nothing_drops_the_stale_entry(shov):
+    key = shov_api._where_cache_key('stories', {'story_uuid': 'u'})
+    shov_api._where_cache.set(key, found('1'))
+    shov.results = [{'success': True, 'items': []}]
+
+    shov_api._refresh_where(key, 'stories', {'story_uuid': 'u'}, generation=0)
+
+    assert shov_api._where_cache.get(key) is None
+
+def test_result_racing_with_a_write_is_not_cached(shov, monkeypatch):
+    def where_then_write(collection_name, filter_dict=None):
+        shov_api.invalidate_collection('stories')
+        return found('1')
+    monkeypatch.setattr(shov_api, '_shov_where_uncached', where_then_write)
+
+    shov_api.shov_where('stories', {'email': 'a@b.c'})
+
+    assert len(shov_api._where_cache) == 0
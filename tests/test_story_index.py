@@ -0,0 +1,74 @@
+import pytest
+
+from narrato.services import story_index as story_index_module
+from narrato.services.story_index import SUMMARY_BACKFILL_MARKER, SUMMARY_COLLECTION, StoryIndex, summary_record
+
+class FakeShov:
+    def __init__(self, stories, summaries=()):
+        self.collections = {'stories': list(stories), SUMMARY_COLLECTION: list(summaries)}
+        self.keys = {}
+        self.scans = []
+
+    def where(self, collection_name, filter_dict=None):
+        self.scans.append(collection_name)
+        items = self.collections[collection_name]
+        if filter_dict:
+            items = [item for item in items if all(item['value'].get(k) == v for k, v in filter_dict.items())]
+        return {'success': True, 'items': items}
+
+    def add(self, collection_name, value):
+        item_id = f"{collection_name}-{len(self.collections[collection_name])}"
+        self.collections[collection_name].append({'id': item_id, 'value': value})
+        return {'success': True, 'id': item_id}
+
+    def set(self, key, value):
+        self.keys[key] = value
+        return {'success': True}
+
+    def get(self, key):
+        return {'success': key in self.keys, 'value': self.keys.get(key)}
+
+@pytest.fixture
+def shov(monkeypatch):
+    fake = FakeShov([
+        {'id': 's1', 'value': {'story_uuid': 'u1', 'title': 'Old', 'email': 'a@b.c', 'public': True}},
+        {'id': 's2', 'value': {'story_uuid': 'u2', 'title': 'New', 'email': 'a@b.c'}},
+    ], [
+        {'id': 'sum2', 'value': summary_record('s2', {'story_uuid': 'u2', 'title': 'New', 'email': 'a@b.c'})},
+    ])
+    monkeypatch.setattr(story_index_module, '_shov_where_uncached', fake.where)
+    monkeypatch.setattr(story_index_module, 'shov_add', fake.add)
+    monkeypatch.setattr(story_index_module, 'shov_set', fake.set)
+    monkeypatch.setattr(story_index_module, 'shov_get', fake.get)
+    return fake
+
+def test_backfill_writes_missing_summaries_and_sets_the_marker(shov):
+    index = StoryIndex()
+
+    assert index.rebuild(include_stories=True)
+
+    assert [item['value']['story_id'] for item in shov.collections[SUMMARY_COLLECTION]] == ['s2', 's1']
+    assert shov.keys[SUMMARY_BACKFILL_MARKER]['backfilled'] == 1
+    assert index.backfilled
+    assert [s['story_uuid'] for s in index.public_stories()['items']] == ['u1']
+
+def test_marker_stops_later_processes_from_scanning_stories(shov):
+    StoryIndex().rebuild(include_stories=True)
+    shov.scans.clear()
+
+    index = StoryIndex()
+    assert index._backfill_marker_set()
+    index.rebuild(include_stories=not index._backfill_marker_set())
+
+    assert shov.scans == [SUMMARY_COLLECTION]
+    assert index.story_for_uuid('u1') is None  # full records are only fetched on demand
+    assert index.summary_id_for('s1')
+
+def test_failed_backfill_leaves_the_marker_unset(shov, monkeypatch):
+    monkeypatch.setattr(story_index_module, 'shov_add', lambda collection_name, value: {'success': False, 'error': 'RequestException'})
+    index = StoryIndex()
+
+    index.rebuild(include_stories=True)
+
+    assert SUMMARY_BACKFILL_MARKER not in shov.keys
+    assert not index.backfilled
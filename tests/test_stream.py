@@ -0,0 +1,183 @@
+import asyncio
+import copy
+
+import pytest
+
+from narrato.routes import stream
+
+async def collect(agen):
+    return [event async for event in agen]
+
+def test_pad_slots_keeps_entries_by_index():
+    assert stream._pad_slots(['a', None, 'c'], 5) == ['a', None, 'c', None, None]
+    assert stream._pad_slots(['a', 'b', 'c'], 2) == ['a', 'b']
+
+def test_fan_out_bounds_concurrency_and_yields_in_completion_order():
+    active = peak = 0
+
+    async def work(i):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01 * (5 - i))
+        active -= 1
+        return f"result {i}"
+
+    results = asyncio.run(collect(stream._fan_out(range(5), work, limit=2)))
+
+    assert peak == 2
+    assert sorted(results) == [(i, f"result {i}") for i in range(5)]
+    assert results[0] == (1, "result 1")  # 0 and 1 start first; 1 is quicker
+
+def test_fan_out_cancels_the_rest_when_the_caller_stops():
+    cancelled = []
+
+    async def work(i):
+        try:
+            await asyncio.sleep(0 if i == 0 else 10)
+        except asyncio.CancelledError:
+            cancelled.append(i)
+            raise
+        return i
+
+    async def first_only():
+        fan_out = stream._fan_out(range(4), work, limit=4)
+        async for result in fan_out:
+            await fan_out.aclose()
+            await asyncio.sleep(0)
+            return result
+
+    assert asyncio.run(first_only()) == (0, 0)
+    assert sorted(cancelled) == [1, 2, 3]
+
+def test_fan_out_propagates_errors():
+    async def work(i):
+        if i == 2:
+            raise RuntimeError("image failed")
+        return i
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(stream._fan_out(range(4), work, limit=2)))
+
+class FakeCheckpoint:
+    """Stands in for StoryCheckpoint, starting from the state in `saved`."""
+    saved = {}
+    instances = []
+
+    def __init__(self, story_uuid):
+        self.story_uuid = story_uuid
+        self.source = 'local' if story_uuid in self.saved else None
+        self.changes = []
+        self.discarded = False
+        self.instances.append(self)
+
+    async def load(self):
+        return copy.deepcopy(self.saved.get(self.story_uuid, {}))
+
+    def set(self, path, value):
+        self.changes.append((tuple(path), value))
+
+    def flush_soon(self):
+        pass
+
+    async def discard(self):
+        self.discarded = True
+
+@pytest.fixture
+def providers(monkeypatch):
+    """Records the provider calls a story makes and the story it saves."""
+    calls = {'image': [], 'voice': [], 'saved': []}
+
+    async def generate_image(prompt, on_late_result=None):
+        calls['image'].append(prompt)
+        return f"https://img/{prompt}.png"
+
+    async def generate_voice(text):
+        calls['voice'].append(text)
+        return f"https://audio/{text}.mp3"
+
+    async def shov_add(collection_name, value):
+        if collection_name == 'stories':
+            calls['saved'].append(copy.deepcopy(value))
+        return {'success': True, 'id': f'{collection_name}-1'}
+
+    async def unexpected(*args, **kwargs):
+        raise AssertionError("a completed stage was run again")
+
+    FakeCheckpoint.saved = {}
+    FakeCheckpoint.instances = []
+    monkeypatch.setattr(stream, 'StoryCheckpoint', FakeCheckpoint)
+    monkeypatch.setattr(stream, 'generate_image', generate_image)
+    monkeypatch.setattr(stream, 'generate_voice', generate_voice)
+    monkeypatch.setattr(stream, 'generate_story_content', unexpected)
+    monkeypatch.setattr(stream, 'generate_visual_plan', unexpected)
+    monkeypatch.setattr(stream, 'shov_add', shov_add)
+    monkeypatch.setattr(stream, 'shov_update', unexpected)
+    return calls
+
+def story_checkpoint(images, audio_files, completed_stages):
+    return {
+        'story_data': {
+            'title': 'Fox',
+            'paragraphs': ['One', 'Two'],
+            'style_guide': {}, 'character_database': {},
+            'images': images,
+            'audio_files': audio_files,
+        },
+        'image_prompts': ['p0', 'p1', 'p2'],
+        'completed_stages': completed_stages,
+    }
+
+def run_story(story_uuid='u1'):
+    return asyncio.run(collect(stream.generate_story_for_stream('a fox', 'generate', 2, 2, 'a@b.c', False, story_uuid)))
+
+def test_resumed_story_only_generates_the_missing_images(providers):
+    done = {'url': 'https://img/done.png', 'prompt': 'p0'}
+    FakeCheckpoint.saved['u1'] = story_checkpoint([done, None, None], ['t.mp3', '1.mp3', '2.mp3'], ['audio', 'content', 'visual_plan'])
+
+    events = run_story()
+
+    assert events[0]['task'] == 'Resuming generation...'
+    assert events[-1]['task'] == 'Finished!'
+    assert sorted(providers['image']) == ['p1', 'p2']
+    assert providers['voice'] == []
+    saved, = providers['saved']
+    assert [image['url'] for image in saved['images']] == ['https://img/done.png', 'https://img/p1.png', 'https://img/p2.png']
+    assert FakeCheckpoint.instances[0].discarded
+
+def test_resumed_story_records_each_new_image_in_its_checkpoint(providers):
+    FakeCheckpoint.saved['u1'] = story_checkpoint([None, None, None], ['t.mp3', '1.mp3', '2.mp3'], ['audio', 'content', 'visual_plan'])
+
+    run_story()
+
+    changes = FakeCheckpoint.instances[0].changes
+    assert sorted(path for path, _ in changes if path[:2] == ('story_data', 'images') and len(path) == 3) == [
+        ('story_data', 'images', 0), ('story_data', 'images', 1), ('story_data', 'images', 2)]
+    assert ('completed_stages', ('audio', 'content', 'images', 'visual_plan')) in [(path[0], tuple(value)) for path, value in changes if path == ('completed_stages',)]
+
+def test_old_step_checkpoints_resume_at_the_right_stage():
+    assert stream._stages_from_step(0) == []
+    assert stream._stages_from_step(2) == ['content']
+    assert stream._stages_from_step(4) == ['content', 'visual_plan', 'images']
+
+def test_resumed_story_only_narrates_the_missing_clips(providers):
+    images = [{'url': f'https://img/p{i}.png', 'prompt': f'p{i}'} for i in range(3)]
+    # The title and last paragraph were narrated; the list is short if the last clips never finished
+    FakeCheckpoint.saved['u1'] = story_checkpoint(images, ['https://audio/Fox.mp3', None, 'https://audio/Two.mp3'], ['content', 'images', 'visual_plan'])
+
+    events = run_story()
+
+    assert providers['voice'] == ['One']
+    assert providers['image'] == []
+    assert {'audio_file': 'https://audio/One.mp3', 'index': 1} in [event['data'] for event in events]
+    saved, = providers['saved']
+    assert saved['audio_files'] == ['https://audio/Fox.mp3', 'https://audio/One.mp3', 'https://audio/Two.mp3']
+
+def test_short_audio_list_is_padded_before_resuming(providers):
+    images = [{'url': f'https://img/p{i}.png', 'prompt': f'p{i}'} for i in range(3)]
+    FakeCheckpoint.saved['u1'] = story_checkpoint(images, ['https://audio/Fox.mp3'], ['content', 'images', 'visual_plan'])
+
+    run_story()
+
+    assert sorted(providers['voice']) == ['One', 'Two']
+    assert providers['saved'][0]['audio_files'] == ['https://audio/Fox.mp3', 'https://audio/One.mp3', 'https://audio/Two.mp3']
@@ -0,0 +1,102 @@
+import asyncio
+import base64
+import types
+
+import pytest
+
+from narrato.core.mp3 import mp3_duration, mp3_frames, split_mp3
+from narrato.services import generation
+from narrato.services.tts_batch import SpeechBatcher, SpeechMarksMismatch, batch_ssml, segment_cut_times
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz: 417-byte frames of 1152 samples (~26 ms)
+FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)
+FRAME_SECONDS = 1152 / 44100
+
+def mp3(frames, id3=False):
+    tag = b'ID3\x04\x00\x00\x00\x00\x00\x0a' + bytes(10) if id3 else b''
+    return tag + FRAME * frames + (b'TAG' + bytes(125) if id3 else b'')
+
+def marks(*words):
+    """Word marks for (word, start_ms, end_ms) triples, as Speechify returns them."""
+    return {'chunks': [{'type': 'word', 'value': w, 'start_time': start, 'end_time': end} for w, start, end in words]}
+
+def test_mp3_frames_skip_tags():
+    frames = mp3_frames(mp3(3, id3=True))
+
+    assert [offset for offset, _, _ in frames] == [20, 437, 854]
+    assert mp3_duration(mp3(100)) == pytest.approx(100 * FRAME_SECONDS)
+
+def test_split_mp3_cuts_on_the_nearest_frames():
+    data = mp3(100)
+
+    clips = split_mp3(data, [10 * FRAME_SECONDS + 0.001, 60 * FRAME_SECONDS - 0.001])
+
+    assert [len(clip) // len(FRAME) for clip in clips] == [10, 50, 40]
+    assert b''.join(clips) == data
+    assert all(mp3_frames(clip) for clip in clips)
+
+def test_split_mp3_rejects_cuts_that_leave_an_empty_clip():
+    with pytest.raises(ValueError):
+        split_mp3(mp3(10), [0.0])
+    with pytest.raises(ValueError):
+        split_mp3(mp3(10), [0.1, 0.1])
+
+def test_split_mp3_rejects_other_data():
+    with pytest.raises(ValueError):
+        split_mp3(b'RIFF' + bytes(100), [])
+
+def test_cut_times_fall_between_texts():
+    speech_marks = marks(('The', 0, 200), ('fox.', 200, 600), ('It', 1800, 2000), ("ran!", 2000, 2400), ('End', 3600, 4000))
+
+    cuts = segment_cut_times(speech_marks, ['The fox.', "It ran!", 'End'])
+
+    assert cuts == [1.2, 3.0]
+
+def test_cut_times_match_words_case_and_punctuation_insensitively():
+    speech_marks = marks(("Don't", 0, 300), ('STOP', 300, 500), ('now', 1500, 1800))
+
+    assert segment_cut_times(speech_marks, ["don't stop.", 'Now']) == [1.0]
+
+def test_cut_times_reject_marks_that_do_not_match():
+    with pytest.raises(SpeechMarksMismatch):
+        segment_cut_times(marks(('The', 0, 200), ('cat', 200, 400)), ['The', 'dog'])
+    with pytest.raises(SpeechMarksMismatch):
+        segment_cut_times(marks(('Hi', 0, 200)), ['Hi', '...'])
+
+def test_batch_ssml_escapes_texts_and_inserts_pauses():
+    ssml = batch_ssml(['Tom & Jerry', '<ok>'], 'calm', pause_ms=800)
+
+    assert ssml == '<speak><speechify:style emotion="calm">Tom &amp; Jerry<break time="800ms"/>&lt;ok&gt;</speechify:style></speak>'
+
+def test_speech_batcher_groups_clips_requested_together():
+    batches = []
+
+    async def synthesize(texts):
+        batches.append(texts)
+        return [f"{text}.mp3" for text in texts]
+
+    async def run():
+        batcher = SpeechBatcher(synthesize, max_chars=10, linger=0.01)
+        return await asyncio.gather(*(batcher.request(text) for text in ['aaa', 'bbb', 'ccc', 'dddd']))
+
+    urls = asyncio.run(run())
+
+    assert urls == ['aaa.mp3', 'bbb.mp3', 'ccc.mp3', 'dddd.mp3']
+    assert batches == [['aaa', 'bbb', 'ccc'], ['dddd']]
+
+def test_single_clip_ssml_is_escaped(monkeypatch):
+    sent = []
+
+    async def speechify_tts(ssml_input):
+        sent.append(ssml_input)
+        return types.SimpleNamespace(audio_data=base64.b64encode(b'mp3').decode())
+
+    async def upload_voice(audio_bytes):
+        return 'https://audio/clip.mp3'
+
+    monkeypatch.setattr(generation, '_speechify_tts', speechify_tts)
+    monkeypatch.setattr(generation, '_upload_voice', upload_voice)
+
+    assert asyncio.run(generation._synthesize_voice('Salt & pepper <3')) == 'https://audio/clip.mp3'
+    assert 'Salt &amp; pepper &lt;3' in sent[0]
+    assert sent[0] == batch_ssml(['Salt & pepper <3'], generation.TTS_EMOTION)